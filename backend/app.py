@@ -1,9 +1,34 @@
 
+import io
 import os
+import csv
+import json
+import zlib
+import math
+import time
+import base64
+import queue
+import atexit
 import datetime
 import sqlite3
-from functools import wraps
-from flask import Flask, request, jsonify, g
+import re
+import hmac
+import fcntl
+import shutil
+import sys
+import hashlib
+import secrets
+import pathlib
+import tempfile
+import collections
+import contextlib
+import concurrent.futures
+import multiprocessing
+import threading
+import xml.etree.ElementTree as ET
+from functools import wraps, lru_cache
+import click
+from flask import Flask, Response, request, jsonify, g, stream_with_context
 from flask_cors import CORS, cross_origin
 from werkzeug.security import generate_password_hash, check_password_hash
 import jwt
@@ -18,12 +43,280 @@ DB_FILE = os.getenv("SQLITE_FILE", "smart_gps.db")
 JWT_SECRET = os.getenv("JWT_SECRET", "change_this_secret")
 JWT_ALGORITHM = "HS256"
 JWT_EXP_MINUTES = int(os.getenv("JWT_EXP_MINUTES", "1440"))
+TOKEN_CACHE_SIZE = int(os.getenv("TOKEN_CACHE_SIZE", "10000"))  # 0 disables the verified-token cache
+# how often a worker re-reads the shared "token_cache" generation; a clear elsewhere lands within this
+TOKEN_CACHE_GENERATION_TTL = float(os.getenv("TOKEN_CACHE_GENERATION_TTL", "1.0"))
+# Werkzeug method string, e.g. "scrypt:32768:8:1" or "pbkdf2:sha256:600000"; changing it rehashes on login
+PASSWORD_HASH_METHOD = os.getenv("PASSWORD_HASH_METHOD", "scrypt")
+HASH_POOL_WORKERS = int(os.getenv("HASH_POOL_WORKERS", str(min(4, os.cpu_count() or 1))))  # 0 = inline
+HASH_POOL_MAX_PENDING = int(os.getenv("HASH_POOL_MAX_PENDING", "64"))
+HASH_POOL_WAIT_S = float(os.getenv("HASH_POOL_WAIT_S", "5"))
+REFERENCE_CACHE_MAX_ENTRIES = int(os.getenv("REFERENCE_CACHE_MAX_ENTRIES", "256"))
+NEARBY_START_RADIUS_M = float(os.getenv("NEARBY_START_RADIUS_M", "500"))
+NEARBY_MAX_RADIUS_M = float(os.getenv("NEARBY_MAX_RADIUS_M", "50000"))
+# stop ETA model
+ETA_TRAINING_DAYS = int(os.getenv("ETA_TRAINING_DAYS", "28"))
+ETA_ARRIVAL_RADIUS_M = float(os.getenv("ETA_ARRIVAL_RADIUS_M", "50"))
+ETA_MAX_SEGMENT_S = int(os.getenv("ETA_MAX_SEGMENT_S", "3600"))
+ETA_DEFAULT_SPEED_KMH = float(os.getenv("ETA_DEFAULT_SPEED_KMH", "20"))
+ETA_STALE_S = int(os.getenv("ETA_STALE_S", "600"))
+GPS_BATCH_MAX = int(os.getenv("GPS_BATCH_MAX", "1000"))
+# "sync" commits every POST /gps inline; "queue" hands points to a background group-commit writer
+GPS_INGEST_MODE = os.getenv("GPS_INGEST_MODE", "sync").lower()
+GPS_QUEUE_FLUSH_ROWS = int(os.getenv("GPS_QUEUE_FLUSH_ROWS", "500"))
+GPS_QUEUE_FLUSH_MS = int(os.getenv("GPS_QUEUE_FLUSH_MS", "200"))
+GPS_QUEUE_MAX_DEPTH = int(os.getenv("GPS_QUEUE_MAX_DEPTH", "10000"))
+GPS_QUEUE_RETRY_MAX_S = float(os.getenv("GPS_QUEUE_RETRY_MAX_S", "5"))
+# queued points that cannot be committed land here as CSV; load them with `flask import-gps`
+GPS_DEAD_LETTER_FILE = os.getenv("GPS_DEAD_LETTER_FILE", DB_FILE + ".gps-dead-letter.csv")
+FLEET_CACHE_TTL = float(os.getenv("FLEET_CACHE_TTL", "1.0"))
+MAX_PER_PAGE = int(os.getenv("MAX_PER_PAGE", "500"))
+# SQLite tuning, applied to every pooled connection
+SQLITE_SYNCHRONOUS = os.getenv("SQLITE_SYNCHRONOUS", "NORMAL").upper()
+SQLITE_CACHE_SIZE = int(os.getenv("SQLITE_CACHE_SIZE", "-20000"))  # negative = KiB
+SQLITE_MMAP_SIZE = int(os.getenv("SQLITE_MMAP_SIZE", str(256 * 1024 * 1024)))
+SQLITE_BUSY_TIMEOUT_MS = int(os.getenv("SQLITE_BUSY_TIMEOUT_MS", "5000"))
+SQLITE_READ_POOL_SIZE = int(os.getenv("SQLITE_READ_POOL_SIZE", "4"))
+# live position stream
+STREAM_POLL_MS = int(os.getenv("STREAM_POLL_MS", "500"))
+STREAM_HEARTBEAT_S = float(os.getenv("STREAM_HEARTBEAT_S", "15"))
+STREAM_QUEUE_SIZE = int(os.getenv("STREAM_QUEUE_SIZE", "1000"))
+STREAM_REPLAY_MAX = int(os.getenv("STREAM_REPLAY_MAX", "5000"))
+STREAM_RETRY_MS = int(os.getenv("STREAM_RETRY_MS", "3000"))
+STREAM_TICKET_TTL_S = int(os.getenv("STREAM_TICKET_TTL_S", "30"))
+TRACK_MAX_POINTS = int(os.getenv("TRACK_MAX_POINTS", "500000"))
+# raw GPS retention (and access change log pruning); 0 days keeps raw points forever,
+# 0 interval disables the background job
+GPS_RETENTION_DAYS = int(os.getenv("GPS_RETENTION_DAYS", "0"))
+GPS_RETENTION_CHUNK = int(os.getenv("GPS_RETENTION_CHUNK", "2000"))
+GPS_RETENTION_PAUSE_MS = int(os.getenv("GPS_RETENTION_PAUSE_MS", "50"))
+GPS_RETENTION_INTERVAL_S = int(os.getenv("GPS_RETENTION_INTERVAL_S", "0"))
+# every worker runs the loop, but a run only proceeds while it holds the "gps-retention" lease row
+GPS_RETENTION_LEASE_S = int(os.getenv("GPS_RETENTION_LEASE_S", "60"))
+# slow-query log; 0 disables it. QUERY_PLAN_STRICT=1 refuses to start if a hot query lost its index
+SLOW_QUERY_MS = float(os.getenv("SLOW_QUERY_MS", "500"))
+SLOW_QUERY_LOG_SIZE = int(os.getenv("SLOW_QUERY_LOG_SIZE", "100"))
+QUERY_PLAN_STRICT = os.getenv("QUERY_PLAN_STRICT", "0") == "1"
+# metrics; every worker of one server must see the same METRICS_DIR. /metrics requires
+# "Authorization: Bearer <METRICS_TOKEN>" and stays disabled while the token is unset
+METRICS_DIR = os.getenv("METRICS_DIR", os.path.join(tempfile.gettempdir(), "smart_gps_metrics"))
+METRICS_FLUSH_S = float(os.getenv("METRICS_FLUSH_S", "5"))
+METRICS_TOKEN = os.getenv("METRICS_TOKEN", "")
 CORS_ORIGINS = ["http://localhost:8080", "http://localhost:3000", "http://localhost:5173", "http://192.168.100.5:8080","https://trackxx.vercel.app"]
 
 app = Flask(__name__)
 
 CORS(app, origins=CORS_ORIGINS, supports_credentials=True, allow_headers='*', methods=['GET', 'POST', 'PUT', 'DELETE', 'OPTIONS'])
 
+# -------------------------------
+# Metrics
+# -------------------------------
+# Each worker records into its own registry and every METRICS_FLUSH_S dumps it to
+# METRICS_DIR/<run id>/worker-<pid>.json. The run id ("<time>-<pid>") is minted by the
+# first process to start up (the gunicorn master with --preload) and reaches its workers
+# through METRICS_RUN_ID, so a restart never merges an earlier run's files. /metrics
+# sums every file of the run, so a scrape of any worker reports the whole server.
+# Files of workers that exited are folded into retired.json and removed, so counters
+# never go backwards and worker recycling does not grow the directory.
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+QUERY_COUNT_BUCKETS = (1, 2, 3, 5, 10, 20, 50, 100, 250)
+SQL_STRING_LITERAL = re.compile(r"'(?:[^']|'')*'")
+SQL_NUMBER_LITERAL = re.compile(r"(?<![\w.])\d+(?:\.\d+)?(?![\w.])")
+SQL_PLACEHOLDER_LIST = re.compile(r"\(\s*\?(?:\s*,\s*\?)+\s*\)")
+
+@lru_cache(maxsize=2048)
+def sql_fingerprint(sql):
+    """Normalised SQL (literals as ?, placeholder lists collapsed) and a short stable id for metric labels."""
+    text = " ".join(sql.split())
+    text = SQL_NUMBER_LITERAL.sub("?", SQL_STRING_LITERAL.sub("?", text))
+    text = SQL_PLACEHOLDER_LIST.sub("(?, ...)", text)
+    return text, hashlib.sha1(text.encode("utf-8")).hexdigest()[:12]
+
+def metrics_run_id():
+    """Id shared by one server's processes; inherited through METRICS_RUN_ID or minted here."""
+    run_id = os.environ.get("METRICS_RUN_ID")
+    if not run_id:
+        run_id = os.environ["METRICS_RUN_ID"] = f"{int(time.time())}-{os.getpid()}"
+    return run_id
+
+def pid_alive(pid):
+    if pid <= 0:
+        return False
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+def worker_file_pid(filename):
+    """pid in a "worker-<pid>.json" name, else None."""
+    digits = filename[len("worker-"):-len(".json")]
+    if filename.startswith("worker-") and filename.endswith(".json") and digits.isdigit():
+        return int(digits)
+    return None
+
+def snapshot_dict(histograms, counters, statements):
+    return {
+        "histograms": [[name, [list(l) for l in labels], entry] for (name, labels), entry in histograms.items()],
+        "counters": [[name, [list(l) for l in labels], value] for (name, labels), value in counters.items()],
+        "statements": dict(statements),
+    }
+
+def read_snapshot(path):
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+def write_snapshot(path, snapshot):
+    """Atomic rename, so readers never see a torn file."""
+    with open(path + ".tmp", "w") as f:
+        json.dump(snapshot, f)
+    os.replace(path + ".tmp", path)
+
+def merge_snapshot(totals, snapshot):
+    """Add one snapshot into (histograms, counters, statements)."""
+    histograms, counters, statements = totals
+    for name, labels, entry in snapshot["histograms"]:
+        key = (name, tuple(tuple(l) for l in labels))
+        total = histograms.get(key)
+        if total is None or total["buckets"] != entry["buckets"]:
+            histograms[key] = total = {"buckets": entry["buckets"], "counts": [0] * len(entry["buckets"]),
+                                       "sum": 0.0, "count": 0}
+        total["counts"] = [a + b for a, b in zip(total["counts"], entry["counts"])]
+        total["sum"] += entry["sum"]
+        total["count"] += entry["count"]
+    for name, labels, value in snapshot["counters"]:
+        key = (name, tuple(tuple(l) for l in labels))
+        counters[key] = counters.get(key, 0) + value
+    statements.update(snapshot["statements"])
+
+class MetricsRegistry:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self._reset()
+
+    def _reset(self):
+        self.pid = os.getpid()
+        self.histograms = {}
+        self.counters = {}
+        self.statements = {}
+        self.flushed_at = 0.0
+
+    def _check_fork(self):
+        if self.pid != os.getpid():
+            self._reset()
+
+    def observe(self, name, labels, value, buckets=LATENCY_BUCKETS):
+        key = (name, tuple(labels))
+        with self.lock:
+            self._check_fork()
+            entry = self.histograms.get(key)
+            if entry is None:
+                entry = self.histograms[key] = {"buckets": list(buckets), "counts": [0] * len(buckets),
+                                                "sum": 0.0, "count": 0}
+            for i, bound in enumerate(buckets):
+                if value <= bound:
+                    entry["counts"][i] += 1
+                    break
+            entry["sum"] += value
+            entry["count"] += 1
+
+    def inc(self, name, labels, amount=1):
+        key = (name, tuple(labels))
+        with self.lock:
+            self._check_fork()
+            self.counters[key] = self.counters.get(key, 0) + amount
+
+    def describe_statement(self, query_id, text):
+        if query_id not in self.statements:
+            with self.lock:
+                self.statements[query_id] = text[:300]
+
+    def to_dict(self):
+        with self.lock:
+            return snapshot_dict(self.histograms, self.counters, self.statements)
+
+    def directory(self):
+        return os.path.join(METRICS_DIR, metrics_run_id())
+
+    def flush(self, force=False):
+        """Write this worker's snapshot if one is due (atomic rename, never a torn file)."""
+        now = time.monotonic()
+        if not force and now - self.flushed_at < METRICS_FLUSH_S:
+            return
+        self.flushed_at = now
+        directory = self.directory()
+        os.makedirs(directory, exist_ok=True)
+        write_snapshot(os.path.join(directory, f"worker-{os.getpid()}.json"), self.to_dict())
+
+    def retire_dead_workers(self, directory):
+        """Fold the files of exited workers into retired.json and delete them; the caller holds the lock."""
+        dead = [os.path.join(directory, filename) for filename in os.listdir(directory)
+                if worker_file_pid(filename) is not None and not pid_alive(worker_file_pid(filename))]
+        if not dead:
+            return
+        retired_path = os.path.join(directory, "retired.json")
+        totals = ({}, {}, {})
+        for path in [retired_path] + dead:
+            snapshot = read_snapshot(path)
+            if snapshot is not None:
+                merge_snapshot(totals, snapshot)
+        write_snapshot(retired_path, snapshot_dict(*totals))
+        for path in dead:
+            os.remove(path)
+
+    def merged(self):
+        """Sum the snapshots of every worker of this server, live and retired."""
+        self.flush(force=True)
+        directory = self.directory()
+        totals = ({}, {}, {})
+        with open(os.path.join(directory, ".lock"), "a") as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            self.retire_dead_workers(directory)
+            fcntl.flock(lock, fcntl.LOCK_SH)
+            for filename in sorted(os.listdir(directory)):
+                if filename.endswith(".json"):
+                    snapshot = read_snapshot(os.path.join(directory, filename))
+                    if snapshot is not None:
+                        merge_snapshot(totals, snapshot)
+        return totals
+
+    def prune_stale_runs(self):
+        """Remove the directories of earlier runs whose minting process has exited."""
+        current = metrics_run_id()
+        try:
+            names = os.listdir(METRICS_DIR)
+        except FileNotFoundError:
+            return
+        for name in names:
+            pid = name.rsplit("-", 1)[-1]
+            path = os.path.join(METRICS_DIR, name)
+            if name != current and pid.isdigit() and not pid_alive(int(pid)) and os.path.isdir(path):
+                shutil.rmtree(path, ignore_errors=True)
+
+metrics = MetricsRegistry()
+
+@app.before_request
+def start_request_timer():
+    g._request_started = time.perf_counter()
+    g._query_count = 0
+
+@app.after_request
+def record_request_metrics(response):
+    started = g.get("_request_started")
+    if started is not None:
+        # streamed bodies (SSE, exports) are measured to the first byte
+        route = request.url_rule.rule if request.url_rule is not None else "unmatched"
+        labels = (("method", request.method), ("route", route), ("status", str(response.status_code)))
+        metrics.observe("http_request_duration_seconds", labels, time.perf_counter() - started)
+        metrics.observe("db_queries_per_request", labels[:2], g.get("_query_count", 0), QUERY_COUNT_BUCKETS)
+        metrics.flush()
+    return response
+
 @app.before_request
 def handle_preflight():
     if request.method == "OPTIONS":
@@ -37,49 +330,258 @@ def handle_preflight():
 # -------------------------------
 # Database helpers
 # -------------------------------
-def get_db():
-    """Return a SQLite connection for this request (cached on 'g')."""
-    db = getattr(g, "_database", None)
+def open_db_connection(readonly=False):
+    """Open a SQLite connection with the shared pragmas (WAL, synchronous, cache, mmap, busy timeout)."""
+    if readonly:
+        uri = pathlib.Path(DB_FILE).absolute().as_uri() + "?mode=ro"
+        conn = sqlite3.connect(uri, uri=True, timeout=SQLITE_BUSY_TIMEOUT_MS / 1000.0,
+                               detect_types=sqlite3.PARSE_DECLTYPES | sqlite3.PARSE_COLNAMES,
+                               check_same_thread=False)
+    else:
+        conn = sqlite3.connect(DB_FILE, timeout=SQLITE_BUSY_TIMEOUT_MS / 1000.0,
+                               detect_types=sqlite3.PARSE_DECLTYPES | sqlite3.PARSE_COLNAMES,
+                               check_same_thread=False)
+        conn.execute("PRAGMA journal_mode = WAL;")
+    conn.row_factory = sqlite3.Row
+    # Option B: keep foreign keys OFF to avoid constraint errors for deletes
+    conn.execute("PRAGMA foreign_keys = OFF;")
+    conn.execute(f"PRAGMA synchronous = {SQLITE_SYNCHRONOUS};")
+    conn.execute(f"PRAGMA cache_size = {SQLITE_CACHE_SIZE};")
+    conn.execute(f"PRAGMA mmap_size = {SQLITE_MMAP_SIZE};")
+    conn.execute(f"PRAGMA busy_timeout = {SQLITE_BUSY_TIMEOUT_MS};")
+    if readonly:
+        conn.execute("PRAGMA query_only = ON;")
+    return conn
+
+class ConnectionPool:
+    """Per-worker pool: one shared writer connection plus a stack of read-only connections.
+
+    In WAL mode readers never block the writer, so dashboard listings can run while
+    GPS ingest commits. The writer is held for one transaction at a time (see
+    write_transaction), never for the rest of a request.
+    """
+
+    def __init__(self, read_size):
+        self.read_size = max(1, read_size)
+        self._lock = threading.Lock()
+        self._writer_lock = threading.Lock()
+        self._reset()
+
+    def _reset(self):
+        self._pid = os.getpid()
+        self._readers = []
+        self._writer = None
+        self.stats = {"readers_created": 0, "readers_reused": 0, "readers_closed": 0,
+                      "readers_in_use": 0, "writer_acquired": 0, "writer_wait_ms": 0.0}
+
+    def _check_fork(self):
+        # connections must not cross a fork (gunicorn --preload)
+        if self._pid != os.getpid():
+            self._writer_lock = threading.Lock()
+            self._reset()
+
+    def acquire_reader(self):
+        with self._lock:
+            self._check_fork()
+            self.stats["readers_in_use"] += 1
+            if self._readers:
+                self.stats["readers_reused"] += 1
+                return self._readers.pop()
+            self.stats["readers_created"] += 1
+        return open_db_connection(readonly=True)
+
+    def release_reader(self, conn):
+        with self._lock:
+            self.stats["readers_in_use"] -= 1
+            if self._pid == os.getpid() and len(self._readers) < self.read_size:
+                self._readers.append(conn)
+                return
+            self.stats["readers_closed"] += 1
+        conn.close()
+
+    def acquire_writer(self):
+        with self._lock:
+            self._check_fork()
+        start = time.perf_counter()
+        self._writer_lock.acquire()
+        waited = time.perf_counter() - start
+        metrics.observe("db_lock_wait_seconds", (("lock", "writer_pool"),), waited)
+        with self._lock:
+            self.stats["writer_acquired"] += 1
+            self.stats["writer_wait_ms"] += waited * 1000.0
+            if self._writer is None:
+                self._writer = open_db_connection()
+            return self._writer
+
+    def release_writer(self, conn):
+        if conn.in_transaction:
+            conn.rollback()
+        self._writer_lock.release()
+
+    def snapshot(self):
+        with self._lock:
+            return dict(self.stats, readers_idle=len(self._readers), read_pool_size=self.read_size,
+                        writer_open=self._writer is not None, writer_busy=self._writer_lock.locked())
+
+db_pool = ConnectionPool(SQLITE_READ_POOL_SIZE)
+
+_write_state = threading.local()
+
+@contextlib.contextmanager
+def write_transaction():
+    """Hold this worker's writer connection for one BEGIN IMMEDIATE ... COMMIT.
+
+    Rolls back if the block raises and releases the writer as soon as it ends. A
+    nested block joins the enclosing transaction, so several statements can commit
+    together.
+    """
+    conn = getattr(_write_state, "conn", None)
+    if conn is not None:
+        yield conn
+        return
+    conn = db_pool.acquire_writer()
+    _write_state.conn = conn
+    try:
+        begin_write(conn)
+        yield conn
+        conn.commit()
+    except BaseException:
+        if conn.in_transaction:
+            conn.rollback()
+        raise
+    finally:
+        _write_state.conn = None
+        db_pool.release_writer(conn)
+
+def get_read_db():
+    """Return this request's read-only connection (cached on 'g')."""
+    db = getattr(g, "_read_database", None)
     if db is None:
-        db = sqlite3.connect(DB_FILE, detect_types=sqlite3.PARSE_DECLTYPES | sqlite3.PARSE_COLNAMES)
-        db.row_factory = sqlite3.Row
-        # Option B: keep foreign keys OFF to avoid constraint errors for deletes
-        db.execute("PRAGMA foreign_keys = OFF;")
-        g._database = db
+        db = db_pool.acquire_reader()
+        g._read_database = db
     return db
 
 @app.teardown_appcontext
 def close_connection(exc):
-    db = getattr(g, "_database", None)
-    if db is not None:
-        db.close()
+    read_db = g.pop("_read_database", None)
+    if read_db is not None:
+        db_pool.release_reader(read_db)
+
+_slow_queries = collections.deque(maxlen=SLOW_QUERY_LOG_SIZE)
+
+def explain_plan(conn, sql, params=()):
+    """EXPLAIN QUERY PLAN detail lines for `sql`, or the error text if it cannot be planned."""
+    try:
+        return [row[3] for row in conn.execute("EXPLAIN QUERY PLAN " + sql, params or ())]
+    except sqlite3.Error as e:
+        return [f"error: {e}"]
+
+def plan_flags(plan):
+    """'full_scan' for a plain table SCAN, 'temp_btree' when SQLite sorts or groups in a temp B-tree."""
+    flags = []
+    for detail in plan:
+        if detail.startswith("SCAN ") and " USING " not in detail and "VIRTUAL TABLE" not in detail \
+                and "CONSTANT ROW" not in detail and "full_scan" not in flags:
+            flags.append("full_scan")
+        if "USE TEMP B-TREE" in detail and "temp_btree" not in flags:
+            flags.append("temp_btree")
+    return flags
+
+def log_slow_query(helper, conn, sql, params, elapsed):
+    text, query_id = sql_fingerprint(sql)
+    plan = explain_plan(conn, sql, params)
+    entry = {
+        "at": datetime.datetime.now(datetime.UTC).strftime("%Y-%m-%d %H:%M:%S"),
+        "helper": helper,
+        "duration_ms": round(elapsed * 1000.0, 2),
+        "query_id": query_id,
+        "sql": text,
+        # values are hashed, never logged
+        "params_fingerprint": hashlib.sha1(repr(tuple(params or ())).encode("utf-8")).hexdigest()[:12],
+        "param_count": len(params or ()),
+        "plan": plan,
+        "flags": plan_flags(plan),
+    }
+    _slow_queries.append(entry)
+    metrics.inc("db_slow_queries_total", (("helper", helper), ("query_id", query_id)))
+    app.logger.warning("slow query %s", json.dumps(entry))
+
+def record_query(helper, conn, sql, params, started, rows):
+    """Feed one helper call into the query metrics and, past SLOW_QUERY_MS, the slow-query log."""
+    elapsed = time.perf_counter() - started
+    text, query_id = sql_fingerprint(sql)
+    metrics.describe_statement(query_id, text)
+    labels = (("helper", helper), ("query_id", query_id))
+    metrics.observe("db_query_duration_seconds", labels, elapsed)
+    metrics.inc("db_query_rows_total", labels, max(rows, 0))
+    g._query_count = g.get("_query_count", 0) + 1
+    if SLOW_QUERY_MS > 0 and elapsed * 1000.0 >= SLOW_QUERY_MS:
+        log_slow_query(helper, conn, sql, params, elapsed)
+
+def begin_write(conn):
+    """Take the SQLite write lock before the statement so waiting for it is measured on its own."""
+    if conn.in_transaction:
+        return
+    started = time.perf_counter()
+    conn.execute("BEGIN IMMEDIATE")
+    metrics.observe("db_lock_wait_seconds", (("lock", "sqlite_write"),), time.perf_counter() - started)
 
 def query_fetchall(sql, params=()):
-    conn = get_db()
+    conn = get_read_db()
+    started = time.perf_counter()
     cur = conn.cursor()
     cur.execute(sql, params or ())
     rows = cur.fetchall()
     cur.close()
+    record_query("fetchall", conn, sql, params, started, len(rows))
     # convert sqlite3.Row -> dict
     return [dict(r) for r in rows]
 
 def query_fetchone(sql, params=()):
-    conn = get_db()
+    conn = get_read_db()
+    started = time.perf_counter()
     cur = conn.cursor()
     cur.execute(sql, params or ())
     row = cur.fetchone()
     cur.close()
+    record_query("fetchone", conn, sql, params, started, 1 if row else 0)
     return dict(row) if row else None
 
 def query_commit(sql, params=()):
-    conn = get_db()
-    cur = conn.cursor()
-    cur.execute(sql, params or ())
-    conn.commit()
-    last = cur.lastrowid
-    cur.close()
+    with write_transaction() as conn:
+        started = time.perf_counter()
+        cur = conn.cursor()
+        cur.execute(sql, params or ())
+        last = cur.lastrowid
+        count = cur.rowcount
+        cur.close()
+        record_query("commit", conn, sql, params, started, count)
     return last
 
+def query_commit_returning(sql, params=()):
+    """Run a write with a RETURNING clause and commit; returns the first returned row or None."""
+    with write_transaction() as conn:
+        started = time.perf_counter()
+        cur = conn.cursor()
+        cur.execute(sql, params or ())
+        row = cur.fetchone()
+        cur.fetchall()
+        cur.close()
+        record_query("commit", conn, sql, params, started, 1 if row else 0)
+    return dict(row) if row else None
+
+def query_commit_many(sql, seq_of_params):
+    """Run one prepared statement for every params tuple inside a single transaction."""
+    with write_transaction() as conn:
+        started = time.perf_counter()
+        cur = conn.cursor()
+        cur.executemany(sql, seq_of_params)
+        count = cur.rowcount
+        cur.close()
+        sample = seq_of_params[0] if isinstance(seq_of_params, (list, tuple)) and seq_of_params else ()
+        record_query("commit_many", conn, sql, sample, started, count)
+    return count
+
 # -------------------------------
 # JWT helpers
 # -------------------------------
@@ -92,23 +594,129 @@ def create_token(payload):
         token = token.decode("utf-8")
     return token
 
+class TokenCache:
+    """Bounded LRU of verified JWT claims keyed by the token's SHA-256 digest.
+
+    Devices send the same bearer token thousands of times a day; a hit skips the
+    HMAC check and JSON parsing. Entries are dropped once the token's `exp` passes,
+    so an expired token always falls through to jwt.decode and is rejected there.
+    token_required syncs the cache with the "token_cache" generation in
+    cache_generations at most every TOKEN_CACHE_GENERATION_TTL seconds, so a clear in
+    one worker empties all of them within that window without a query per request.
+    """
+
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self._entries = collections.OrderedDict()
+        self._lock = threading.Lock()
+        self.generation = None
+        self.checked_at = None
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def _key(token):
+        return hashlib.sha256(token.encode("utf-8")).digest()
+
+    def get(self, token):
+        if self.max_size <= 0:
+            return None
+        key = self._key(token)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or entry[0] <= time.time():
+                if entry is not None:
+                    del self._entries[key]
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return dict(entry[1])
+
+    def put(self, token, claims):
+        exp = claims.get("exp")
+        if self.max_size <= 0 or not isinstance(exp, (int, float)):
+            return
+        key = self._key(token)
+        with self._lock:
+            self._entries[key] = (exp, dict(claims))
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def needs_sync(self):
+        return self.checked_at is None or time.monotonic() - self.checked_at >= TOKEN_CACHE_GENERATION_TTL
+
+    def sync(self, generation):
+        """Drop every entry if the shared generation moved since the last check."""
+        with self._lock:
+            if generation != self.generation:
+                self._entries.clear()
+                self.generation = generation
+            self.checked_at = time.monotonic()
+
+    def snapshot(self):
+        with self._lock:
+            total = self.hits + self.misses
+            return {"size": len(self._entries), "max_size": self.max_size, "hits": self.hits,
+                    "misses": self.misses, "hit_ratio": (self.hits / total) if total else 0.0}
+
+token_cache = TokenCache(TOKEN_CACHE_SIZE)
+
 def decode_token(token):
+    cached = token_cache.get(token)
+    if cached is not None:
+        return cached
     try:
         data = jwt.decode(token, JWT_SECRET, algorithms=[JWT_ALGORITHM])
-        return data
     except jwt.ExpiredSignatureError:
         raise ValueError("Token expired")
     except jwt.InvalidTokenError:
         raise ValueError("Invalid token")
+    token_cache.put(token, data)
+    return data
+
+def stream_ticket_digest(ticket):
+    return hashlib.sha256(ticket.encode("utf-8")).hexdigest()
 
-def token_required(require_admin=False):
+def redeem_stream_ticket(ticket):
+    """Claims stored for a stream ticket, consuming it; None if unknown, used or expired."""
+    row = query_commit_returning("DELETE FROM stream_tickets WHERE ticket_hash=? RETURNING claims, expires_at",
+                                 (stream_ticket_digest(ticket),))
+    if row is None or row["expires_at"] <= time.time():
+        return None
+    return json.loads(row["claims"])
+
+def token_required(require_admin=False, allow_ticket=False):
     def decorator(f):
         @wraps(f)
         def wrapped(*args, **kwargs):
             auth = request.headers.get("Authorization", "")
+            # EventSource cannot send headers, so streaming endpoints take a single-use
+            # ?ticket= from POST /stream/tickets; a JWT never goes in the query string
+            if not auth.startswith("Bearer ") and allow_ticket and request.args.get("ticket"):
+                try:
+                    data = redeem_stream_ticket(request.args["ticket"])
+                except sqlite3.Error as e:
+                    return jsonify({"error": str(e)}), 500
+                if data is None:
+                    return jsonify({"error": "Invalid or expired stream ticket"}), 401
+                request.user = data
+                if require_admin and data.get("role") != "admin":
+                    return jsonify({"error": "Admin access required"}), 403
+                return f(*args, **kwargs)
             if not auth.startswith("Bearer "):
                 return jsonify({"error": "Authorization header missing or invalid"}), 401
             token = auth.split(" ", 1)[1]
+            if token_cache.max_size > 0 and token_cache.needs_sync():
+                try:
+                    token_cache.sync(current_generation("token_cache"))
+                except sqlite3.Error as e:
+                    return jsonify({"error": str(e)}), 500
             try:
                 data = decode_token(token)
             except ValueError as e:
@@ -124,9 +732,131 @@ def token_required(require_admin=False):
         return wrapped
     return decorator
 
+# -------------------------------
+# Password hashing
+# -------------------------------
+class PasswordHasher:
+    """Runs Werkzeug's deliberately slow KDF in a bounded per-worker process pool.
+
+    Hashing outside the request thread (and outside the GIL) keeps a login burst
+    from starving GPS ingest. At most `max_pending` calls may be queued or running;
+    beyond that callers wait up to `wait_s` and then get QueueFullError (503).
+    With `workers` = 0 hashing runs inline on the request thread. Pool processes come
+    from a forkserver (spawn where that is unavailable), never a fork of this
+    multi-threaded worker, whose other threads may hold locks at fork time.
+    """
+
+    def __init__(self, method, workers, max_pending, wait_s):
+        self.method = method
+        self.workers = workers
+        self.max_pending = max(1, max_pending)
+        self.wait_s = wait_s
+        self._lock = threading.Lock()
+        self._pid = None
+        self._pool = None
+        self._slots = None
+        self._prefix = None
+        self.stats = {"pending": 0, "completed": 0, "rejected": 0, "rehashed": 0, "total_ms": 0.0}
+
+    def _ensure(self):
+        with self._lock:
+            if self._pid != os.getpid():
+                # a forked worker must not reuse its parent's pool
+                self._pid = os.getpid()
+                self._pool = None
+                self._slots = threading.BoundedSemaphore(self.max_pending)
+            if self._pool is None and self.workers > 0:
+                method = "forkserver" if "forkserver" in multiprocessing.get_all_start_methods() else "spawn"
+                self._pool = concurrent.futures.ProcessPoolExecutor(
+                    max_workers=self.workers, mp_context=multiprocessing.get_context(method))
+            return self._pool
+
+    def _run(self, fn, *args):
+        pool = self._ensure()
+        if not self._slots.acquire(timeout=self.wait_s):
+            with self._lock:
+                self.stats["rejected"] += 1
+            raise QueueFullError("Password hashing is busy, retry shortly")
+        start = time.perf_counter()
+        with self._lock:
+            self.stats["pending"] += 1
+        try:
+            if pool is None:
+                return fn(*args)
+            try:
+                return pool.submit(fn, *args).result()
+            except concurrent.futures.process.BrokenProcessPool:
+                with self._lock:
+                    self._pool = None
+                return fn(*args)
+        finally:
+            self._slots.release()
+            with self._lock:
+                self.stats["pending"] -= 1
+                self.stats["completed"] += 1
+                self.stats["total_ms"] += (time.perf_counter() - start) * 1000.0
+
+    def hash(self, password):
+        return self._run(generate_password_hash, password, self.method)
+
+    def verify(self, password_hash, password):
+        return self._run(check_password_hash, password_hash, password)
+
+    def needs_rehash(self, password_hash):
+        """True when a stored hash was made with a different method or cost than configured."""
+        if self._prefix is None:
+            # Werkzeug fills in default parameters, so learn the canonical prefix once
+            self._prefix = generate_password_hash("probe", self.method).split("$", 1)[0]
+        return password_hash.split("$", 1)[0] != self._prefix
+
+    def record_rehash(self):
+        with self._lock:
+            self.stats["rehashed"] += 1
+
+    def snapshot(self):
+        with self._lock:
+            done = self.stats["completed"]
+            return {"method": self.method, "workers": self.workers, "max_pending": self.max_pending,
+                    "pending": self.stats["pending"],
+                    "queued": max(0, self.stats["pending"] - max(self.workers, 1)),
+                    "completed": done, "rejected": self.stats["rejected"],
+                    "rehashed": self.stats["rehashed"],
+                    "avg_ms": (self.stats["total_ms"] / done) if done else 0.0}
+
+password_hasher = PasswordHasher(PASSWORD_HASH_METHOD, HASH_POOL_WORKERS, HASH_POOL_MAX_PENDING,
+                                 HASH_POOL_WAIT_S)
+
+def hash_password(password):
+    return password_hasher.hash(password)
+
+def verify_password(password_hash, password):
+    return password_hasher.verify(password_hash, password)
+
+def rehash_if_needed(table, id_column, row_id, password_hash, password):
+    """Upgrade a stored hash to the configured method/cost after a successful login."""
+    if not password_hasher.needs_rehash(password_hash):
+        return
+    try:
+        query_commit(f"UPDATE {table} SET password_hash=? WHERE {id_column}=?",
+                     (hash_password(password), row_id))
+        password_hasher.record_rehash()
+    except (QueueFullError, sqlite3.Error):
+        # the login already succeeded; try again on the next one
+        app.logger.warning("Password rehash skipped for %s %s", table, row_id)
+
 # -------------------------------
 # Utilities
 # -------------------------------
+class QueueFullError(Exception):
+    """A bounded in-process queue (GPS ingest, password hashing) has no room."""
+    pass
+
+@app.errorhandler(QueueFullError)
+def queue_full_response(e):
+    response = jsonify({"error": str(e)})
+    response.headers["Retry-After"] = "1"
+    return response, 503
+
 def parse_pagination():
     try:
         page = int(request.args.get("page", 1))
@@ -135,15 +865,104 @@ def parse_pagination():
         if per_page < 1: per_page = 50
     except ValueError:
         page, per_page = 1, 50
+    per_page = min(per_page, MAX_PER_PAGE)
     offset = (page - 1) * per_page
     return offset, per_page
 
+def encode_cursor(values):
+    raw = json.dumps(values, separators=(",", ":")).encode("utf-8")
+    return base64.urlsafe_b64encode(raw).decode("ascii").rstrip("=")
+
+def decode_cursor(cursor, size):
+    try:
+        raw = base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4))
+        values = json.loads(raw)
+    except (ValueError, TypeError):
+        raise ValueError("Invalid cursor")
+    if not isinstance(values, list) or len(values) != size:
+        raise ValueError("Invalid cursor")
+    # only flat scalars may be bound; nested lists or objects would reach sqlite3
+    if not all(isinstance(v, (str, int, float)) and not isinstance(v, bool) for v in values):
+        raise ValueError("Invalid cursor")
+    return tuple(values)
+
+def cursor_page(sql, key_columns, key_fields, where=None, params=()):
+    """Fetch one keyset page, newest first, for `?cursor=` requests.
+
+    `sql` must contain `{where}` and `{order}` placeholders. `key_columns` are the SQL
+    columns the page is ordered by (most significant first, the last one unique) and
+    `key_fields` the matching keys in the returned rows. Raises ValueError for a
+    malformed cursor.
+    """
+    try:
+        per_page = int(request.args.get("per_page", 50))
+    except ValueError:
+        per_page = 50
+    if per_page < 1:
+        per_page = 50
+    per_page = min(per_page, MAX_PER_PAGE)
+
+    clauses = [where] if where else []
+    params = tuple(params)
+    cursor = request.args.get("cursor", "")
+    if cursor:
+        clauses.append(f"({', '.join(key_columns)}) < ({', '.join('?' * len(key_columns))})")
+        params += decode_cursor(cursor, len(key_columns))
+    sql = sql.format(where=("WHERE " + " AND ".join(clauses)) if clauses else "",
+                     order=", ".join(f"{c} DESC" for c in key_columns))
+    rows = query_fetchall(sql + " LIMIT ?", params + (per_page + 1,))
+    next_cursor = None
+    if len(rows) > per_page:
+        rows = rows[:per_page]
+        next_cursor = encode_cursor([rows[-1][f] for f in key_fields])
+    return {"items": rows, "next_cursor": next_cursor}
+
 def require_fields(data, fields):
     missing = [f for f in fields if not (data.get(f) or (data.get(f) == 0))]
     if missing:
         return False, f"Missing fields: {', '.join(missing)}"
     return True, ""
 
+def parse_coordinates(data):
+    """Return (latitude, longitude) as floats, rejecting non-numeric or out-of-range values."""
+    try:
+        lat = float(data.get('latitude'))
+        lon = float(data.get('longitude'))
+    except (TypeError, ValueError):
+        raise ValueError("latitude and longitude must be numbers")
+    if not (-90.0 <= lat <= 90.0) or not (-180.0 <= lon <= 180.0):
+        raise ValueError("Coordinates out of range")
+    return lat, lon
+
+def parse_optional_coordinates(data):
+    """Like parse_coordinates, but (None, None) when neither field is present."""
+    if data.get('latitude') in (None, "") and data.get('longitude') in (None, ""):
+        return None, None
+    return parse_coordinates(data)
+
+def parse_timestamp(value):
+    """Normalise an ISO-8601 string or epoch seconds to SQLite's 'YYYY-MM-DD HH:MM:SS' (UTC)."""
+    if value is None or value == "":
+        return None
+    if isinstance(value, bool):
+        raise ValueError("Invalid timestamp")
+    if isinstance(value, str) and value.replace(".", "", 1).isdigit():
+        # epoch seconds sent as text, e.g. from a query string
+        value = float(value)
+    if isinstance(value, (int, float)):
+        try:
+            dt = datetime.datetime.fromtimestamp(value, datetime.UTC)
+        except (OverflowError, OSError, ValueError):
+            raise ValueError("Invalid timestamp")
+    else:
+        try:
+            dt = datetime.datetime.fromisoformat(str(value).replace("Z", "+00:00"))
+        except ValueError:
+            raise ValueError("Invalid timestamp")
+        if dt.tzinfo is not None:
+            dt = dt.astimezone(datetime.UTC)
+    return dt.strftime("%Y-%m-%d %H:%M:%S")
+
 # -------------------------------
 # Initialize DB schema + seed (runs once if DB missing)
 # -------------------------------
@@ -240,6 +1059,463 @@ SELECT 'Visitor' WHERE NOT EXISTS (SELECT 1 FROM user_categories WHERE category_
 -- admin: password 'admin123' (hashed below if not present)
 """
 
+# -------------------------------
+# Schema migrations
+# -------------------------------
+# SCHEMA_SQL is the original (version 0) layout. Every later change is appended here
+# and applied once per database, tracked with PRAGMA user_version. Steps are SQL
+# statements or callables taking the connection; each migration runs in its own
+# transaction and must be safe to run on a database that partly has it already.
+NUMERIC_TEXT = re.compile(r"[+-]?(?:\d+(?:\.\d*)?|\.\d+)(?:[eE][+-]?\d+)?")
+
+def numeric_coordinate(value, limit):
+    """`value` as a float if it is a finite number (or numeric text) within +/-limit, else None."""
+    if isinstance(value, str):
+        value = value.strip()
+        if not NUMERIC_TEXT.fullmatch(value):
+            return None
+    elif not isinstance(value, (int, float)):
+        return None
+    number = float(value)
+    if not math.isfinite(number) or abs(number) > limit:
+        return None
+    return number
+
+def log_quarantined_coordinates(conn):
+    count = conn.execute("SELECT COUNT(*) FROM gps_locations_quarantine").fetchone()[0]
+    if count:
+        app.logger.warning("%d GPS points with invalid coordinates moved to gps_locations_quarantine", count)
+
+MIGRATIONS = [
+    (1, "vehicle_latest_position", [
+        """
+        CREATE TABLE IF NOT EXISTS vehicle_latest_position (
+            vehicle_id INTEGER PRIMARY KEY,
+            latitude TEXT NOT NULL,
+            longitude TEXT NOT NULL,
+            timestamp DATETIME NOT NULL
+        )
+        """,
+        """
+        INSERT OR IGNORE INTO vehicle_latest_position (vehicle_id, latitude, longitude, timestamp)
+        SELECT vehicle_id, latitude, longitude, COALESCE(timestamp, CURRENT_TIMESTAMP)
+        FROM gps_locations
+        WHERE location_id IN (SELECT MAX(location_id) FROM gps_locations GROUP BY vehicle_id)
+        """,
+    ]),
+    (2, "indexes for hot queries and cascade deletes", [
+        "CREATE INDEX IF NOT EXISTS idx_gps_locations_vehicle_ts ON gps_locations(vehicle_id, timestamp)",
+        "CREATE INDEX IF NOT EXISTS idx_gps_locations_ts ON gps_locations(timestamp)",
+        "CREATE INDEX IF NOT EXISTS idx_access_logs_ts ON access_logs(timestamp)",
+        "CREATE INDEX IF NOT EXISTS idx_access_logs_user ON access_logs(user_id)",
+        "CREATE INDEX IF NOT EXISTS idx_access_logs_card ON access_logs(card_id)",
+        "CREATE INDEX IF NOT EXISTS idx_cards_user ON cards(user_id)",
+        "CREATE INDEX IF NOT EXISTS idx_cards_uid ON cards(card_uid)",
+        "CREATE INDEX IF NOT EXISTS idx_route_stops_route ON route_stops(route_id, stop_number)",
+        "CREATE INDEX IF NOT EXISTS idx_vehicles_route ON vehicles(route_id)",
+    ]),
+    # coordinates were TEXT; rebuild both position tables with REAL columns
+    # text that is not a number in range would CAST to 0.0 (Null Island); such points
+    # go to gps_locations_quarantine as they were, and are logged
+    (3, "numeric coordinates", [
+        lambda conn: conn.create_function("numeric_coordinate", 2, numeric_coordinate, deterministic=True),
+        """
+        CREATE TABLE IF NOT EXISTS gps_locations_quarantine (
+            location_id INTEGER PRIMARY KEY,
+            vehicle_id INTEGER,
+            latitude TEXT,
+            longitude TEXT,
+            timestamp DATETIME,
+            quarantined_at DATETIME DEFAULT CURRENT_TIMESTAMP
+        )
+        """,
+        """
+        INSERT OR IGNORE INTO gps_locations_quarantine (location_id, vehicle_id, latitude, longitude, timestamp)
+        SELECT location_id, vehicle_id, latitude, longitude, timestamp
+        FROM gps_locations
+        WHERE numeric_coordinate(latitude, 90) IS NULL OR numeric_coordinate(longitude, 180) IS NULL
+        """,
+        """
+        CREATE TABLE gps_locations_new (
+            location_id INTEGER PRIMARY KEY AUTOINCREMENT,
+            vehicle_id INTEGER,
+            latitude REAL NOT NULL,
+            longitude REAL NOT NULL,
+            timestamp DATETIME DEFAULT CURRENT_TIMESTAMP
+        )
+        """,
+        """
+        INSERT INTO gps_locations_new (location_id, vehicle_id, latitude, longitude, timestamp)
+        SELECT location_id, vehicle_id, numeric_coordinate(latitude, 90), numeric_coordinate(longitude, 180), timestamp
+        FROM gps_locations
+        WHERE numeric_coordinate(latitude, 90) IS NOT NULL AND numeric_coordinate(longitude, 180) IS NOT NULL
+        """,
+        "DROP TABLE gps_locations",
+        "ALTER TABLE gps_locations_new RENAME TO gps_locations",
+        "CREATE INDEX IF NOT EXISTS idx_gps_locations_vehicle_ts ON gps_locations(vehicle_id, timestamp)",
+        "CREATE INDEX IF NOT EXISTS idx_gps_locations_ts ON gps_locations(timestamp)",
+        """
+        CREATE TABLE vehicle_latest_position_new (
+            vehicle_id INTEGER PRIMARY KEY,
+            latitude REAL NOT NULL,
+            longitude REAL NOT NULL,
+            timestamp DATETIME NOT NULL
+        )
+        """,
+        """
+        INSERT INTO vehicle_latest_position_new (vehicle_id, latitude, longitude, timestamp)
+        SELECT vehicle_id, numeric_coordinate(latitude, 90), numeric_coordinate(longitude, 180), timestamp
+        FROM vehicle_latest_position
+        WHERE numeric_coordinate(latitude, 90) IS NOT NULL AND numeric_coordinate(longitude, 180) IS NOT NULL
+        """,
+        # a vehicle whose latest position was invalid falls back to its latest valid point
+        """
+        INSERT OR IGNORE INTO vehicle_latest_position_new (vehicle_id, latitude, longitude, timestamp)
+        SELECT vehicle_id, latitude, longitude, COALESCE(timestamp, CURRENT_TIMESTAMP)
+        FROM gps_locations
+        WHERE vehicle_id IN (SELECT vehicle_id FROM vehicle_latest_position)
+          AND location_id IN (SELECT MAX(location_id) FROM gps_locations GROUP BY vehicle_id)
+        """,
+        "DROP TABLE vehicle_latest_position",
+        "ALTER TABLE vehicle_latest_position_new RENAME TO vehicle_latest_position",
+        log_quarantined_coordinates,
+    ]),
+    (4, "gps_rollups", [
+        """
+        CREATE TABLE IF NOT EXISTS gps_rollups (
+            vehicle_id INTEGER NOT NULL,
+            bucket DATETIME NOT NULL,
+            point_count INTEGER NOT NULL,
+            latitude REAL NOT NULL,
+            longitude REAL NOT NULL,
+            min_lat REAL NOT NULL,
+            max_lat REAL NOT NULL,
+            min_lon REAL NOT NULL,
+            max_lon REAL NOT NULL,
+            distance_m REAL NOT NULL DEFAULT 0,
+            first_ts DATETIME NOT NULL,
+            last_ts DATETIME NOT NULL,
+            PRIMARY KEY (vehicle_id, bucket)
+        ) WITHOUT ROWID
+        """,
+    ]),
+    (5, "cache_generations", [
+        """
+        CREATE TABLE IF NOT EXISTS cache_generations (
+            name TEXT PRIMARY KEY,
+            generation INTEGER NOT NULL DEFAULT 0
+        )
+        """,
+    ]),
+    (6, "stop coordinates and spatial indexes", [
+        lambda conn: add_column_if_missing(conn, "route_stops", "latitude", "REAL"),
+        lambda conn: add_column_if_missing(conn, "route_stops", "longitude", "REAL"),
+        "CREATE VIRTUAL TABLE IF NOT EXISTS vehicle_position_rtree USING rtree(vehicle_id, min_lat, max_lat, min_lon, max_lon)",
+        "CREATE VIRTUAL TABLE IF NOT EXISTS stop_rtree USING rtree(stop_id, min_lat, max_lat, min_lon, max_lon)",
+        # delete then insert rather than OR REPLACE: the UPSERT on vehicle_latest_position
+        # carries its own conflict clause, which overrides any OR REPLACE inside a trigger
+        """
+        CREATE TRIGGER IF NOT EXISTS trg_vlp_rtree_insert AFTER INSERT ON vehicle_latest_position BEGIN
+            DELETE FROM vehicle_position_rtree WHERE vehicle_id = NEW.vehicle_id;
+            INSERT INTO vehicle_position_rtree
+            VALUES (NEW.vehicle_id, NEW.latitude, NEW.latitude, NEW.longitude, NEW.longitude);
+        END
+        """,
+        """
+        CREATE TRIGGER IF NOT EXISTS trg_vlp_rtree_update AFTER UPDATE ON vehicle_latest_position BEGIN
+            DELETE FROM vehicle_position_rtree WHERE vehicle_id = OLD.vehicle_id;
+            INSERT INTO vehicle_position_rtree
+            VALUES (NEW.vehicle_id, NEW.latitude, NEW.latitude, NEW.longitude, NEW.longitude);
+        END
+        """,
+        """
+        CREATE TRIGGER IF NOT EXISTS trg_vlp_rtree_delete AFTER DELETE ON vehicle_latest_position BEGIN
+            DELETE FROM vehicle_position_rtree WHERE vehicle_id = OLD.vehicle_id;
+        END
+        """,
+        """
+        CREATE TRIGGER IF NOT EXISTS trg_stop_rtree_insert AFTER INSERT ON route_stops
+        WHEN NEW.latitude IS NOT NULL AND NEW.longitude IS NOT NULL BEGIN
+            DELETE FROM stop_rtree WHERE stop_id = NEW.stop_id;
+            INSERT INTO stop_rtree
+            VALUES (NEW.stop_id, NEW.latitude, NEW.latitude, NEW.longitude, NEW.longitude);
+        END
+        """,
+        """
+        CREATE TRIGGER IF NOT EXISTS trg_stop_rtree_update AFTER UPDATE OF latitude, longitude ON route_stops BEGIN
+            DELETE FROM stop_rtree WHERE stop_id = OLD.stop_id;
+            INSERT INTO stop_rtree
+            SELECT NEW.stop_id, NEW.latitude, NEW.latitude, NEW.longitude, NEW.longitude
+            WHERE NEW.latitude IS NOT NULL AND NEW.longitude IS NOT NULL;
+        END
+        """,
+        """
+        CREATE TRIGGER IF NOT EXISTS trg_stop_rtree_delete AFTER DELETE ON route_stops BEGIN
+            DELETE FROM stop_rtree WHERE stop_id = OLD.stop_id;
+        END
+        """,
+        """
+        INSERT OR REPLACE INTO vehicle_position_rtree
+        SELECT vehicle_id, latitude, latitude, longitude, longitude FROM vehicle_latest_position
+        """,
+        """
+        INSERT OR REPLACE INTO stop_rtree
+        SELECT stop_id, latitude, latitude, longitude, longitude FROM route_stops
+        WHERE latitude IS NOT NULL AND longitude IS NOT NULL
+        """,
+    ]),
+    (7, "segment_travel_times", [
+        """
+        CREATE TABLE IF NOT EXISTS segment_travel_times (
+            route_id INTEGER NOT NULL,
+            from_stop_id INTEGER NOT NULL,
+            to_stop_id INTEGER NOT NULL,
+            hour INTEGER NOT NULL,
+            avg_seconds REAL NOT NULL,
+            samples INTEGER NOT NULL,
+            updated_at DATETIME DEFAULT CURRENT_TIMESTAMP,
+            PRIMARY KEY (route_id, from_stop_id, hour)
+        ) WITHOUT ROWID
+        """,
+    ]),
+    (8, "access change log", [
+        lambda conn: add_column_if_missing(conn, "access_logs", "area", "TEXT"),
+        lambda conn: add_column_if_missing(conn, "access_logs", "granted", "INTEGER"),
+        """
+        CREATE TABLE IF NOT EXISTS access_changes (
+            change_id INTEGER PRIMARY KEY AUTOINCREMENT,
+            entity TEXT NOT NULL,
+            entity_key TEXT NOT NULL,
+            changed_at DATETIME DEFAULT CURRENT_TIMESTAMP
+        )
+        """,
+        """
+        CREATE TRIGGER IF NOT EXISTS trg_cards_access_insert AFTER INSERT ON cards BEGIN
+            INSERT INTO access_changes(entity, entity_key) VALUES ('card', NEW.card_uid);
+        END
+        """,
+        """
+        CREATE TRIGGER IF NOT EXISTS trg_cards_access_update AFTER UPDATE ON cards BEGIN
+            INSERT INTO access_changes(entity, entity_key) VALUES ('card', OLD.card_uid);
+            INSERT INTO access_changes(entity, entity_key)
+            SELECT 'card', NEW.card_uid WHERE NEW.card_uid IS NOT OLD.card_uid;
+        END
+        """,
+        """
+        CREATE TRIGGER IF NOT EXISTS trg_cards_access_delete AFTER DELETE ON cards BEGIN
+            INSERT INTO access_changes(entity, entity_key) VALUES ('card', OLD.card_uid);
+        END
+        """,
+        """
+        CREATE TRIGGER IF NOT EXISTS trg_users_access_insert AFTER INSERT ON users BEGIN
+            INSERT INTO access_changes(entity, entity_key) VALUES ('user', NEW.user_id);
+        END
+        """,
+        """
+        CREATE TRIGGER IF NOT EXISTS trg_users_access_update AFTER UPDATE OF category_id ON users
+        WHEN NEW.category_id IS NOT OLD.category_id BEGIN
+            INSERT INTO access_changes(entity, entity_key) VALUES ('user', NEW.user_id);
+        END
+        """,
+        """
+        CREATE TRIGGER IF NOT EXISTS trg_users_access_delete AFTER DELETE ON users BEGIN
+            INSERT INTO access_changes(entity, entity_key) VALUES ('user', OLD.user_id);
+        END
+        """,
+        """
+        CREATE TRIGGER IF NOT EXISTS trg_permissions_access_insert AFTER INSERT ON access_permissions BEGIN
+            INSERT INTO access_changes(entity, entity_key) VALUES ('category', NEW.category_id);
+        END
+        """,
+        """
+        CREATE TRIGGER IF NOT EXISTS trg_permissions_access_update AFTER UPDATE ON access_permissions BEGIN
+            INSERT INTO access_changes(entity, entity_key) VALUES ('category', OLD.category_id);
+            INSERT INTO access_changes(entity, entity_key)
+            SELECT 'category', NEW.category_id WHERE NEW.category_id IS NOT OLD.category_id;
+        END
+        """,
+        """
+        CREATE TRIGGER IF NOT EXISTS trg_permissions_access_delete AFTER DELETE ON access_permissions BEGIN
+            INSERT INTO access_changes(entity, entity_key) VALUES ('category', OLD.category_id);
+        END
+        """,
+        "CREATE INDEX IF NOT EXISTS idx_access_permissions_category ON access_permissions(category_id)",
+    ]),
+    # stable bit per area for the offline reader snapshot; bits are never reused
+    (9, "access area bits", [
+        """
+        CREATE TABLE IF NOT EXISTS access_areas (
+            area TEXT PRIMARY KEY,
+            bit INTEGER NOT NULL UNIQUE
+        )
+        """,
+        """
+        INSERT OR IGNORE INTO access_areas(area, bit)
+        SELECT allowed_area, ROW_NUMBER() OVER (ORDER BY MIN(permission_id)) - 1
+        FROM access_permissions GROUP BY allowed_area
+        """,
+        """
+        CREATE TRIGGER IF NOT EXISTS trg_permissions_area_insert AFTER INSERT ON access_permissions BEGIN
+            INSERT OR IGNORE INTO access_areas(area, bit)
+            VALUES (NEW.allowed_area, (SELECT COALESCE(MAX(bit) + 1, 0) FROM access_areas));
+        END
+        """,
+        """
+        CREATE TRIGGER IF NOT EXISTS trg_permissions_area_update AFTER UPDATE OF allowed_area ON access_permissions BEGIN
+            INSERT OR IGNORE INTO access_areas(area, bit)
+            VALUES (NEW.allowed_area, (SELECT COALESCE(MAX(bit) + 1, 0) FROM access_areas));
+        END
+        """,
+    ]),
+    # per-hour tap counters and per-day distinct users, kept in step by triggers
+    (10, "access analytics counters", [
+        """
+        CREATE TABLE IF NOT EXISTS access_hourly_counts (
+            hour TEXT NOT NULL,
+            action_type TEXT NOT NULL,
+            area TEXT NOT NULL,
+            category_id INTEGER NOT NULL,
+            taps INTEGER NOT NULL,
+            denied INTEGER NOT NULL,
+            PRIMARY KEY (hour, action_type, area, category_id)
+        ) WITHOUT ROWID
+        """,
+        """
+        CREATE TABLE IF NOT EXISTS access_daily_users (
+            day TEXT NOT NULL,
+            user_id INTEGER NOT NULL,
+            PRIMARY KEY (day, user_id)
+        ) WITHOUT ROWID
+        """,
+        """
+        CREATE TRIGGER IF NOT EXISTS trg_access_logs_counts_insert AFTER INSERT ON access_logs BEGIN
+            INSERT INTO access_hourly_counts(hour, action_type, area, category_id, taps, denied)
+            VALUES (strftime('%Y-%m-%d %H:00:00', NEW.timestamp), NEW.action_type, COALESCE(NEW.area, ''),
+                    COALESCE((SELECT category_id FROM users WHERE user_id = NEW.user_id), 0), 1, NEW.granted IS 0)
+            ON CONFLICT(hour, action_type, area, category_id)
+            DO UPDATE SET taps = taps + 1, denied = denied + excluded.denied;
+            INSERT INTO access_daily_users(day, user_id)
+            SELECT date(NEW.timestamp), NEW.user_id WHERE NEW.user_id IS NOT NULL
+            ON CONFLICT(day, user_id) DO NOTHING;
+        END
+        """,
+        # the category is looked up again on delete; a user whose category changed in
+        # between leaves a drift that the backfill job repairs
+        """
+        CREATE TRIGGER IF NOT EXISTS trg_access_logs_counts_delete AFTER DELETE ON access_logs BEGIN
+            UPDATE access_hourly_counts SET taps = taps - 1, denied = denied - (OLD.granted IS 0)
+            WHERE hour = strftime('%Y-%m-%d %H:00:00', OLD.timestamp) AND action_type = OLD.action_type
+              AND area = COALESCE(OLD.area, '')
+              AND category_id = COALESCE((SELECT category_id FROM users WHERE user_id = OLD.user_id), 0);
+            DELETE FROM access_hourly_counts
+            WHERE hour = strftime('%Y-%m-%d %H:00:00', OLD.timestamp) AND taps <= 0;
+            DELETE FROM access_daily_users
+            WHERE day = date(OLD.timestamp) AND user_id = OLD.user_id
+              AND NOT EXISTS (SELECT 1 FROM access_logs WHERE user_id = OLD.user_id
+                              AND timestamp >= date(OLD.timestamp) AND timestamp < date(OLD.timestamp, '+1 day'));
+        END
+        """,
+        """
+        INSERT OR IGNORE INTO access_hourly_counts(hour, action_type, area, category_id, taps, denied)
+        SELECT strftime('%Y-%m-%d %H:00:00', access_logs.timestamp), access_logs.action_type,
+               COALESCE(access_logs.area, ''), COALESCE(users.category_id, 0),
+               COUNT(*), SUM(access_logs.granted IS 0)
+        FROM access_logs LEFT JOIN users ON users.user_id = access_logs.user_id
+        GROUP BY 1, 2, 3, 4
+        """,
+        """
+        INSERT OR IGNORE INTO access_daily_users(day, user_id)
+        SELECT DISTINCT date(timestamp), user_id FROM access_logs WHERE user_id IS NOT NULL
+        """,
+    ]),
+    (11, "vehicle occupancy", [
+        lambda conn: add_column_if_missing(conn, "access_logs", "vehicle_id", "INTEGER"),
+        """
+        CREATE TABLE IF NOT EXISTS vehicle_occupancy (
+            vehicle_id INTEGER PRIMARY KEY,
+            occupancy INTEGER NOT NULL,
+            log_id INTEGER NOT NULL,
+            generation INTEGER NOT NULL DEFAULT 0,
+            updated_at DATETIME DEFAULT CURRENT_TIMESTAMP
+        )
+        """,
+    ]),
+    (12, "import progress", [
+        """
+        CREATE TABLE IF NOT EXISTS import_progress (
+            source TEXT PRIMARY KEY,
+            kind TEXT NOT NULL,
+            records_done INTEGER NOT NULL,
+            finished INTEGER NOT NULL DEFAULT 0,
+            updated_at DATETIME DEFAULT CURRENT_TIMESTAMP
+        )
+        """,
+    ]),
+    # single-use tickets for opening the SSE stream; only the ticket's hash is stored
+    (13, "stream tickets", [
+        """
+        CREATE TABLE IF NOT EXISTS stream_tickets (
+            ticket_hash TEXT PRIMARY KEY,
+            claims TEXT NOT NULL,
+            expires_at INTEGER NOT NULL
+        )
+        """,
+    ]),
+    # one holder per background job across workers; the rollup's last point lets a
+    # retention run continue a vehicle's distance from where the previous run stopped
+    (14, "job leases", [
+        """
+        CREATE TABLE IF NOT EXISTS job_leases (
+            name TEXT PRIMARY KEY,
+            holder TEXT NOT NULL,
+            expires_at REAL NOT NULL
+        )
+        """,
+        lambda conn: add_column_if_missing(conn, "gps_rollups", "last_lat", "REAL"),
+        lambda conn: add_column_if_missing(conn, "gps_rollups", "last_lon", "REAL"),
+    ]),
+]
+
+SCHEMA_VERSION = MIGRATIONS[-1][0]
+
+def add_column_if_missing(conn, table, column, decl):
+    columns = [row[1] for row in conn.execute(f"PRAGMA table_info({table})")]
+    if column not in columns:
+        conn.execute(f"ALTER TABLE {table} ADD COLUMN {column} {decl}")
+
+def get_schema_version(conn):
+    return conn.execute("PRAGMA user_version").fetchone()[0]
+
+def apply_migrations(conn):
+    """Bring `conn`'s database up to SCHEMA_VERSION; returns the list of applied versions.
+
+    Each migration takes the write lock (BEGIN IMMEDIATE) and re-reads user_version
+    before running, so workers starting together apply it exactly once.
+    """
+    applied = []
+    conn.isolation_level = None
+    for version, name, steps in MIGRATIONS:
+        if get_schema_version(conn) >= version:
+            continue
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            if get_schema_version(conn) >= version:
+                conn.execute("COMMIT")
+                continue
+            for step in steps:
+                if callable(step):
+                    step(conn)
+                else:
+                    conn.execute(step)
+            conn.execute(f"PRAGMA user_version = {int(version)}")
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+        app.logger.info("Applied schema migration %d (%s)", version, name)
+        applied.append(version)
+    return applied
+
 def init_db():
     need_seed_admin = False
     if not os.path.exists(DB_FILE):
@@ -252,6 +1528,7 @@ def init_db():
         # admin insertion will be done in Python so hash is correct
         need_seed_admin = True
         conn.commit()
+        apply_migrations(conn)
         conn.close()
     else:
         # ensure schema exists (idempotent)
@@ -259,6 +1536,7 @@ def init_db():
         conn.executescript(SCHEMA_SQL)
         conn.executescript(SEED_SQL)
         conn.commit()
+        apply_migrations(conn)
         # check if admin exists
         cur = conn.cursor()
         cur.execute("SELECT 1 FROM admins LIMIT 1;")
@@ -268,15 +1546,21 @@ def init_db():
 
     if need_seed_admin:
         # create default admin and sample data
-        conn = sqlite3.connect(DB_FILE)
+        hashed = generate_password_hash("admin123", PASSWORD_HASH_METHOD)
+        conn = sqlite3.connect(DB_FILE, timeout=SQLITE_BUSY_TIMEOUT_MS / 1000.0)
+        conn.isolation_level = None
         cur = conn.cursor()
+        # another process may be seeding at the same moment: decide and insert under
+        # the write lock, so only one of them seeds
+        cur.execute("BEGIN IMMEDIATE")
+        cur.execute("SELECT 1 FROM admins LIMIT 1;")
+        if cur.fetchone() is not None:
+            cur.execute("COMMIT")
+            conn.close()
+            return
         # sample admin
-        hashed = generate_password_hash("admin123")
-        try:
-            cur.execute("INSERT OR IGNORE INTO admins (name, email, password_hash) VALUES (?, ?, ?)",
-                        ("Super Admin", "admin@smartgps.com", hashed))
-        except Exception:
-            pass
+        cur.execute("INSERT OR IGNORE INTO admins (name, email, password_hash) VALUES (?, ?, ?)",
+                    ("Super Admin", "admin@smartgps.com", hashed))
 
         # sample routes
         cur.execute("SELECT COUNT(1) FROM routes")
@@ -304,11 +1588,118 @@ def init_db():
                 ("BUS-202", "Akhtar Driver", 50, 2),
             ])
 
-        conn.commit()
+        cur.execute("COMMIT")
         conn.close()
 
-# run init on start
-init_db()
+# -------------------------------
+# Startup
+# -------------------------------
+# Importing this module touches no database. Schema and seed work runs once per
+# deployment: `flask init-db` (the Procfile release phase). The gunicorn master and
+# each worker process then only compare PRAGMA user_version with SCHEMA_VERSION.
+# DB_INIT_MODE: "check" (the default, for workers) refuses to start on a missing or
+# out-of-date database, "auto" runs init_db instead (local dev: `python app.py` uses
+# it), "off" skips the check.
+DB_INIT_MODE = os.getenv("DB_INIT_MODE", "check").lower()
+
+class SchemaOutOfDateError(RuntimeError):
+    pass
+
+def ensure_database(mode=None):
+    """Cheap schema check; returns "current", "initialized" or "skipped"."""
+    mode = (mode or DB_INIT_MODE).lower()
+    if mode == "off":
+        return "skipped"
+    version = None
+    if os.path.exists(DB_FILE):
+        conn = sqlite3.connect(DB_FILE, timeout=SQLITE_BUSY_TIMEOUT_MS / 1000.0)
+        try:
+            version = get_schema_version(conn)
+        finally:
+            conn.close()
+    if version is not None and version >= SCHEMA_VERSION:
+        return "current"
+    if mode == "check":
+        raise SchemaOutOfDateError(f"database schema is at version {version}, expected {SCHEMA_VERSION}; "
+                                   "run `flask init-db`")
+    init_db()
+    return "initialized"
+
+_startup = {"pid": None, "db": None}
+_startup_lock = threading.Lock()
+
+def startup(mode=None):
+    """Once per process: schema check (or init) and, with QUERY_PLAN_STRICT, the hot-plan check."""
+    with _startup_lock:
+        if _startup["pid"] == os.getpid():
+            return
+        _startup["db"] = ensure_database(mode)
+        metrics.prune_stale_runs()
+        if not ACCESS_SNAPSHOT_SALT:
+            app.logger.warning("ACCESS_SNAPSHOT_SALT is unset; /access/snapshot will refuse to serve")
+        if QUERY_PLAN_STRICT:
+            failures = check_hot_query_plans()
+            if failures:
+                raise QueryPlanError("hot query plans regressed: " + json.dumps(failures))
+        _startup["pid"] = os.getpid()
+
+@app.before_request
+def ensure_startup():
+    if _startup["pid"] != os.getpid():
+        startup()
+
+def create_app(init_mode=None):
+    """App factory for gunicorn ('app:create_app()') and tests; runs this process's startup eagerly."""
+    startup(init_mode)
+    return app
+
+@app.cli.command("init-db")
+def init_db_command():
+    """Create or migrate the schema and seed data; run once per deployment."""
+    init_db()
+    print(json.dumps({"schema_version": SCHEMA_VERSION}))
+
+# -------------------------------
+# Reference-data cache
+# -------------------------------
+# Categories, routes, stops and permissions rarely change. Each worker keeps the
+# serialized response per (table group, query) and reuses it while the group's
+# generation in cache_generations is unchanged. Writers bump the generation inside the
+# same write_transaction() as the data change, which invalidates the entry in every
+# gunicorn worker exactly when the change becomes visible.
+_reference_cache = {}
+
+def current_generation(name):
+    row = query_fetchone("SELECT generation FROM cache_generations WHERE name=?", (name,))
+    return row["generation"] if row else 0
+
+def bump_generation(*names):
+    """Advance each named generation; inside write_transaction() it commits with the caller's write."""
+    with write_transaction():
+        for name in names:
+            query_commit("""
+                INSERT INTO cache_generations(name, generation) VALUES(?, 1)
+                ON CONFLICT(name) DO UPDATE SET generation = generation + 1
+            """, (name,))
+
+def cached_json_response(name, key, loader):
+    """Serve `loader()` as JSON with a strong ETag, reusing the cached body while fresh.
+
+    The generation is read before loading, so a concurrent write can only make an
+    entry look older than it is, never newer.
+    """
+    generation = current_generation(name)
+    entry = _reference_cache.get((name, key))
+    if entry is None or entry[0] != generation:
+        body = app.json.dumps(loader()).encode("utf-8")
+        entry = (generation, body, hashlib.sha1(body).hexdigest())
+        if len(_reference_cache) >= REFERENCE_CACHE_MAX_ENTRIES:
+            _reference_cache.clear()
+        _reference_cache[(name, key)] = entry
+    response = Response(entry[1], mimetype="application/json")
+    response.set_etag(entry[2])
+    response.headers["Cache-Control"] = "no-cache"
+    return response.make_conditional(request)
 
 # -------------------------------
 # Routes: Categories
@@ -317,8 +1708,8 @@ init_db()
 def get_categories():
     offset, per_page = parse_pagination()
     try:
-        rows = query_fetchall("SELECT * FROM user_categories LIMIT ? OFFSET ?", (per_page, offset))
-        return jsonify(rows)
+        return cached_json_response("categories", (per_page, offset), lambda: query_fetchall(
+            "SELECT * FROM user_categories LIMIT ? OFFSET ?", (per_page, offset)))
     except sqlite3.Error as e:
         return jsonify({"error": str(e)}), 500
 
@@ -330,7 +1721,9 @@ def add_category():
     if not ok:
         return jsonify({"error": msg}), 400
     try:
-        query_commit("INSERT INTO user_categories(category_name) VALUES (?)", (data['category_name'],))
+        with write_transaction():
+            query_commit("INSERT INTO user_categories(category_name) VALUES (?)", (data['category_name'],))
+            bump_generation("categories")
         return jsonify({"message": "Category added"}), 201
     except sqlite3.Error as e:
         return jsonify({"error": str(e)}), 500
@@ -343,7 +1736,9 @@ def update_category(id):
     if not ok:
         return jsonify({"error": msg}), 400
     try:
-        query_commit("UPDATE user_categories SET category_name=? WHERE category_id=?", (data['category_name'], id))
+        with write_transaction():
+            query_commit("UPDATE user_categories SET category_name=? WHERE category_id=?", (data['category_name'], id))
+            bump_generation("categories")
         return jsonify({"message": "Category updated"})
     except sqlite3.Error as e:
         return jsonify({"error": str(e)}), 500
@@ -352,7 +1747,9 @@ def update_category(id):
 @token_required(require_admin=True)
 def delete_category(id):
     try:
-        query_commit("DELETE FROM user_categories WHERE category_id=?", (id,))
+        with write_transaction():
+            query_commit("DELETE FROM user_categories WHERE category_id=?", (id,))
+            bump_generation("categories")
         return jsonify({"message": "Category deleted"})
     except sqlite3.Error as e:
         return jsonify({"error": str(e)}), 500
@@ -368,7 +1765,7 @@ def user_register():
     if not ok:
         return jsonify({"error": msg}), 400
     try:
-        hashed = generate_password_hash(data['password'])
+        hashed = hash_password(data['password'])
         query_commit("""
             INSERT INTO users (name, email, phone, category_id, emergency_contact, fee_status, password_hash)
             VALUES (?, ?, ?, ?, ?, ?, ?)
@@ -390,8 +1787,9 @@ def user_login():
         user = query_fetchone("SELECT * FROM users WHERE email=?", (data['email'],))
         if not user or not user.get("password_hash"):
             return jsonify({"error": "Invalid email or password"}), 401
-        if not check_password_hash(user['password_hash'], data['password']):
+        if not verify_password(user['password_hash'], data['password']):
             return jsonify({"error": "Invalid email or password"}), 401
+        rehash_if_needed("users", "user_id", user['user_id'], user['password_hash'], data['password'])
 
         token = create_token({
             "user_id": user['user_id'],
@@ -445,7 +1843,7 @@ def update_user(id):
         if k in data:
             if k == 'password':
                 fields.append("password_hash=?")
-                params.append(generate_password_hash(data[k]))
+                params.append(hash_password(data[k]))
             else:
                 fields.append(f"{k}=?")
                 params.append(data[k])
@@ -519,7 +1917,7 @@ def update_user_profile():
             if key in data:
                 if key == "password":
                     fields.append("password_hash=?")
-                    params.append(generate_password_hash(data[key]))
+                    params.append(hash_password(data[key]))
                 else:
                     fields.append(f"{key}=?")
                     params.append(data[key])
@@ -543,6 +1941,9 @@ def update_user_profile():
     except sqlite3.IntegrityError:
         return jsonify({"error": "Email already exists"}), 400
 
+    except QueueFullError as e:
+        return queue_full_response(e)
+
     except Exception as e:
         return jsonify({"error": str(e)}), 500
 
@@ -701,17 +2102,11 @@ def get_user_vehicle():
         return jsonify({"error": "User access required"}), 403
     try:
         # Return the first vehicle with its latest GPS location
-        vehicle = query_fetchone("""
-            SELECT vehicles.vehicle_id, vehicles.vehicle_number, vehicles.driver_name, vehicles.route_id, routes.route_name,
-                   gps_locations.latitude, gps_locations.longitude
-            FROM vehicles
-            LEFT JOIN routes ON vehicles.route_id = routes.route_id
-            LEFT JOIN gps_locations ON vehicles.vehicle_id = gps_locations.vehicle_id
-            WHERE gps_locations.location_id = (
-                SELECT MAX(location_id) FROM gps_locations WHERE vehicle_id = vehicles.vehicle_id
-            ) OR gps_locations.vehicle_id IS NULL
-            LIMIT 1
-        """)
+        fleet = get_fleet_positions()
+        vehicle = None
+        if fleet:
+            vehicle = {k: fleet[0][k] for k in ("vehicle_id", "vehicle_number", "driver_name", "route_id",
+                                                "route_name", "latitude", "longitude")}
         if not vehicle:
             # Return default vehicle data instead of 404
             return jsonify({
@@ -733,8 +2128,8 @@ def get_user_vehicle():
 def get_routes():
     offset, per_page = parse_pagination()
     try:
-        rows = query_fetchall("SELECT * FROM routes LIMIT ? OFFSET ?", (per_page, offset))
-        return jsonify(rows)
+        return cached_json_response("routes", (per_page, offset), lambda: query_fetchall(
+            "SELECT * FROM routes LIMIT ? OFFSET ?", (per_page, offset)))
     except sqlite3.Error as e:
         return jsonify({"error": str(e)}), 500
 
@@ -746,8 +2141,10 @@ def add_route():
     if not ok:
         return jsonify({"error": msg}), 400
     try:
-        query_commit("INSERT INTO routes(route_name, start_point, end_point) VALUES(?, ?, ?)",
-                     (data['route_name'], data['start_point'], data['end_point']))
+        with write_transaction():
+            query_commit("INSERT INTO routes(route_name, start_point, end_point) VALUES(?, ?, ?)",
+                         (data['route_name'], data['start_point'], data['end_point']))
+            bump_generation("routes")
         return jsonify({"message": "Route added"}), 201
     except sqlite3.Error as e:
         return jsonify({"error": str(e)}), 500
@@ -760,8 +2157,11 @@ def update_route(id):
     if not ok:
         return jsonify({"error": msg}), 400
     try:
-        query_commit("UPDATE routes SET route_name=?, start_point=?, end_point=? WHERE route_id=?",
-                     (data['route_name'], data['start_point'], data['end_point'], id))
+        with write_transaction():
+            query_commit("UPDATE routes SET route_name=?, start_point=?, end_point=? WHERE route_id=?",
+                         (data['route_name'], data['start_point'], data['end_point'], id))
+            bump_generation("routes")
+        invalidate_fleet_positions()
         return jsonify({"message": "Route updated"})
     except sqlite3.Error as e:
         return jsonify({"error": str(e)}), 500
@@ -770,9 +2170,13 @@ def update_route(id):
 @token_required(require_admin=True)
 def delete_route(id):
     try:
-        query_commit("UPDATE vehicles SET route_id=NULL WHERE route_id=?", (id,))
-        query_commit("DELETE FROM route_stops WHERE route_id=?", (id,))
-        query_commit("DELETE FROM routes WHERE route_id=?", (id,))
+        with write_transaction():
+            query_commit("UPDATE vehicles SET route_id=NULL WHERE route_id=?", (id,))
+            query_commit("DELETE FROM route_stops WHERE route_id=?", (id,))
+            query_commit("DELETE FROM segment_travel_times WHERE route_id=?", (id,))
+            query_commit("DELETE FROM routes WHERE route_id=?", (id,))
+            bump_generation("routes", "route_stops")
+        invalidate_fleet_positions()
         return jsonify({"message": "Route deleted successfully"})
     except sqlite3.Error as e:
         return jsonify({"error": str(e)}), 500
@@ -783,8 +2187,8 @@ def delete_route(id):
 @app.route('/route_stops/<int:route_id>', methods=['GET'])
 def get_route_stops(route_id):
     try:
-        rows = query_fetchall("SELECT * FROM route_stops WHERE route_id=? ORDER BY stop_number", (route_id,))
-        return jsonify(rows)
+        return cached_json_response("route_stops", route_id, lambda: query_fetchall(
+            "SELECT * FROM route_stops WHERE route_id=? ORDER BY stop_number", (route_id,)))
     except sqlite3.Error as e:
         return jsonify({"error": str(e)}), 500
 
@@ -796,8 +2200,14 @@ def add_route_stop():
     if not ok:
         return jsonify({"error": msg}), 400
     try:
-        query_commit("INSERT INTO route_stops(route_id, stop_name, stop_number) VALUES(?, ?, ?)",
-                     (data['route_id'], data['stop_name'], data['stop_number']))
+        lat, lon = parse_optional_coordinates(data)
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    try:
+        with write_transaction():
+            query_commit("INSERT INTO route_stops(route_id, stop_name, stop_number, latitude, longitude) VALUES(?, ?, ?, ?, ?)",
+                         (data['route_id'], data['stop_name'], data['stop_number'], lat, lon))
+            bump_generation("route_stops")
         return jsonify({"message": "Route stop added"}), 201
     except sqlite3.Error as e:
         return jsonify({"error": str(e)}), 500
@@ -810,8 +2220,18 @@ def update_route_stop(stop_id):
     if not ok:
         return jsonify({"error": msg}), 400
     try:
-        query_commit("UPDATE route_stops SET stop_name=?, stop_number=? WHERE stop_id=?",
-                     (data['stop_name'], data['stop_number'], stop_id))
+        lat, lon = parse_optional_coordinates(data)
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    try:
+        with write_transaction():
+            if lat is None:
+                query_commit("UPDATE route_stops SET stop_name=?, stop_number=? WHERE stop_id=?",
+                             (data['stop_name'], data['stop_number'], stop_id))
+            else:
+                query_commit("UPDATE route_stops SET stop_name=?, stop_number=?, latitude=?, longitude=? WHERE stop_id=?",
+                             (data['stop_name'], data['stop_number'], lat, lon, stop_id))
+            bump_generation("route_stops")
         return jsonify({"message": "Route stop updated"})
     except sqlite3.Error as e:
         return jsonify({"error": str(e)}), 500
@@ -820,7 +2240,9 @@ def update_route_stop(stop_id):
 @token_required(require_admin=True)
 def delete_route_stop(stop_id):
     try:
-        query_commit("DELETE FROM route_stops WHERE stop_id=?", (stop_id,))
+        with write_transaction():
+            query_commit("DELETE FROM route_stops WHERE stop_id=?", (stop_id,))
+            bump_generation("route_stops")
         return jsonify({"message": "Route stop deleted"})
     except sqlite3.Error as e:
         return jsonify({"error": str(e)}), 500
@@ -828,21 +2250,32 @@ def delete_route_stop(stop_id):
 # -------------------------------
 # Access logs
 # -------------------------------
+ACCESS_LOGS_LIST_SQL = """
+    SELECT access_logs.log_id, users.name, cards.card_uid, access_logs.action_type, access_logs.area, access_logs.granted,
+           access_logs.timestamp, user_categories.category_name
+    FROM access_logs
+    LEFT JOIN users ON access_logs.user_id = users.user_id
+    LEFT JOIN cards ON access_logs.card_id = cards.card_id
+    LEFT JOIN user_categories ON users.category_id = user_categories.category_id
+"""
+
 @app.route('/access_logs', methods=['GET'])
 @token_required(require_admin=True)
 def get_logs():
-    offset, per_page = parse_pagination()
+    select_sql = ACCESS_LOGS_LIST_SQL
     try:
-        rows = query_fetchall("""
-            SELECT users.name, cards.card_uid, access_logs.action_type, access_logs.timestamp, user_categories.category_name
-            FROM access_logs
-            LEFT JOIN users ON access_logs.user_id = users.user_id
-            LEFT JOIN cards ON access_logs.card_id = cards.card_id
-            LEFT JOIN user_categories ON users.category_id = user_categories.category_id
+        if "cursor" in request.args:
+            page = cursor_page(select_sql + " {where} ORDER BY {order}",
+                               ["access_logs.timestamp", "access_logs.log_id"], ["timestamp", "log_id"])
+            return jsonify(page)
+        offset, per_page = parse_pagination()
+        rows = query_fetchall(select_sql + """
             ORDER BY access_logs.timestamp DESC
             LIMIT ? OFFSET ?
         """, (per_page, offset))
         return jsonify(rows)
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
     except sqlite3.Error as e:
         return jsonify({"error": str(e)}), 500
 
@@ -854,8 +2287,8 @@ def add_log():
     if not ok:
         return jsonify({"error": msg}), 400
     try:
-        query_commit("INSERT INTO access_logs(user_id, card_id, action_type) VALUES(?, ?, ?)",
-                     (data['user_id'], data['card_id'], data['action_type']))
+        query_commit("INSERT INTO access_logs(user_id, card_id, action_type, vehicle_id) VALUES(?, ?, ?, ?)",
+                     (data['user_id'], data['card_id'], data['action_type'], data.get('vehicle_id')))
         return jsonify({"message": "Log added"}), 201
     except sqlite3.Error as e:
         return jsonify({"error": str(e)}), 500
@@ -871,7 +2304,7 @@ def admin_register():
     if not ok:
         return jsonify({"error": msg}), 400
     try:
-        hashed = generate_password_hash(data['password'])
+        hashed = hash_password(data['password'])
         query_commit("INSERT INTO admins(name, email, password_hash) VALUES(?, ?, ?)",
                      (data['name'], data['email'], hashed))
         return jsonify({"message": "Admin registered successfully"}), 201
@@ -890,8 +2323,9 @@ def admin_login():
         admin = query_fetchone("SELECT * FROM admins WHERE email=?", (data['email'],))
         if not admin or not admin.get("password_hash"):
             return jsonify({"error": "Invalid email or password"}), 401
-        if not check_password_hash(admin['password_hash'], data['password']):
+        if not verify_password(admin['password_hash'], data['password']):
             return jsonify({"error": "Invalid email or password"}), 401
+        rehash_if_needed("admins", "admin_id", admin['admin_id'], admin['password_hash'], data['password'])
         token = create_token({
             "admin_id": admin['admin_id'],
             "name": admin['name'],
@@ -924,7 +2358,7 @@ def update_admin(id):
     params = [data['name'], data['email']]
     sql = "UPDATE admins SET name=?, email=?"
     if data.get('password'):
-        params.append(generate_password_hash(data['password']))
+        params.append(hash_password(data['password']))
         sql += ", password_hash=?"
     sql += " WHERE admin_id=?"
     params.append(id)
@@ -950,8 +2384,8 @@ def delete_admin(id):
 @token_required(require_admin=True)
 def get_permissions():
     try:
-        rows = query_fetchall("SELECT * FROM access_permissions")
-        return jsonify(rows)
+        return cached_json_response("permissions", None, lambda: query_fetchall(
+            "SELECT * FROM access_permissions"))
     except sqlite3.Error as e:
         return jsonify({"error": str(e)}), 500
 
@@ -963,8 +2397,10 @@ def add_permission():
     if not ok:
         return jsonify({"error": msg}), 400
     try:
-        query_commit("INSERT INTO access_permissions(category_id, allowed_area) VALUES(?, ?)",
-                     (data['category_id'], data['allowed_area']))
+        with write_transaction():
+            query_commit("INSERT INTO access_permissions(category_id, allowed_area) VALUES(?, ?)",
+                         (data['category_id'], data['allowed_area']))
+            bump_generation("permissions")
         return jsonify({"message": "Permission added"}), 201
     except sqlite3.Error as e:
         return jsonify({"error": str(e)}), 500
@@ -977,8 +2413,10 @@ def update_permission(id):
     if not ok:
         return jsonify({"error": msg}), 400
     try:
-        query_commit("UPDATE access_permissions SET category_id=?, allowed_area=? WHERE permission_id=?",
-                     (data['category_id'], data['allowed_area'], id))
+        with write_transaction():
+            query_commit("UPDATE access_permissions SET category_id=?, allowed_area=? WHERE permission_id=?",
+                         (data['category_id'], data['allowed_area'], id))
+            bump_generation("permissions")
         return jsonify({"message": "Permission updated"})
     except sqlite3.Error as e:
         return jsonify({"error": str(e)}), 500
@@ -987,101 +2425,1862 @@ def update_permission(id):
 @token_required(require_admin=True)
 def delete_permission(id):
     try:
-        query_commit("DELETE FROM access_permissions WHERE permission_id=?", (id,))
+        with write_transaction():
+            query_commit("DELETE FROM access_permissions WHERE permission_id=?", (id,))
+            bump_generation("permissions")
         return jsonify({"message": "Permission deleted"})
     except sqlite3.Error as e:
         return jsonify({"error": str(e)}), 500
 
 # -------------------------------
-# GPS
+# Card tap authorization
 # -------------------------------
-@app.route('/gps', methods=['GET'])
-@token_required(require_admin=True)
-def get_gps():
-    offset, per_page = parse_pagination()
-    try:
-        rows = query_fetchall("""
-            SELECT gps_locations.*, vehicles.vehicle_number
-            FROM gps_locations
-            LEFT JOIN vehicles ON gps_locations.vehicle_id = vehicles.vehicle_id
-            ORDER BY gps_locations.timestamp DESC
-            LIMIT ? OFFSET ?
-        """, (per_page, offset))
-        return jsonify(rows)
-    except sqlite3.Error as e:
-        return jsonify({"error": str(e)}), 500
+# Every worker keeps card_uid -> card, user_id -> category and category -> areas in
+# memory. Triggers on cards, users and access_permissions append the changed key to
+# access_changes; before each decision the index replays new change rows and reloads
+# only those keys, so a tap costs one primary-key lookup plus dict access.
+# The retention job prunes change rows older than ACCESS_CHANGES_RETENTION_HOURS
+# (always keeping the newest); change ids have no gaps, so an index or reader whose
+# version is below the oldest remaining row minus one has missed pruned changes and
+# takes a full reload instead of a delta.
+ACCESS_INDEX_MAX_DELTA = int(os.getenv("ACCESS_INDEX_MAX_DELTA", "500"))
+ACCESS_CHANGES_RETENTION_HOURS = int(os.getenv("ACCESS_CHANGES_RETENTION_HOURS", "168"))  # 0 keeps every row
 
-@app.route('/gps', methods=['POST'])
+CARD_LOOKUP_SQL = """
+    SELECT card_uid, card_id, user_id, status FROM cards {where}
+    ORDER BY card_uid, status = 'active', card_id
+"""
+
+class PermissionIndex:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.cards = {}
+        self.user_categories = {}
+        self.category_areas = {}
+        self.change_id = None
+        self.full_rebuilds = 0
+        self.delta_applies = 0
+
+    def _load_cards(self, conn, where="", params=()):
+        # a uid can be on several rows; prefer the newest active one (sorted last)
+        found = {}
+        for row in conn.execute(CARD_LOOKUP_SQL.format(where=where), params):
+            found[row["card_uid"]] = (row["card_id"], row["user_id"], row["status"])
+        return found
+
+    def _rebuild(self, conn, change_id):
+        self.cards = self._load_cards(conn)
+        self.user_categories = dict(conn.execute("SELECT user_id, category_id FROM users").fetchall())
+        areas = collections.defaultdict(set)
+        for category_id, area in conn.execute("SELECT category_id, allowed_area FROM access_permissions"):
+            areas[category_id].add(area)
+        self.category_areas = {k: frozenset(v) for k, v in areas.items()}
+        self.change_id = change_id
+        self.full_rebuilds += 1
+
+    def _load_user(self, conn, user_id):
+        row = conn.execute("SELECT category_id FROM users WHERE user_id=?", (user_id,)).fetchone()
+        if row is None:
+            self.user_categories.pop(user_id, None)
+        else:
+            self.user_categories[user_id] = row[0]
+
+    def _apply(self, conn, changes, change_id):
+        for entity, key in set(changes):
+            if entity == "card":
+                card = self._load_cards(conn, "WHERE card_uid=?", (key,)).get(key)
+                if card is None:
+                    self.cards.pop(key, None)
+                else:
+                    self.cards[key] = card
+                    # load the owner with the card, so a card never lands ahead of its user
+                    if card[1] is not None:
+                        self._load_user(conn, card[1])
+            elif entity == "user":
+                self._load_user(conn, int(key))
+            elif entity == "category":
+                areas = frozenset(r[0] for r in conn.execute(
+                    "SELECT allowed_area FROM access_permissions WHERE category_id=?", (int(key),)))
+                self.category_areas[int(key)] = areas
+        self.change_id = change_id
+        self.delta_applies += 1
+
+    def sync(self, conn):
+        """Bring the index up to the latest access_changes row."""
+        oldest, latest = conn.execute(
+            "SELECT COALESCE(MIN(change_id), 0), COALESCE(MAX(change_id), 0) FROM access_changes").fetchone()
+        if latest == self.change_id:
+            return
+        with self.lock:
+            if latest == self.change_id:
+                return
+            if (self.change_id is None or latest - self.change_id > ACCESS_INDEX_MAX_DELTA
+                    or latest < self.change_id or self.change_id < oldest - 1):
+                self._rebuild(conn, latest)
+            elif latest > self.change_id:
+                changes = conn.execute("""
+                    SELECT entity, entity_key FROM access_changes WHERE change_id > ? AND change_id <= ?
+                """, (self.change_id, latest)).fetchall()
+                self._apply(conn, [tuple(c) for c in changes], latest)
+
+    def decide(self, card_uid, area):
+        """Return (granted, reason, card_id, user_id) from the in-memory maps."""
+        card = self.cards.get(card_uid)
+        if card is None:
+            return False, "unknown_card", None, None
+        card_id, user_id, status = card
+        if status != "active":
+            return False, "card_inactive", card_id, user_id
+        category_id = self.user_categories.get(user_id)
+        if category_id is None:
+            return False, "no_category", card_id, user_id
+        if area not in self.category_areas.get(category_id, ()):
+            return False, "area_not_allowed", card_id, user_id
+        return True, "allowed", card_id, user_id
+
+    def snapshot(self):
+        return {
+            "change_id": self.change_id,
+            "cards": len(self.cards),
+            "users": len(self.user_categories),
+            "categories": len(self.category_areas),
+            "full_rebuilds": self.full_rebuilds,
+            "delta_applies": self.delta_applies,
+        }
+
+permission_index = PermissionIndex()
+
+@app.route('/access/tap', methods=['POST'])
 @token_required()
-def add_gps():
+def access_tap():
+    """Decide whether a card may enter an area and log the tap in the same call."""
     data = request.json or {}
-    ok, msg = require_fields(data, ["vehicle_id", "latitude", "longitude"])
+    ok, msg = require_fields(data, ["card_uid", "area"])
     if not ok:
         return jsonify({"error": msg}), 400
     try:
-        query_commit("INSERT INTO gps_locations(vehicle_id, latitude, longitude) VALUES(?, ?, ?)",
-                     (data['vehicle_id'], data['latitude'], data['longitude']))
-        return jsonify({"message": "GPS location added"}), 201
+        permission_index.sync(get_read_db())
+        granted, reason, card_id, user_id = permission_index.decide(str(data["card_uid"]), data["area"])
+        log_id = query_commit("""
+            INSERT INTO access_logs(user_id, card_id, action_type, area, granted, vehicle_id) VALUES(?, ?, ?, ?, ?, ?)
+        """, (user_id, card_id, data.get("action_type", "entry"), data["area"], int(granted), data.get("vehicle_id")))
+        return jsonify({
+            "granted": granted,
+            "reason": reason,
+            "card_id": card_id,
+            "user_id": user_id,
+            "log_id": log_id,
+        })
     except sqlite3.Error as e:
         return jsonify({"error": str(e)}), 500
 
-# -------------------------------
-# Cards
-# -------------------------------
-@app.route('/cards', methods=['GET'])
+@app.route('/access/index', methods=['GET'])
 @token_required(require_admin=True)
-def get_cards():
-    offset, per_page = parse_pagination()
+def get_access_index():
     try:
-        rows = query_fetchall("""
-            SELECT cards.*, users.name
-            FROM cards
-            LEFT JOIN users ON cards.user_id = users.user_id
-            LIMIT ? OFFSET ?
-        """, (per_page, offset))
-        return jsonify(rows)
+        permission_index.sync(get_read_db())
+        return jsonify(permission_index.snapshot())
     except sqlite3.Error as e:
         return jsonify({"error": str(e)}), 500
 
-@app.route('/cards', methods=['POST'])
+# -------------------------------
+# Offline reader sync
+# -------------------------------
+# Readers cache a snapshot of hashed card_uid -> area bitmask and decide locally while
+# offline. The snapshot version is the access_changes id the permission index is at,
+# so `?since=<version>` returns only the cards touched after it. Area bits come from
+# access_areas and never change meaning. Buffered taps come back through
+# POST /access_logs/batch with their original timestamps. The snapshot is admin-only
+# and is refused until ACCESS_SNAPSHOT_SALT is set: unsalted 64-bit hashes of short
+# card numbers are trivial to reverse.
+ACCESS_SNAPSHOT_SALT = os.getenv("ACCESS_SNAPSHOT_SALT", "")
+ACCESS_BATCH_MAX = int(os.getenv("ACCESS_BATCH_MAX", "1000"))
+
+def card_hash(card_uid):
+    """Truncated SHA-256 of the salted card_uid; readers hash what they read the same way."""
+    return hashlib.sha256((ACCESS_SNAPSHOT_SALT + card_uid).encode("utf-8")).hexdigest()[:16]
+
+def card_mask(index, card_uid, area_bits):
+    card = index.cards.get(card_uid)
+    if card is None or card[2] != "active":
+        return 0
+    mask = 0
+    for area in index.category_areas.get(index.user_categories.get(card[1]), ()):
+        if area in area_bits:
+            mask |= 1 << area_bits[area]
+    return mask
+
+def prune_access_changes(conn):
+    """Delete change rows older than ACCESS_CHANGES_RETENTION_HOURS, keeping the newest; returns the count."""
+    if ACCESS_CHANGES_RETENTION_HOURS <= 0:
+        return 0
+    return conn.execute("""
+        DELETE FROM access_changes
+        WHERE changed_at < datetime('now', ?)
+          AND change_id < (SELECT MAX(change_id) FROM access_changes)
+    """, (f"-{ACCESS_CHANGES_RETENTION_HOURS} hours",)).rowcount
+
+def changed_card_uids(conn, index, since):
+    """card_uids whose mask may differ between `since` and the index's version.
+
+    None when there are too many, or when rows after `since` have already been pruned.
+    """
+    oldest = conn.execute("SELECT COALESCE(MIN(change_id), 0) FROM access_changes").fetchone()[0]
+    if since < oldest - 1:
+        return None
+    changes = conn.execute("""
+        SELECT entity, entity_key FROM access_changes WHERE change_id > ? AND change_id <= ?
+        LIMIT ?
+    """, (since, index.change_id, ACCESS_INDEX_MAX_DELTA + 1)).fetchall()
+    if len(changes) > ACCESS_INDEX_MAX_DELTA:
+        return None
+    uids, users, categories = set(), set(), set()
+    for entity, key in changes:
+        if entity == "card":
+            uids.add(key)
+        elif entity == "user":
+            users.add(int(key))
+        elif entity == "category":
+            categories.add(int(key))
+    if users or categories:
+        for uid, (_, user_id, _) in index.cards.items():
+            if user_id in users or index.user_categories.get(user_id) in categories:
+                uids.add(uid)
+    return uids
+
+@app.route('/access/snapshot', methods=['GET'])
 @token_required(require_admin=True)
-def add_card():
-    data = request.json or {}
-    ok, msg = require_fields(data, ["card_uid", "user_id"])
-    if not ok:
-        return jsonify({"error": msg}), 400
+def get_access_snapshot():
+    """Full or delta permission snapshot for offline card readers."""
+    if not ACCESS_SNAPSHOT_SALT:
+        return jsonify({"error": "ACCESS_SNAPSHOT_SALT is not configured"}), 503
+    since = request.args.get("since")
     try:
-        query_commit("INSERT INTO cards(card_uid, user_id, status) VALUES(?, ?, ?)",
-                     (data['card_uid'], data['user_id'], data.get('status', 'active')))
-        return jsonify({"message": "Card added"}), 201
+        since = int(since) if since not in (None, "") else None
+    except ValueError:
+        return jsonify({"error": "since must be an integer"}), 400
+    try:
+        conn = get_read_db()
+        permission_index.sync(conn)
+        area_bits = dict(conn.execute("SELECT area, bit FROM access_areas").fetchall())
+        with permission_index.lock:
+            version = permission_index.change_id
+            uids = None
+            if since is not None and 0 <= since <= version:
+                uids = changed_card_uids(conn, permission_index, since)
+            body = {"version": version, "hash": "sha256/64", "areas": area_bits}
+            if uids is None:
+                cards = {}
+                for uid in permission_index.cards:
+                    mask = card_mask(permission_index, uid, area_bits)
+                    if mask:
+                        cards[card_hash(uid)] = mask
+                body.update(full=True, cards=cards)
+            else:
+                upsert, remove = {}, []
+                for uid in uids:
+                    mask = card_mask(permission_index, uid, area_bits)
+                    if mask:
+                        upsert[card_hash(uid)] = mask
+                    else:
+                        remove.append(card_hash(uid))
+                body.update(full=False, since=since, cards=upsert, removed=remove)
+        return jsonify(body)
     except sqlite3.Error as e:
         return jsonify({"error": str(e)}), 500
 
-@app.route('/cards/<int:id>', methods=['PUT'])
-@token_required(require_admin=True)
-def update_card(id):
-    data = request.json or {}
-    ok, msg = require_fields(data, ["card_uid", "user_id", "status"])
-    if not ok:
-        return jsonify({"error": msg}), 400
+@app.route('/access_logs/batch', methods=['POST'])
+@token_required()
+def add_log_batch():
+    """Store taps buffered by an offline reader, keeping their original timestamps."""
+    data = request.json
+    entries = data.get("entries") if isinstance(data, dict) else data
+    if not isinstance(entries, list) or not entries:
+        return jsonify({"error": "Expected a non-empty list of entries"}), 400
+    if len(entries) > ACCESS_BATCH_MAX:
+        return jsonify({"error": f"Batch too large (max {ACCESS_BATCH_MAX} entries)"}), 413
+
     try:
-        query_commit("UPDATE cards SET card_uid=?, user_id=?, status=? WHERE card_id=?",
-                     (data['card_uid'], data['user_id'], data['status'], id))
-        return jsonify({"message": "Card updated"})
+        permission_index.sync(get_read_db())
     except sqlite3.Error as e:
         return jsonify({"error": str(e)}), 500
 
-@app.route('/cards/<int:id>', methods=['DELETE'])
-@token_required(require_admin=True)
-def delete_card(id):
+    results = []
+    rows = []
+    for index, entry in enumerate(entries):
+        if not isinstance(entry, dict):
+            results.append({"index": index, "status": "rejected", "error": "Entry must be an object"})
+            continue
+        ok, msg = require_fields(entry, ["card_uid", "area", "timestamp"])
+        if ok:
+            try:
+                ts = parse_timestamp(entry["timestamp"])
+            except ValueError as e:
+                ok, msg = False, str(e)
+        if not ok:
+            results.append({"index": index, "status": "rejected", "error": msg})
+            continue
+        card_id, user_id, _ = permission_index.cards.get(str(entry["card_uid"]), (None, None, None))
+        granted = entry.get("granted")
+        rows.append((user_id, card_id, entry.get("action_type", "entry"), entry["area"],
+                     None if granted is None else int(bool(granted)), ts, entry.get("vehicle_id")))
+        results.append({"index": index, "status": "accepted"})
+
     try:
-        query_commit("DELETE FROM access_logs WHERE card_id=?", (id,))
-        query_commit("DELETE FROM cards WHERE card_id=?", (id,))
-        return jsonify({"message": "Card deleted"})
+        if rows:
+            query_commit_many("""
+                INSERT INTO access_logs(user_id, card_id, action_type, area, granted, timestamp, vehicle_id)
+                VALUES(?, ?, ?, ?, ?, ?, ?)
+            """, rows)
     except sqlite3.Error as e:
         return jsonify({"error": str(e)}), 500
 
-# -------------------------------
+    accepted = len(rows)
+    if accepted == len(entries):
+        status = 201
+    else:
+        status = 207 if accepted else 400
+    return jsonify({
+        "accepted": accepted,
+        "rejected": len(entries) - accepted,
+        "results": results
+    }), status
+
+# -------------------------------
+# Access analytics
+# -------------------------------
+# Triggers on access_logs keep access_hourly_counts (taps per hour, action_type, area
+# and the user's category) and access_daily_users (one row per user per day) current,
+# so the dashboards below read pre-aggregated rows. The backfill recomputes whole
+# days from the log, one short transaction per day.
+def rebuild_access_counters(conn, day):
+    """Recompute both counter tables for one 'YYYY-MM-DD' day from access_logs."""
+    bounds = (day, day)
+    conn.execute("DELETE FROM access_hourly_counts WHERE hour >= ? AND hour < date(?, '+1 day')", bounds)
+    conn.execute("DELETE FROM access_daily_users WHERE day = ?", (day,))
+    conn.execute("""
+        INSERT INTO access_hourly_counts(hour, action_type, area, category_id, taps, denied)
+        SELECT strftime('%Y-%m-%d %H:00:00', access_logs.timestamp), access_logs.action_type,
+               COALESCE(access_logs.area, ''), COALESCE(users.category_id, 0),
+               COUNT(*), SUM(access_logs.granted IS 0)
+        FROM access_logs
+        LEFT JOIN users ON users.user_id = access_logs.user_id
+        WHERE access_logs.timestamp >= ? AND access_logs.timestamp < date(?, '+1 day')
+        GROUP BY 1, 2, 3, 4
+    """, bounds)
+    conn.execute("""
+        INSERT INTO access_daily_users(day, user_id)
+        SELECT DISTINCT date(timestamp), user_id FROM access_logs
+        WHERE timestamp >= ? AND timestamp < date(?, '+1 day') AND user_id IS NOT NULL
+    """, bounds)
+
+def backfill_access_counters():
+    """Rebuild every day that has log rows or counter rows; returns a summary dict."""
+    conn = open_db_connection()
+    conn.isolation_level = None
+    try:
+        days = [r[0] for r in conn.execute("""
+            SELECT date(timestamp) FROM access_logs GROUP BY 1
+            UNION SELECT date(hour) FROM access_hourly_counts
+            UNION SELECT day FROM access_daily_users
+        """) if r[0] is not None]
+        for day in days:
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                rebuild_access_counters(conn, day)
+                conn.execute("COMMIT")
+            except Exception:
+                conn.execute("ROLLBACK")
+                raise
+    finally:
+        conn.close()
+    return {"days": len(days)}
+
+def analytics_window():
+    """`from` / `to` query args as a half-open [start, end) timestamp range."""
+    start = parse_timestamp(request.args.get("from")) or "0000-00-00 00:00:00"
+    end = parse_timestamp(request.args.get("to")) or "9999-12-31 23:59:59"
+    return start, end
+
+def first_day_from(ts):
+    """The first day whose midnight is at or after `ts`, so days and hours cut [start, end) alike."""
+    day = ts[:10]
+    if ts[11:] > "00:00:00":
+        try:
+            day = (datetime.date.fromisoformat(day) + datetime.timedelta(days=1)).isoformat()
+        except OverflowError:
+            day = "9999-12-32"
+    return day
+
+ANALYTICS_GROUPS = {
+    "hour": ("hour", "hour"),
+    "action_type": ("action_type", "action_type"),
+    "area": ("area", "area"),
+    "category": ("category_id", "category_id"),
+}
+
+@app.route('/analytics/access', methods=['GET'])
+@token_required(require_admin=True)
+def get_access_analytics():
+    """Tap counts grouped by ?group=hour|action_type|area|category over ?from=&to=."""
+    group = request.args.get("group", "hour")
+    if group not in ANALYTICS_GROUPS:
+        return jsonify({"error": "group must be one of " + ", ".join(ANALYTICS_GROUPS)}), 400
+    column, field = ANALYTICS_GROUPS[group]
+    try:
+        start, end = analytics_window()
+        clauses, params = ["hour >= ?", "hour < ?"], [start, end]
+        for name in ("action_type", "area"):
+            if request.args.get(name) is not None:
+                clauses.append(f"{name} = ?")
+                params.append(request.args[name])
+        if request.args.get("category_id") is not None:
+            clauses.append("category_id = ?")
+            params.append(int(request.args["category_id"]))
+        rows = query_fetchall(f"""
+            SELECT {column} AS {field}, SUM(taps) AS taps, SUM(denied) AS denied
+            FROM access_hourly_counts
+            WHERE {" AND ".join(clauses)}
+            GROUP BY {column}
+            ORDER BY {column}
+        """, params)
+        if group == "category":
+            names = {r["category_id"]: r["category_name"]
+                     for r in query_fetchall("SELECT category_id, category_name FROM user_categories")}
+            for row in rows:
+                row["category_name"] = names.get(row["category_id"])
+        return jsonify(rows)
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    except sqlite3.Error as e:
+        return jsonify({"error": str(e)}), 500
+
+@app.route('/analytics/access/unique_users', methods=['GET'])
+@token_required(require_admin=True)
+def get_access_unique_users():
+    """Distinct users with at least one tap, per day, for the days starting in [from, to)."""
+    try:
+        start, end = analytics_window()
+        rows = query_fetchall("""
+            SELECT day, COUNT(*) AS unique_users
+            FROM access_daily_users
+            WHERE day >= ? AND day < ?
+            GROUP BY day
+            ORDER BY day
+        """, (first_day_from(start), first_day_from(end)))
+        return jsonify(rows)
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    except sqlite3.Error as e:
+        return jsonify({"error": str(e)}), 500
+
+@app.route('/analytics/access/backfill', methods=['POST'])
+@token_required(require_admin=True)
+def run_access_backfill():
+    try:
+        return jsonify(backfill_access_counters())
+    except sqlite3.Error as e:
+        return jsonify({"error": str(e)}), 500
+
+@app.cli.command("access-analytics-backfill")
+def access_analytics_backfill_command():
+    """Recompute the access analytics counters from access_logs."""
+    startup()
+    print(json.dumps(backfill_access_counters()))
+
+# -------------------------------
+# Vehicle occupancy
+# -------------------------------
+# Taps with a vehicle_id are boardings or alightings. Each worker keeps a running
+# count per vehicle by tailing access_logs by log_id (ids are committed in order)
+# and every OCCUPANCY_CHECKPOINT_S writes its counts to vehicle_occupancy, so a
+# restart replays only the rows after the checkpoint. A manual reset writes the
+# checkpoint directly and bumps the "occupancy" generation, which makes every
+# worker reload; checkpoints from a worker on an older generation are ignored.
+OCCUPANCY_CHECKPOINT_S = float(os.getenv("OCCUPANCY_CHECKPOINT_S", "30"))
+OCCUPANCY_REPLAY_CHUNK = int(os.getenv("OCCUPANCY_REPLAY_CHUNK", "5000"))
+BOARD_ACTIONS = {"board", "entry"}
+ALIGHT_ACTIONS = {"alight", "exit"}
+
+OCCUPANCY_REPLAY_SQL = """
+    SELECT log_id, vehicle_id, action_type FROM access_logs
+    WHERE log_id > ? AND vehicle_id IS NOT NULL AND granted IS NOT 0
+    ORDER BY log_id LIMIT ?
+"""
+
+OCCUPANCY_CHECKPOINT_SQL = """
+    INSERT INTO vehicle_occupancy(vehicle_id, occupancy, log_id, generation, updated_at)
+    VALUES (?, ?, ?, ?, CURRENT_TIMESTAMP)
+    ON CONFLICT(vehicle_id) DO UPDATE SET
+        occupancy = excluded.occupancy,
+        log_id = excluded.log_id,
+        generation = excluded.generation,
+        updated_at = excluded.updated_at
+    WHERE excluded.generation >= vehicle_occupancy.generation
+      AND excluded.log_id >= vehicle_occupancy.log_id
+"""
+
+class OccupancyTracker:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.counts = {}
+        self.log_id = 0
+        self.generation = None
+        self.checkpointed_at = time.monotonic()
+        self.checkpointed_log_id = None
+
+    def _reload(self, conn, generation):
+        rows = conn.execute("SELECT vehicle_id, occupancy, log_id FROM vehicle_occupancy").fetchall()
+        self.counts = {r["vehicle_id"]: r["occupancy"] for r in rows}
+        floors = {r["vehicle_id"]: r["log_id"] for r in rows}
+        self.log_id = min(floors.values(), default=0)
+        self.generation = generation
+        self._replay(conn, floors)
+
+    def _replay(self, conn, floors=None):
+        while True:
+            rows = conn.execute(OCCUPANCY_REPLAY_SQL, (self.log_id, OCCUPANCY_REPLAY_CHUNK)).fetchall()
+            for log_id, vehicle_id, action_type in rows:
+                if floors and log_id <= floors.get(vehicle_id, 0):
+                    continue
+                if action_type in BOARD_ACTIONS:
+                    self.counts[vehicle_id] = self.counts.get(vehicle_id, 0) + 1
+                elif action_type in ALIGHT_ACTIONS:
+                    # a missed boarding tap must not drive the count negative
+                    self.counts[vehicle_id] = max(self.counts.get(vehicle_id, 0) - 1, 0)
+            if rows:
+                self.log_id = rows[-1][0]
+            if len(rows) < OCCUPANCY_REPLAY_CHUNK:
+                break
+
+    def refresh(self, checkpoint=False):
+        """Catch up with new taps and resets, checkpointing when due. Returns a copy of the counts."""
+        conn = get_read_db()
+        generation = current_generation("occupancy")
+        with self.lock:
+            if generation != self.generation:
+                self._reload(conn, generation)
+            else:
+                self._replay(conn)
+            counts = dict(self.counts)
+            due = checkpoint or (time.monotonic() - self.checkpointed_at >= OCCUPANCY_CHECKPOINT_S
+                                 and self.log_id != self.checkpointed_log_id)
+            if due:
+                self.checkpointed_at = time.monotonic()
+                self.checkpointed_log_id = self.log_id
+                rows = [(v, n, self.log_id, self.generation) for v, n in counts.items()]
+        if due and rows:
+            query_commit_many(OCCUPANCY_CHECKPOINT_SQL, rows)
+        return counts
+
+    def reset(self, vehicle_id, occupancy):
+        """Set one vehicle's count as of the newest log row and make every worker reload."""
+        # checkpoint everyone else first so the reload never has to replay from before the reset
+        self.refresh(checkpoint=True)
+        with write_transaction() as conn:
+            bump_generation("occupancy")
+            generation = conn.execute("SELECT generation FROM cache_generations WHERE name='occupancy'").fetchone()[0]
+            last = conn.execute("SELECT COALESCE(MAX(log_id), 0) FROM access_logs").fetchone()[0]
+            query_commit("""
+                INSERT OR REPLACE INTO vehicle_occupancy(vehicle_id, occupancy, log_id, generation, updated_at)
+                VALUES (?, ?, ?, ?, CURRENT_TIMESTAMP)
+            """, (vehicle_id, occupancy, last, generation))
+
+occupancy_tracker = OccupancyTracker()
+
+def load_factor(occupancy, capacity):
+    return round(occupancy / capacity, 3) if capacity else None
+
+def occupancy_rows(counts, where="", params=()):
+    rows = query_fetchall(f"""
+        SELECT vehicles.vehicle_id, vehicles.vehicle_number, vehicles.capacity, vehicles.route_id, routes.route_name
+        FROM vehicles
+        LEFT JOIN routes ON vehicles.route_id = routes.route_id
+        {where}
+        ORDER BY vehicles.vehicle_id
+    """, params)
+    for row in rows:
+        row["occupancy"] = counts.get(row["vehicle_id"], 0)
+        row["load_factor"] = load_factor(row["occupancy"], row["capacity"])
+    return rows
+
+@app.route('/occupancy', methods=['GET'])
+@token_required()
+def get_occupancy():
+    """Current load and load factor per vehicle and per route."""
+    try:
+        vehicles = occupancy_rows(occupancy_tracker.refresh())
+        routes = {}
+        for v in vehicles:
+            if v["route_id"] is None:
+                continue
+            route = routes.setdefault(v["route_id"], {
+                "route_id": v["route_id"], "route_name": v["route_name"],
+                "vehicles": 0, "occupancy": 0, "capacity": 0,
+            })
+            route["vehicles"] += 1
+            route["occupancy"] += v["occupancy"]
+            route["capacity"] += v["capacity"] or 0
+        for route in routes.values():
+            route["load_factor"] = load_factor(route["occupancy"], route["capacity"])
+        return jsonify({"vehicles": vehicles, "routes": list(routes.values())})
+    except sqlite3.Error as e:
+        return jsonify({"error": str(e)}), 500
+
+@app.route('/vehicles/<int:id>/occupancy', methods=['GET'])
+@token_required()
+def get_vehicle_occupancy(id):
+    try:
+        rows = occupancy_rows(occupancy_tracker.refresh(), "WHERE vehicles.vehicle_id=?", (id,))
+        if not rows:
+            return jsonify({"error": "Vehicle not found"}), 404
+        return jsonify(rows[0])
+    except sqlite3.Error as e:
+        return jsonify({"error": str(e)}), 500
+
+@app.route('/vehicles/<int:id>/occupancy/reset', methods=['POST'])
+@token_required(require_admin=True)
+def reset_vehicle_occupancy(id):
+    """Correct a drifted count, e.g. to 0 at the end of a run."""
+    data = request.json or {}
+    occupancy = data.get("occupancy", 0)
+    if isinstance(occupancy, bool) or not isinstance(occupancy, int) or occupancy < 0:
+        return jsonify({"error": "occupancy must be a non-negative integer"}), 400
+    try:
+        occupancy_tracker.reset(id, occupancy)
+        return jsonify({"message": "Occupancy reset", "vehicle_id": id, "occupancy": occupancy})
+    except sqlite3.Error as e:
+        return jsonify({"error": str(e)}), 500
+
+# -------------------------------
+# GPS ingest (write-behind queue)
+# -------------------------------
+GPS_INSERT_SQL = """
+    INSERT INTO gps_locations(vehicle_id, latitude, longitude, timestamp)
+    VALUES(?, ?, ?, COALESCE(?, CURRENT_TIMESTAMP))
+"""
+
+def utc_now_str():
+    return datetime.datetime.now(datetime.UTC).strftime("%Y-%m-%d %H:%M:%S")
+
+LATEST_POSITION_UPSERT_SQL = """
+    INSERT INTO vehicle_latest_position(vehicle_id, latitude, longitude, timestamp)
+    VALUES(?, ?, ?, COALESCE(?, CURRENT_TIMESTAMP))
+    ON CONFLICT(vehicle_id) DO UPDATE SET
+        latitude=excluded.latitude, longitude=excluded.longitude, timestamp=excluded.timestamp
+    WHERE excluded.timestamp >= vehicle_latest_position.timestamp
+"""
+
+def write_gps_rows(conn, rows):
+    """Insert GPS rows on `conn` with one prepared statement; the caller owns the transaction.
+
+    Also advances vehicle_latest_position for every vehicle in the group.
+    """
+    conn.executemany(GPS_INSERT_SQL, rows)
+    latest = {}
+    for row in rows:
+        current = latest.get(row[0])
+        # rows without a timestamp are "now" and win over explicit ones in the same group
+        if current is None or row[3] is None or (current[3] is not None and row[3] >= current[3]):
+            latest[row[0]] = row
+    conn.executemany(LATEST_POSITION_UPSERT_SQL, list(latest.values()))
+    invalidate_fleet_positions()
+
+class GPSIngestQueue:
+    """Bounded in-process queue drained by one writer thread that group-commits points.
+
+    Rows are (vehicle_id, latitude, longitude, timestamp) tuples. The writer owns its
+    own SQLite connection (outside the request pool) and commits whenever `flush_rows` points are waiting or
+    `flush_ms` has passed since the first point of the group arrived.
+
+    Queued points were already acknowledged with 202, so a group is never dropped: a
+    transient failure (locked or busy database) is retried with backoff while the
+    bounded queue pushes back on new points with 503. A group that hits any other
+    error, or still fails while the worker shuts down, is appended to
+    GPS_DEAD_LETTER_FILE for `flask import-gps`.
+    """
+
+    def __init__(self, flush_rows=500, flush_ms=200, max_depth=10000):
+        self.flush_rows = max(1, flush_rows)
+        self.flush_interval = max(1, flush_ms) / 1000.0
+        self.queue = queue.Queue(maxsize=max(1, max_depth))
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+        self._pid = None
+        self.stats = {"enqueued": 0, "written": 0, "rejected": 0, "commits": 0, "errors": 0,
+                      "dead_lettered": 0}
+
+    def _ensure_writer(self):
+        # started lazily so each forked gunicorn worker gets its own writer
+        if self._thread is not None and self._thread.is_alive() and self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._thread is not None and self._thread.is_alive() and self._pid == os.getpid():
+                return
+            self._stop.clear()
+            self._pid = os.getpid()
+            self._thread = threading.Thread(target=self._run, name="gps-writer", daemon=True)
+            self._thread.start()
+
+    def put_many(self, rows):
+        """Enqueue rows without blocking; returns False (nothing enqueued) if the queue lacks room."""
+        self._ensure_writer()
+        with self._lock:
+            if self.queue.maxsize - self.queue.qsize() < len(rows):
+                self.stats["rejected"] += len(rows)
+                return False
+            for row in rows:
+                self.queue.put_nowait(row)
+            self.stats["enqueued"] += len(rows)
+        return True
+
+    def _drain_group(self):
+        try:
+            first = self.queue.get(timeout=self.flush_interval)
+        except queue.Empty:
+            return []
+        group = [first]
+        deadline = time.monotonic() + self.flush_interval
+        while len(group) < self.flush_rows:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                group.append(self.queue.get(timeout=remaining))
+            except queue.Empty:
+                break
+        return group
+
+    def _write(self, conn, group):
+        delay = 0.05
+        while True:
+            try:
+                with conn:
+                    write_gps_rows(conn, group)
+                position_broadcaster.notify()
+                self.stats["written"] += len(group)
+                self.stats["commits"] += 1
+                return
+            except sqlite3.Error as e:
+                self.stats["errors"] += 1
+                transient = isinstance(e, sqlite3.OperationalError) and not self._stop.is_set()
+                if not transient and self._spill(group, e):
+                    return
+                app.logger.warning("GPS writer retrying %d points in %.2fs: %s", len(group), delay, e)
+            time.sleep(delay)
+            delay = min(delay * 2, GPS_QUEUE_RETRY_MAX_S)
+
+    def _spill(self, group, reason):
+        """Append `group` to the dead-letter CSV; False if even that failed."""
+        try:
+            with open(GPS_DEAD_LETTER_FILE, "a", newline="") as f:
+                # every worker appends to the same file
+                fcntl.flock(f, fcntl.LOCK_EX)
+                writer = csv.writer(f)
+                if os.fstat(f.fileno()).st_size == 0:
+                    writer.writerow(["vehicle_id", "latitude", "longitude", "timestamp"])
+                writer.writerows(group)
+                f.flush()
+                os.fsync(f.fileno())
+        except OSError as e:
+            app.logger.error("GPS writer could not dead-letter %d points: %s", len(group), e)
+            return False
+        self.stats["dead_lettered"] += len(group)
+        app.logger.error("GPS writer moved %d points to %s: %s", len(group), GPS_DEAD_LETTER_FILE, reason)
+        return True
+
+    def _run(self):
+        conn = open_db_connection()
+        try:
+            while not (self._stop.is_set() and self.queue.empty()):
+                group = self._drain_group()
+                if group:
+                    self._write(conn, group)
+        finally:
+            conn.close()
+
+    def flush(self, timeout=30):
+        """Stop the writer after it has committed everything still queued."""
+        thread = self._thread
+        if thread is None or not thread.is_alive() or self._pid != os.getpid():
+            return
+        self._stop.set()
+        thread.join(timeout)
+        if thread.is_alive():
+            # the writer is still stuck on a group; keep what is queued behind it
+            leftover = []
+            while True:
+                try:
+                    leftover.append(self.queue.get_nowait())
+                except queue.Empty:
+                    break
+            if leftover:
+                self._spill(leftover, "shutdown before commit")
+
+    def snapshot(self):
+        return dict(self.stats, depth=self.queue.qsize(), max_depth=self.queue.maxsize,
+                    flush_rows=self.flush_rows, flush_ms=int(self.flush_interval * 1000),
+                    writer_alive=bool(self._thread and self._thread.is_alive()))
+
+gps_ingest_queue = None
+if GPS_INGEST_MODE == "queue":
+    gps_ingest_queue = GPSIngestQueue(GPS_QUEUE_FLUSH_ROWS, GPS_QUEUE_FLUSH_MS, GPS_QUEUE_MAX_DEPTH)
+    # gunicorn exits workers through sys.exit on SIGTERM, so atexit drains the queue
+    atexit.register(gps_ingest_queue.flush)
+
+def ingest_gps_rows(rows):
+    """Store GPS rows directly, or hand them to the write-behind queue when enabled.
+
+    Returns True when the rows were committed, False when they were queued, and
+    raises QueueFullError if the queue has no room for them.
+    """
+    if gps_ingest_queue is not None:
+        # commit happens later, so stamp points with their receive time now
+        now = utc_now_str()
+        rows = [row if row[3] else row[:3] + (now,) for row in rows]
+        if not gps_ingest_queue.put_many(rows):
+            raise QueueFullError("GPS ingest queue is full")
+        return False
+    with write_transaction() as conn:
+        write_gps_rows(conn, rows)
+    position_broadcaster.notify()
+    return True
+
+# -------------------------------
+# Fleet positions
+# -------------------------------
+# Short-lived per-worker copy of the fleet snapshot; other workers' writes become
+# visible after FLEET_CACHE_TTL seconds, local writes immediately.
+_fleet_positions_cache = {"expires": 0.0, "rows": None}
+
+# coordinates are stored as REAL but served as strings, as they always were
+FLEET_POSITIONS_SQL = """
+    SELECT vehicles.vehicle_id, vehicles.vehicle_number, vehicles.driver_name, vehicles.route_id,
+           routes.route_name,
+           CAST(vehicle_latest_position.latitude AS TEXT) AS latitude,
+           CAST(vehicle_latest_position.longitude AS TEXT) AS longitude,
+           vehicle_latest_position.timestamp
+    FROM vehicles
+    LEFT JOIN routes ON vehicles.route_id = routes.route_id
+    LEFT JOIN vehicle_latest_position ON vehicles.vehicle_id = vehicle_latest_position.vehicle_id
+    ORDER BY vehicles.vehicle_id
+"""
+
+def invalidate_fleet_positions():
+    _fleet_positions_cache["expires"] = 0.0
+
+def get_fleet_positions():
+    now = time.monotonic()
+    rows = _fleet_positions_cache["rows"]
+    if rows is None or now >= _fleet_positions_cache["expires"]:
+        rows = query_fetchall(FLEET_POSITIONS_SQL)
+        _fleet_positions_cache["rows"] = rows
+        _fleet_positions_cache["expires"] = now + FLEET_CACHE_TTL
+    return rows
+
+@app.route('/fleet/positions', methods=['GET'])
+@token_required()
+def get_fleet_positions_route():
+    try:
+        return jsonify(get_fleet_positions())
+    except sqlite3.Error as e:
+        return jsonify({"error": str(e)}), 500
+
+# -------------------------------
+# Live position stream (SSE)
+# -------------------------------
+# Rows are committed in location_id order (SQLite has a single writer), so tailing
+# gps_locations by id sees every point from every worker, and the id doubles as
+# the SSE event id for Last-Event-ID resume.
+STREAM_ROWS_SQL = """
+    SELECT gps_locations.location_id, gps_locations.vehicle_id, vehicles.route_id,
+           CAST(gps_locations.latitude AS TEXT) AS latitude,
+           CAST(gps_locations.longitude AS TEXT) AS longitude,
+           gps_locations.timestamp
+    FROM gps_locations
+    LEFT JOIN vehicles ON gps_locations.vehicle_id = vehicles.vehicle_id
+    WHERE gps_locations.location_id > ?
+"""
+
+class StreamSubscriber:
+    def __init__(self, vehicle_ids, route_ids, queue_size):
+        self.vehicle_ids = vehicle_ids
+        self.route_ids = route_ids
+        self.queue = queue.Queue(maxsize=queue_size)
+        self.overflowed = False
+
+    def matches(self, row):
+        if not self.vehicle_ids and not self.route_ids:
+            return True
+        return row["vehicle_id"] in self.vehicle_ids or row["route_id"] in self.route_ids
+
+class PositionBroadcaster:
+    """One polling thread per worker that fans new GPS rows out to SSE subscribers.
+
+    The thread runs only while someone is subscribed. A subscriber whose queue fills
+    up is marked overflowed; its stream then ends and the client resumes from its
+    Last-Event-ID.
+    """
+
+    def __init__(self, poll_ms, queue_size):
+        self.poll_interval = max(10, poll_ms) / 1000.0
+        self.queue_size = queue_size
+        self._lock = threading.Lock()
+        self._wake = threading.Event()
+        self._subscribers = set()
+        self._thread = None
+        self._pid = None
+        self.last_id = 0
+
+    def subscribe(self, vehicle_ids=None, route_ids=None):
+        sub = StreamSubscriber(vehicle_ids or set(), route_ids or set(), self.queue_size)
+        with self._lock:
+            self._subscribers.add(sub)
+            if self._thread is None or not self._thread.is_alive() or self._pid != os.getpid():
+                self._pid = os.getpid()
+                self.last_id = self._current_max_id()
+                self._thread = threading.Thread(target=self._run, name="gps-broadcaster", daemon=True)
+                self._thread.start()
+        return sub
+
+    def unsubscribe(self, sub):
+        with self._lock:
+            self._subscribers.discard(sub)
+
+    def notify(self):
+        """Wake the poller early; called after this worker commits GPS rows."""
+        self._wake.set()
+
+    def subscriber_count(self):
+        with self._lock:
+            return len(self._subscribers)
+
+    def _current_max_id(self):
+        conn = open_db_connection(readonly=True)
+        try:
+            return conn.execute("SELECT COALESCE(MAX(location_id), 0) FROM gps_locations").fetchone()[0]
+        finally:
+            conn.close()
+
+    def _run(self):
+        conn = open_db_connection(readonly=True)
+        try:
+            while True:
+                with self._lock:
+                    if not self._subscribers:
+                        self._thread = None
+                        return
+                    subscribers = list(self._subscribers)
+                rows = conn.execute(STREAM_ROWS_SQL + " ORDER BY gps_locations.location_id LIMIT 1000",
+                                    (self.last_id,)).fetchall()
+                for row in rows:
+                    event = dict(row)
+                    for sub in subscribers:
+                        if sub.overflowed or not sub.matches(event):
+                            continue
+                        try:
+                            sub.queue.put_nowait(event)
+                        except queue.Full:
+                            sub.overflowed = True
+                    self.last_id = event["location_id"]
+                if len(rows) < 1000:
+                    self._wake.wait(self.poll_interval)
+                    self._wake.clear()
+        except sqlite3.Error:
+            app.logger.exception("GPS broadcaster stopped")
+            with self._lock:
+                self._thread = None
+                for sub in self._subscribers:
+                    sub.overflowed = True
+        finally:
+            conn.close()
+
+position_broadcaster = PositionBroadcaster(STREAM_POLL_MS, STREAM_QUEUE_SIZE)
+
+def parse_id_list(value):
+    ids = set()
+    for part in (value or "").split(","):
+        part = part.strip()
+        if part:
+            ids.add(int(part))
+    return ids
+
+def sse_event(data, event=None, event_id=None):
+    lines = []
+    if event_id is not None:
+        lines.append(f"id: {event_id}")
+    if event:
+        lines.append(f"event: {event}")
+    lines.append("data: " + json.dumps(data, separators=(",", ":")))
+    return "\n".join(lines) + "\n\n"
+
+@app.route('/stream/tickets', methods=['POST'])
+@token_required()
+def create_stream_ticket():
+    """Single-use ticket for opening /stream/positions from a browser EventSource.
+
+    The ticket goes in the URL instead of the JWT, so access and proxy logs only ever
+    see a value that is spent on first use and expires after STREAM_TICKET_TTL_S.
+    """
+    ticket = secrets.token_urlsafe(32)
+    now = int(time.time())
+    try:
+        query_commit("DELETE FROM stream_tickets WHERE expires_at <= ?", (now,))
+        query_commit("INSERT INTO stream_tickets(ticket_hash, claims, expires_at) VALUES(?, ?, ?)",
+                     (stream_ticket_digest(ticket), json.dumps(request.user), now + STREAM_TICKET_TTL_S))
+    except sqlite3.Error as e:
+        return jsonify({"error": str(e)}), 500
+    return jsonify({"ticket": ticket, "expires_in": STREAM_TICKET_TTL_S}), 201
+
+@app.route('/stream/positions', methods=['GET'])
+@token_required(allow_ticket=True)
+def stream_positions():
+    """Server-Sent Events feed of accepted GPS points.
+
+    Authenticate with the Authorization header or, from EventSource, ?ticket= (see
+    POST /stream/tickets). A ticket is spent on connect, so after a drop the client
+    fetches a new one and reconnects with ?last_event_id=.
+    Filters: ?vehicle_id=1,2 and/or ?route_id=3 (either matches). Resume with the
+    Last-Event-ID header (or ?last_event_id=); otherwise the stream opens with a
+    `snapshot` event of the current latest positions.
+    """
+    try:
+        vehicle_ids = parse_id_list(request.args.get("vehicle_id"))
+        route_ids = parse_id_list(request.args.get("route_id"))
+        last_event_id = request.headers.get("Last-Event-ID") or request.args.get("last_event_id")
+        last_event_id = int(last_event_id) if last_event_id else None
+    except ValueError:
+        return jsonify({"error": "vehicle_id, route_id and last_event_id must be integers"}), 400
+
+    sub = position_broadcaster.subscribe(vehicle_ids, route_ids)
+    try:
+        preamble = [f"retry: {STREAM_RETRY_MS}\n\n"]
+        if last_event_id is not None:
+            rows = query_fetchall(STREAM_ROWS_SQL + " ORDER BY gps_locations.location_id LIMIT ?",
+                                  (last_event_id, STREAM_REPLAY_MAX))
+            for row in rows:
+                if sub.matches(row):
+                    preamble.append(sse_event(row, "position", row["location_id"]))
+                last_event_id = row["location_id"]
+            if len(rows) == STREAM_REPLAY_MAX:
+                # too far behind to bridge to the live feed; end after the replay so
+                # the client reconnects from the last id it received
+                sub.overflowed = True
+        else:
+            snapshot = [row for row in get_fleet_positions()
+                        if sub.matches(row) and row["latitude"] is not None]
+            preamble.append(sse_event(snapshot, "snapshot"))
+            last_event_id = 0
+    except sqlite3.Error as e:
+        position_broadcaster.unsubscribe(sub)
+        return jsonify({"error": str(e)}), 500
+
+    def generate(last_sent):
+        try:
+            for chunk in preamble:
+                yield chunk
+            while not sub.overflowed:
+                try:
+                    event = sub.queue.get(timeout=STREAM_HEARTBEAT_S)
+                except queue.Empty:
+                    yield ": heartbeat\n\n"
+                    continue
+                if event["location_id"] <= last_sent:
+                    continue
+                last_sent = event["location_id"]
+                yield sse_event(event, "position", last_sent)
+        finally:
+            position_broadcaster.unsubscribe(sub)
+
+    return Response(generate(last_event_id), mimetype="text/event-stream",
+                    headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+
+# -------------------------------
+# GPS
+# -------------------------------
+GPS_LIST_SQL = """
+    SELECT gps_locations.location_id, gps_locations.vehicle_id,
+           CAST(gps_locations.latitude AS TEXT) AS latitude,
+           CAST(gps_locations.longitude AS TEXT) AS longitude,
+           gps_locations.timestamp, vehicles.vehicle_number
+    FROM gps_locations
+    LEFT JOIN vehicles ON gps_locations.vehicle_id = vehicles.vehicle_id
+"""
+
+@app.route('/gps', methods=['GET'])
+@token_required(require_admin=True)
+def get_gps():
+    select_sql = GPS_LIST_SQL
+    try:
+        if "cursor" in request.args:
+            page = cursor_page(select_sql + " {where} ORDER BY {order}",
+                               ["gps_locations.timestamp", "gps_locations.location_id"], ["timestamp", "location_id"])
+            return jsonify(page)
+        offset, per_page = parse_pagination()
+        rows = query_fetchall(select_sql + """
+            ORDER BY gps_locations.timestamp DESC
+            LIMIT ? OFFSET ?
+        """, (per_page, offset))
+        return jsonify(rows)
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    except sqlite3.Error as e:
+        return jsonify({"error": str(e)}), 500
+
+@app.route('/gps', methods=['POST'])
+@token_required()
+def add_gps():
+    data = request.json or {}
+    ok, msg = require_fields(data, ["vehicle_id", "latitude", "longitude"])
+    if not ok:
+        return jsonify({"error": msg}), 400
+    try:
+        lat, lon = parse_coordinates(data)
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    try:
+        if not ingest_gps_rows([(data['vehicle_id'], lat, lon, None)]):
+            return jsonify({"message": "GPS location queued"}), 202
+        return jsonify({"message": "GPS location added"}), 201
+    except QueueFullError as e:
+        return queue_full_response(e)
+    except sqlite3.Error as e:
+        return jsonify({"error": str(e)}), 500
+
+@app.route('/gps/batch', methods=['POST'])
+@token_required()
+def add_gps_batch():
+    data = request.json
+    points = data.get("points") if isinstance(data, dict) else data
+    if not isinstance(points, list) or not points:
+        return jsonify({"error": "Expected a non-empty list of points"}), 400
+    if len(points) > GPS_BATCH_MAX:
+        return jsonify({"error": f"Batch too large (max {GPS_BATCH_MAX} points)"}), 413
+
+    results = []
+    rows = []
+    for index, point in enumerate(points):
+        if not isinstance(point, dict):
+            results.append({"index": index, "status": "rejected", "error": "Point must be an object"})
+            continue
+        ok, msg = require_fields(point, ["vehicle_id", "latitude", "longitude"])
+        if ok:
+            try:
+                lat, lon = parse_coordinates(point)
+                ts = parse_timestamp(point.get("timestamp"))
+            except ValueError as e:
+                ok, msg = False, str(e)
+        if not ok:
+            results.append({"index": index, "status": "rejected", "error": msg})
+            continue
+        rows.append((point['vehicle_id'], lat, lon, ts))
+        results.append({"index": index, "status": "accepted"})
+
+    committed = True
+    try:
+        if rows:
+            committed = ingest_gps_rows(rows)
+    except QueueFullError as e:
+        return queue_full_response(e)
+    except sqlite3.Error as e:
+        return jsonify({"error": str(e)}), 500
+
+    accepted = len(rows)
+    if accepted == len(points):
+        status = 201 if committed else 202
+    else:
+        status = 207 if accepted else 400
+    return jsonify({
+        "accepted": accepted,
+        "rejected": len(points) - accepted,
+        "results": results
+    }), status
+
+@app.route('/gps/ingest/stats', methods=['GET'])
+@token_required(require_admin=True)
+def get_gps_ingest_stats():
+    if gps_ingest_queue is None:
+        return jsonify({"mode": GPS_INGEST_MODE})
+    return jsonify(dict(gps_ingest_queue.snapshot(), mode=GPS_INGEST_MODE))
+
+EARTH_RADIUS_M = 6371008.8
+
+# -------------------------------
+# GPS retention and rollups
+# -------------------------------
+# Raw points older than GPS_RETENTION_DAYS are folded into one row per vehicle and
+# minute in gps_rollups, then deleted. Work happens in small chunks, each in its own
+# short write transaction, so ingest never waits long for the lock.
+#
+# Only one run happens at a time per deployment: a run first claims the
+# "gps-retention" row in job_leases and renews it inside every chunk's transaction,
+# so the background loop (started in each worker when GPS_RETENTION_INTERVAL_S > 0),
+# `flask gps-retention` and POST /gps/retention/run all serialize on it and the others
+# skip. Deployments that would rather schedule it set GPS_RETENTION_INTERVAL_S=0 and
+# run `flask gps-retention` from cron; the lease keeps an overlapping cron run out too.
+# Each rollup keeps its last raw point, so a run picks up a vehicle's distance where
+# the previous run stopped.
+ROLLUP_UPSERT_SQL = """
+    INSERT INTO gps_rollups (vehicle_id, bucket, point_count, latitude, longitude,
+                             min_lat, max_lat, min_lon, max_lon, distance_m, first_ts, last_ts,
+                             last_lat, last_lon)
+    VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+    ON CONFLICT(vehicle_id, bucket) DO UPDATE SET
+        latitude = (gps_rollups.latitude * gps_rollups.point_count + excluded.latitude * excluded.point_count)
+                   / (gps_rollups.point_count + excluded.point_count),
+        longitude = (gps_rollups.longitude * gps_rollups.point_count + excluded.longitude * excluded.point_count)
+                    / (gps_rollups.point_count + excluded.point_count),
+        point_count = gps_rollups.point_count + excluded.point_count,
+        min_lat = MIN(gps_rollups.min_lat, excluded.min_lat),
+        max_lat = MAX(gps_rollups.max_lat, excluded.max_lat),
+        min_lon = MIN(gps_rollups.min_lon, excluded.min_lon),
+        max_lon = MAX(gps_rollups.max_lon, excluded.max_lon),
+        distance_m = gps_rollups.distance_m + excluded.distance_m,
+        first_ts = MIN(gps_rollups.first_ts, excluded.first_ts),
+        last_lat = CASE WHEN excluded.last_ts >= gps_rollups.last_ts THEN excluded.last_lat
+                        ELSE gps_rollups.last_lat END,
+        last_lon = CASE WHEN excluded.last_ts >= gps_rollups.last_ts THEN excluded.last_lon
+                        ELSE gps_rollups.last_lon END,
+        last_ts = MAX(gps_rollups.last_ts, excluded.last_ts)
+"""
+
+RETENTION_LEASE = "gps-retention"
+
+def haversine_m(lat1, lon1, lat2, lon2):
+    p1, p2 = math.radians(lat1), math.radians(lat2)
+    dp, dl = p2 - p1, math.radians(lon2 - lon1)
+    a = math.sin(dp / 2) ** 2 + math.cos(p1) * math.cos(p2) * math.sin(dl / 2) ** 2
+    return 2 * EARTH_RADIUS_M * math.asin(min(1.0, math.sqrt(a)))
+
+def retention_cutoff(now=None):
+    """Timestamp before which raw points are compacted, or None when retention is off."""
+    if GPS_RETENTION_DAYS <= 0:
+        return None
+    now = now or datetime.datetime.now(datetime.UTC)
+    return (now - datetime.timedelta(days=GPS_RETENTION_DAYS)).strftime("%Y-%m-%d %H:%M:%S")
+
+def build_rollups(rows, last_points):
+    """Fold (location_id, vehicle_id, lat, lon, ts) rows, sorted by time, into per-minute rollups.
+
+    `last_points` carries each vehicle's previous point between chunks so distance
+    is continuous across chunk boundaries. Rows are in time order, so the point seen
+    last in a bucket is that bucket's last point.
+    """
+    buckets = {}
+    for _, vehicle_id, lat, lon, ts in rows:
+        key = (vehicle_id, ts[:16] + ":00")
+        b = buckets.get(key)
+        if b is None:
+            b = buckets[key] = {"n": 0, "lat": 0.0, "lon": 0.0, "min_lat": lat, "max_lat": lat,
+                                "min_lon": lon, "max_lon": lon, "dist": 0.0, "first": ts, "last": ts}
+        b["n"] += 1
+        b["lat"] += lat
+        b["lon"] += lon
+        b["min_lat"], b["max_lat"] = min(b["min_lat"], lat), max(b["max_lat"], lat)
+        b["min_lon"], b["max_lon"] = min(b["min_lon"], lon), max(b["max_lon"], lon)
+        b["first"], b["last"] = min(b["first"], ts), max(b["last"], ts)
+        b["last_point"] = (lat, lon)
+        prev = last_points.get(vehicle_id)
+        if prev is not None:
+            b["dist"] += haversine_m(prev[0], prev[1], lat, lon)
+        last_points[vehicle_id] = (lat, lon)
+    return [(vehicle_id, bucket, b["n"], b["lat"] / b["n"], b["lon"] / b["n"], b["min_lat"], b["max_lat"],
+             b["min_lon"], b["max_lon"], b["dist"], b["first"], b["last"], *b["last_point"])
+            for (vehicle_id, bucket), b in buckets.items()]
+
+def take_lease(conn, name, holder, ttl):
+    """Claim or renew lease `name` for `holder` in the caller's transaction; True if held."""
+    now = time.time()
+    conn.execute("""
+        INSERT INTO job_leases(name, holder, expires_at) VALUES(?, ?, ?)
+        ON CONFLICT(name) DO UPDATE SET holder = excluded.holder, expires_at = excluded.expires_at
+        WHERE job_leases.holder = excluded.holder OR job_leases.expires_at <= ?
+    """, (name, holder, now + ttl, now))
+    row = conn.execute("SELECT holder FROM job_leases WHERE name=?", (name,)).fetchone()
+    return row is not None and row[0] == holder
+
+def seed_last_points(conn, rows, last_points):
+    """Start each vehicle new to this run at the last point already folded into a rollup."""
+    for _, vehicle_id, _, _, ts in rows:
+        if vehicle_id in last_points:
+            continue
+        prev = conn.execute("""
+            SELECT last_lat, last_lon FROM gps_rollups
+            WHERE vehicle_id = ? AND last_ts <= ? AND last_lat IS NOT NULL
+            ORDER BY bucket DESC LIMIT 1
+        """, (vehicle_id, ts)).fetchone()
+        if prev is not None:
+            last_points[vehicle_id] = (prev[0], prev[1])
+
+def run_gps_retention(max_chunks=None):
+    """Compact raw GPS rows older than the retention window; returns a summary dict.
+
+    Also prunes the access change log. Returns with "skipped" set when another
+    process holds the retention lease.
+    """
+    cutoff = retention_cutoff()
+    summary = {"cutoff": cutoff, "compacted": 0, "chunks": 0}
+    if cutoff is None and ACCESS_CHANGES_RETENTION_HOURS <= 0:
+        return summary
+    conn = open_db_connection()
+    conn.isolation_level = None
+    holder = secrets.token_hex(8)
+    last_points = {}
+    try:
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            owned = take_lease(conn, RETENTION_LEASE, holder, GPS_RETENTION_LEASE_S)
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+        if not owned:
+            summary["skipped"] = "another retention run holds the lease"
+            return summary
+        summary["access_changes_pruned"] = prune_access_changes(conn)
+        if cutoff is None:
+            return summary
+        while max_chunks is None or summary["chunks"] < max_chunks:
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                if not take_lease(conn, RETENTION_LEASE, holder, GPS_RETENTION_LEASE_S):
+                    # stalled past the lease and someone else took over; leave the rest to them
+                    conn.execute("ROLLBACK")
+                    summary["skipped"] = "retention lease lost"
+                    break
+                rows = conn.execute("""
+                    SELECT location_id, vehicle_id, latitude, longitude, timestamp
+                    FROM gps_locations
+                    WHERE timestamp < ?
+                    ORDER BY timestamp, location_id
+                    LIMIT ?
+                """, (cutoff, GPS_RETENTION_CHUNK)).fetchall()
+                if rows:
+                    rows = [tuple(r) for r in rows]
+                    seed_last_points(conn, rows, last_points)
+                    conn.executemany(ROLLUP_UPSERT_SQL, build_rollups(rows, last_points))
+                    conn.executemany("DELETE FROM gps_locations WHERE location_id=?",
+                                     [(r[0],) for r in rows])
+                conn.execute("COMMIT")
+            except Exception:
+                conn.execute("ROLLBACK")
+                raise
+            if not rows:
+                break
+            summary["compacted"] += len(rows)
+            summary["chunks"] += 1
+            # give writers a window between chunks
+            time.sleep(GPS_RETENTION_PAUSE_MS / 1000.0)
+    finally:
+        try:
+            conn.execute("DELETE FROM job_leases WHERE name=? AND holder=?", (RETENTION_LEASE, holder))
+        except sqlite3.Error:
+            app.logger.exception("Could not release the GPS retention lease")
+        conn.close()
+    return summary
+
+_retention_thread = {"thread": None, "pid": None}
+
+def _retention_loop():
+    while True:
+        try:
+            summary = run_gps_retention()
+            if summary["compacted"]:
+                app.logger.info("GPS retention compacted %d points in %d chunks",
+                                summary["compacted"], summary["chunks"])
+        except sqlite3.Error:
+            app.logger.exception("GPS retention run failed")
+        time.sleep(GPS_RETENTION_INTERVAL_S)
+
+@app.before_request
+def ensure_retention_thread():
+    if GPS_RETENTION_INTERVAL_S <= 0:
+        return
+    thread = _retention_thread["thread"]
+    if thread is not None and thread.is_alive() and _retention_thread["pid"] == os.getpid():
+        return
+    _retention_thread["pid"] = os.getpid()
+    _retention_thread["thread"] = threading.Thread(target=_retention_loop, name="gps-retention", daemon=True)
+    _retention_thread["thread"].start()
+
+@app.cli.command("gps-retention")
+def gps_retention_command():
+    """Compact raw GPS points older than GPS_RETENTION_DAYS into per-minute rollups.
+
+    Safe to schedule from cron; a run that finds the retention lease taken does nothing.
+    """
+    startup()
+    print(json.dumps(run_gps_retention()))
+
+@app.route('/gps/retention/run', methods=['POST'])
+@token_required(require_admin=True)
+def run_gps_retention_route():
+    try:
+        max_chunks = request.args.get("max_chunks")
+        summary = run_gps_retention(int(max_chunks) if max_chunks else None)
+        if summary.get("skipped") and not summary["chunks"]:
+            return jsonify(summary), 409
+        return jsonify(summary)
+    except ValueError:
+        return jsonify({"error": "max_chunks must be an integer"}), 400
+    except sqlite3.Error as e:
+        return jsonify({"error": str(e)}), 500
+
+# -------------------------------
+# Nearby vehicles and stops
+# -------------------------------
+# Both searches use SQLite R*Tree indexes (vehicle_position_rtree, stop_rtree) that
+# triggers keep in step with vehicle_latest_position and route_stops. A k-nearest
+# query grows a bounding box until it holds k candidates, then re-checks once with a
+# box as wide as the k-th exact distance so nothing closer is missed.
+NEARBY_VEHICLES_SQL = """
+    SELECT vehicles.vehicle_id, vehicles.vehicle_number, vehicles.route_id,
+           vehicle_latest_position.latitude, vehicle_latest_position.longitude,
+           vehicle_latest_position.timestamp
+    FROM vehicle_position_rtree
+    JOIN vehicle_latest_position ON vehicle_latest_position.vehicle_id = vehicle_position_rtree.vehicle_id
+    JOIN vehicles ON vehicles.vehicle_id = vehicle_position_rtree.vehicle_id
+    WHERE vehicle_position_rtree.min_lat <= ? AND vehicle_position_rtree.max_lat >= ?
+      AND vehicle_position_rtree.min_lon <= ? AND vehicle_position_rtree.max_lon >= ?
+"""
+
+NEARBY_STOPS_SQL = """
+    SELECT route_stops.stop_id, route_stops.route_id, route_stops.stop_name, route_stops.stop_number,
+           route_stops.latitude, route_stops.longitude
+    FROM stop_rtree
+    JOIN route_stops ON route_stops.stop_id = stop_rtree.stop_id
+    WHERE stop_rtree.min_lat <= ? AND stop_rtree.max_lat >= ?
+      AND stop_rtree.min_lon <= ? AND stop_rtree.max_lon >= ?
+"""
+
+METRES_PER_DEGREE = math.pi / 180.0 * EARTH_RADIUS_M
+
+def nearest(sql, lat, lon, k, max_radius_m):
+    def candidates(radius_m):
+        dlat = radius_m / METRES_PER_DEGREE
+        dlon = radius_m / (METRES_PER_DEGREE * max(math.cos(math.radians(lat)), 1e-6))
+        rows = query_fetchall(sql, (lat + dlat, lat - dlat, lon + dlon, lon - dlon))
+        for row in rows:
+            row["distance_m"] = round(haversine_m(lat, lon, row["latitude"], row["longitude"]), 1)
+        rows = [r for r in rows if r["distance_m"] <= max_radius_m]
+        rows.sort(key=lambda r: r["distance_m"])
+        return rows
+
+    radius = min(NEARBY_START_RADIUS_M, max_radius_m)
+    while True:
+        rows = candidates(radius)
+        if len(rows) >= k or radius >= max_radius_m:
+            break
+        radius = min(radius * 4, max_radius_m)
+    if len(rows) >= k and rows[k - 1]["distance_m"] > radius:
+        # a box of half-width r only guarantees completeness up to distance r
+        rows = candidates(rows[k - 1]["distance_m"])
+    return rows[:k]
+
+@app.route('/nearby', methods=['GET'])
+@token_required()
+def get_nearby():
+    """k nearest vehicles and/or stops to ?lat=&lon=, e.g. "which bus is closest to me"."""
+    try:
+        lat, lon = parse_coordinates({"latitude": request.args.get("lat"), "longitude": request.args.get("lon")})
+        k = min(max(int(request.args.get("k", 5)), 1), 100)
+        max_radius_m = float(request.args.get("max_radius_m", NEARBY_MAX_RADIUS_M))
+        if not math.isfinite(max_radius_m) or max_radius_m <= 0:
+            raise ValueError("max_radius_m must be a positive number of metres")
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    kind = request.args.get("type", "all")
+    if kind not in ("all", "vehicles", "stops"):
+        return jsonify({"error": "type must be 'all', 'vehicles' or 'stops'"}), 400
+    try:
+        result = {}
+        if kind in ("all", "vehicles"):
+            result["vehicles"] = nearest(NEARBY_VEHICLES_SQL, lat, lon, k, max_radius_m)
+        if kind in ("all", "stops"):
+            result["stops"] = nearest(NEARBY_STOPS_SQL, lat, lon, k, max_radius_m)
+        return jsonify(result)
+    except sqlite3.Error as e:
+        return jsonify({"error": str(e)}), 500
+
+# -------------------------------
+# Stop ETA prediction
+# -------------------------------
+# Training walks each vehicle's recent raw GPS history, detects arrivals at the
+# stops of its route (within ETA_ARRIVAL_RADIUS_M) and records the arrival-to-
+# arrival time between consecutive stops, bucketed by UTC hour of day. Hour -1 holds
+# the all-day average. Serving only reads the precomputed rows for one route.
+SEGMENT_TIMES_UPSERT_SQL = """
+    INSERT OR REPLACE INTO segment_travel_times
+        (route_id, from_stop_id, to_stop_id, hour, avg_seconds, samples, updated_at)
+    VALUES (?, ?, ?, ?, ?, ?, CURRENT_TIMESTAMP)
+"""
+
+def route_stops_with_coords(conn, route_id):
+    rows = conn.execute("""
+        SELECT stop_id, stop_name, stop_number, latitude, longitude
+        FROM route_stops
+        WHERE route_id=? AND latitude IS NOT NULL AND longitude IS NOT NULL
+        ORDER BY stop_number
+    """, (route_id,)).fetchall()
+    return [dict(r) for r in rows]
+
+def detect_stop_arrivals(points, stops):
+    """Yield (stop_index, arrival datetime) for each time a vehicle enters a stop's radius."""
+    current = None
+    for lat, lon, ts in points:
+        inside = None
+        for index, stop in enumerate(stops):
+            if haversine_m(lat, lon, stop["latitude"], stop["longitude"]) <= ETA_ARRIVAL_RADIUS_M:
+                inside = index
+                break
+        if inside is not None and inside != current:
+            yield inside, datetime.datetime.fromisoformat(ts)
+        current = inside
+
+def train_segment_times(route_ids=None):
+    """Rebuild segment_travel_times from the last ETA_TRAINING_DAYS of raw GPS points."""
+    conn = open_db_connection()
+    since = (datetime.datetime.now(datetime.UTC) - datetime.timedelta(days=ETA_TRAINING_DAYS)).strftime("%Y-%m-%d %H:%M:%S")
+    summary = {"routes": 0, "segments": 0, "samples": 0}
+    try:
+        if route_ids is None:
+            route_ids = [r[0] for r in conn.execute("SELECT route_id FROM routes")]
+        for route_id in route_ids:
+            stops = route_stops_with_coords(conn, route_id)
+            if len(stops) < 2:
+                continue
+            # (from_index, hour) -> [total_seconds, samples]
+            totals = collections.defaultdict(lambda: [0.0, 0])
+            vehicle_ids = [r[0] for r in conn.execute("SELECT vehicle_id FROM vehicles WHERE route_id=?", (route_id,))]
+            for vehicle_id in vehicle_ids:
+                points = conn.execute("""
+                    SELECT latitude, longitude, timestamp FROM gps_locations
+                    WHERE vehicle_id=? AND timestamp >= ?
+                    ORDER BY timestamp, location_id
+                """, (vehicle_id, since))
+                previous = None
+                for index, arrived in detect_stop_arrivals(points, stops):
+                    if previous is not None and index == previous[0] + 1:
+                        seconds = (arrived - previous[1]).total_seconds()
+                        if 0 < seconds <= ETA_MAX_SEGMENT_S:
+                            for hour in (previous[1].hour, -1):
+                                totals[(previous[0], hour)][0] += seconds
+                                totals[(previous[0], hour)][1] += 1
+                            summary["samples"] += 1
+                    previous = (index, arrived)
+            rows = [(route_id, stops[i]["stop_id"], stops[i + 1]["stop_id"], hour, total / count, count)
+                    for (i, hour), (total, count) in totals.items()]
+            with conn:
+                conn.execute("DELETE FROM segment_travel_times WHERE route_id=?", (route_id,))
+                conn.executemany(SEGMENT_TIMES_UPSERT_SQL, rows)
+            summary["routes"] += 1
+            summary["segments"] += len(rows)
+    finally:
+        conn.close()
+    return summary
+
+def project_onto_segment(lat, lon, a, b):
+    """Distance in metres from (lat, lon) to segment a-b and the fraction 0..1 along it."""
+    kx = math.cos(math.radians(lat)) * METRES_PER_DEGREE
+    px, py = lon * kx, lat * METRES_PER_DEGREE
+    ax, ay = a["longitude"] * kx, a["latitude"] * METRES_PER_DEGREE
+    bx, by = b["longitude"] * kx, b["latitude"] * METRES_PER_DEGREE
+    dx, dy = bx - ax, by - ay
+    seg_len2 = dx * dx + dy * dy
+    t = 0.0 if seg_len2 == 0 else max(0.0, min(1.0, ((px - ax) * dx + (py - ay) * dy) / seg_len2))
+    return math.hypot(px - (ax + t * dx), py - (ay + t * dy)), t
+
+@app.route('/routes/<int:id>/eta', methods=['GET'])
+@token_required()
+def get_route_eta(id):
+    """Predicted arrival of each active vehicle of a route at each downstream stop."""
+    now = datetime.datetime.now(datetime.UTC)
+    try:
+        conn = get_read_db()
+        stops = route_stops_with_coords(conn, id)
+        if len(stops) < 2:
+            return jsonify({"error": "Route needs at least two stops with coordinates"}), 404
+        learned = {}
+        for row in query_fetchall("""
+            SELECT from_stop_id, hour, avg_seconds FROM segment_travel_times
+            WHERE route_id=? AND hour IN (?, -1)
+        """, (id, now.hour)):
+            # the current hour's average wins over the all-day one
+            if row["hour"] != -1 or row["from_stop_id"] not in learned:
+                learned[row["from_stop_id"]] = row["avg_seconds"]
+        segment_seconds = []
+        for a, b in zip(stops, stops[1:]):
+            fallback = haversine_m(a["latitude"], a["longitude"], b["latitude"], b["longitude"]) / (ETA_DEFAULT_SPEED_KMH / 3.6)
+            segment_seconds.append(learned.get(a["stop_id"], fallback))
+
+        fresh_after = (now - datetime.timedelta(seconds=ETA_STALE_S)).strftime("%Y-%m-%d %H:%M:%S")
+        vehicles = [v for v in get_fleet_positions()
+                    if v["route_id"] == id and v["latitude"] is not None and v["timestamp"] >= fresh_after]
+
+        etas = {stop["stop_id"]: [] for stop in stops}
+        for vehicle in vehicles:
+            lat, lon = float(vehicle["latitude"]), float(vehicle["longitude"])
+            best = min(((project_onto_segment(lat, lon, stops[i], stops[i + 1]), i) for i in range(len(stops) - 1)),
+                       key=lambda item: item[0][0])
+            (_, fraction), segment = best
+            seconds = (1.0 - fraction) * segment_seconds[segment]
+            for j in range(segment + 1, len(stops)):
+                etas[stops[j]["stop_id"]].append({
+                    "vehicle_id": vehicle["vehicle_id"],
+                    "vehicle_number": vehicle["vehicle_number"],
+                    "eta_seconds": int(round(seconds)),
+                    "eta_at": (now + datetime.timedelta(seconds=seconds)).strftime("%Y-%m-%d %H:%M:%S"),
+                })
+                if j < len(stops) - 1:
+                    seconds += segment_seconds[j]
+
+        return jsonify({
+            "route_id": id,
+            "generated_at": now.strftime("%Y-%m-%d %H:%M:%S"),
+            "stops": [dict(stop_id=s["stop_id"], stop_name=s["stop_name"], stop_number=s["stop_number"],
+                           etas=sorted(etas[s["stop_id"]], key=lambda e: e["eta_seconds"])) for s in stops],
+        })
+    except sqlite3.Error as e:
+        return jsonify({"error": str(e)}), 500
+
+@app.route('/eta/train', methods=['POST'])
+@token_required(require_admin=True)
+def run_eta_training():
+    try:
+        route_id = request.args.get("route_id")
+        return jsonify(train_segment_times([int(route_id)] if route_id else None))
+    except ValueError:
+        return jsonify({"error": "route_id must be an integer"}), 400
+    except sqlite3.Error as e:
+        return jsonify({"error": str(e)}), 500
+
+@app.cli.command("eta-train")
+def eta_train_command():
+    """Rebuild per-segment travel times used by /routes/<id>/eta."""
+    startup()
+    print(json.dumps(train_segment_times()))
+
+# -------------------------------
+# Vehicle track history
+# -------------------------------
+
+def simplify_track(points, tolerance_m):
+    """Douglas-Peucker simplification of [(lat, lon, ...), ...] with a tolerance in metres.
+
+    Points are projected onto a local equirectangular plane, which is accurate to well
+    under a metre over the extent of a campus or city route.
+    """
+    if tolerance_m <= 0 or len(points) < 3:
+        return list(points)
+    lat0 = math.radians(sum(p[0] for p in points) / len(points))
+    kx = math.cos(lat0) * math.pi / 180.0 * EARTH_RADIUS_M
+    ky = math.pi / 180.0 * EARTH_RADIUS_M
+    xy = [(p[1] * kx, p[0] * ky) for p in points]
+
+    keep = [False] * len(points)
+    keep[0] = keep[-1] = True
+    stack = [(0, len(points) - 1)]
+    while stack:
+        first, last = stack.pop()
+        ax, ay = xy[first]
+        bx, by = xy[last]
+        dx, dy = bx - ax, by - ay
+        seg_len2 = dx * dx + dy * dy
+        max_dist, index = 0.0, None
+        for i in range(first + 1, last):
+            px, py = xy[i]
+            if seg_len2 == 0:
+                dist = math.hypot(px - ax, py - ay)
+            else:
+                t = max(0.0, min(1.0, ((px - ax) * dx + (py - ay) * dy) / seg_len2))
+                dist = math.hypot(px - (ax + t * dx), py - (ay + t * dy))
+            if dist > max_dist:
+                max_dist, index = dist, i
+        if index is not None and max_dist > tolerance_m:
+            keep[index] = True
+            stack.append((first, index))
+            stack.append((index, last))
+    return [p for p, k in zip(points, keep) if k]
+
+def encode_polyline(coords, precision=5):
+    """Encode [(lat, lon), ...] in the Google encoded polyline format."""
+    factor = 10 ** precision
+    out = []
+    prev_lat = prev_lon = 0
+    for lat, lon in coords:
+        lat_i, lon_i = int(round(lat * factor)), int(round(lon * factor))
+        for delta in (lat_i - prev_lat, lon_i - prev_lon):
+            value = ~(delta << 1) if delta < 0 else delta << 1
+            while value >= 0x20:
+                out.append(chr((0x20 | (value & 0x1f)) + 63))
+                value >>= 5
+            out.append(chr(value + 63))
+        prev_lat, prev_lon = lat_i, lon_i
+    return "".join(out)
+
+def parse_time_window(default_hours=24):
+    """Read ?from=&to= (ISO-8601 or epoch seconds); defaults to the last `default_hours`."""
+    end = parse_timestamp(request.args.get("to")) or utc_now_str()
+    start = parse_timestamp(request.args.get("from"))
+    if start is None:
+        end_dt = datetime.datetime.strptime(end, "%Y-%m-%d %H:%M:%S")
+        start = (end_dt - datetime.timedelta(hours=default_hours)).strftime("%Y-%m-%d %H:%M:%S")
+    if start > end:
+        raise ValueError("'from' must not be after 'to'")
+    return start, end
+
+TRACK_SQL = """
+    SELECT latitude, longitude, timestamp
+    FROM gps_locations
+    WHERE vehicle_id=? AND timestamp >= ? AND timestamp <= ?
+    ORDER BY timestamp, location_id
+"""
+
+# windows reaching past the retention cutoff also read the per-minute rollups
+TRACK_WITH_ROLLUPS_SQL = """
+    SELECT latitude, longitude, timestamp FROM (
+        SELECT latitude, longitude, bucket AS timestamp, 0 AS location_id
+        FROM gps_rollups
+        WHERE vehicle_id=? AND bucket >= ? AND bucket <= ?
+        UNION ALL
+        SELECT latitude, longitude, timestamp, location_id
+        FROM gps_locations
+        WHERE vehicle_id=? AND timestamp >= ? AND timestamp <= ?
+    )
+    ORDER BY timestamp, location_id
+"""
+
+def track_query(vehicle_id, start, end):
+    cutoff = retention_cutoff()
+    if cutoff is not None and start < cutoff:
+        # a rollup bucket is labelled with the start of its minute
+        return TRACK_WITH_ROLLUPS_SQL, (vehicle_id, start[:16] + ":00", end, vehicle_id, start, end)
+    return TRACK_SQL, (vehicle_id, start, end)
+
+@app.route('/vehicles/<int:id>/track', methods=['GET'])
+@token_required()
+def get_vehicle_track(id):
+    """Points of one vehicle between ?from= and ?to=, oldest first.
+
+    ?tolerance=<metres> applies Douglas-Peucker simplification and ?format=polyline
+    returns an encoded polyline instead of a point list. Unsimplified JSON is
+    streamed straight from the cursor.
+    """
+    try:
+        start, end = parse_time_window()
+        tolerance = float(request.args.get("tolerance", 0) or 0)
+        if tolerance < 0 or math.isnan(tolerance):
+            raise ValueError("tolerance must be a non-negative number of metres")
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    fmt = request.args.get("format", "json")
+    if fmt not in ("json", "polyline"):
+        return jsonify({"error": "format must be 'json' or 'polyline'"}), 400
+
+    try:
+        if not query_fetchone("SELECT vehicle_id FROM vehicles WHERE vehicle_id=?", (id,)):
+            return jsonify({"error": "Vehicle not found"}), 404
+
+        sql, params = track_query(id, start, end)
+        if tolerance == 0 and fmt == "json":
+            cur = get_read_db().execute(sql, params)
+
+            def generate():
+                try:
+                    yield '{"vehicle_id":%d,"from":%s,"to":%s,"points":[' % (id, json.dumps(start), json.dumps(end))
+                    sep = ""
+                    for lat, lon, ts in cur:
+                        yield sep + json.dumps({"latitude": lat, "longitude": lon, "timestamp": ts},
+                                               separators=(",", ":"))
+                        sep = ","
+                    yield "]}"
+                finally:
+                    cur.close()
+
+            return Response(stream_with_context(generate()), mimetype="application/json")
+
+        rows = query_fetchall(sql + " LIMIT ?", params + (TRACK_MAX_POINTS + 1,))
+        if len(rows) > TRACK_MAX_POINTS:
+            return jsonify({"error": f"Window has more than {TRACK_MAX_POINTS} points; narrow it"}), 413
+        points = [(r["latitude"], r["longitude"], r["timestamp"]) for r in rows]
+        simplified = simplify_track(points, tolerance)
+        result = {"vehicle_id": id, "from": start, "to": end,
+                  "raw_points": len(points), "points_returned": len(simplified)}
+        if fmt == "polyline":
+            result["polyline"] = encode_polyline([(p[0], p[1]) for p in simplified])
+            result["timestamps"] = [p[2] for p in simplified]
+        else:
+            result["points"] = [{"latitude": p[0], "longitude": p[1], "timestamp": p[2]} for p in simplified]
+        return jsonify(result)
+    except sqlite3.Error as e:
+        return jsonify({"error": str(e)}), 500
+
+# -------------------------------
+# Cards
+# -------------------------------
+@app.route('/cards', methods=['GET'])
+@token_required(require_admin=True)
+def get_cards():
+    select_sql = """
+        SELECT cards.*, users.name
+        FROM cards
+        LEFT JOIN users ON cards.user_id = users.user_id
+    """
+    try:
+        if "cursor" in request.args:
+            # cards have no timestamp, so the key is the card id alone
+            page = cursor_page(select_sql + " {where} ORDER BY {order}", ["cards.card_id"], ["card_id"])
+            return jsonify(page)
+        offset, per_page = parse_pagination()
+        rows = query_fetchall(select_sql + """
+            LIMIT ? OFFSET ?
+        """, (per_page, offset))
+        return jsonify(rows)
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    except sqlite3.Error as e:
+        return jsonify({"error": str(e)}), 500
+
+@app.route('/cards', methods=['POST'])
+@token_required(require_admin=True)
+def add_card():
+    data = request.json or {}
+    ok, msg = require_fields(data, ["card_uid", "user_id"])
+    if not ok:
+        return jsonify({"error": msg}), 400
+    try:
+        query_commit("INSERT INTO cards(card_uid, user_id, status) VALUES(?, ?, ?)",
+                     (data['card_uid'], data['user_id'], data.get('status', 'active')))
+        return jsonify({"message": "Card added"}), 201
+    except sqlite3.Error as e:
+        return jsonify({"error": str(e)}), 500
+
+@app.route('/cards/<int:id>', methods=['PUT'])
+@token_required(require_admin=True)
+def update_card(id):
+    data = request.json or {}
+    ok, msg = require_fields(data, ["card_uid", "user_id", "status"])
+    if not ok:
+        return jsonify({"error": msg}), 400
+    try:
+        query_commit("UPDATE cards SET card_uid=?, user_id=?, status=? WHERE card_id=?",
+                     (data['card_uid'], data['user_id'], data['status'], id))
+        return jsonify({"message": "Card updated"})
+    except sqlite3.Error as e:
+        return jsonify({"error": str(e)}), 500
+
+@app.route('/cards/<int:id>', methods=['DELETE'])
+@token_required(require_admin=True)
+def delete_card(id):
+    try:
+        query_commit("DELETE FROM access_logs WHERE card_id=?", (id,))
+        query_commit("DELETE FROM cards WHERE card_id=?", (id,))
+        return jsonify({"message": "Card deleted"})
+    except sqlite3.Error as e:
+        return jsonify({"error": str(e)}), 500
+
+# -------------------------------
 # Vehicles
 # -------------------------------
 @app.route('/vehicles', methods=['GET'])
@@ -1109,6 +4308,7 @@ def add_vehicle():
     try:
         query_commit("INSERT INTO vehicles(vehicle_number, driver_name, capacity, route_id) VALUES(?, ?, ?, ?)",
                      (data['vehicle_number'], data['driver_name'], data['capacity'], data.get('route_id')))
+        invalidate_fleet_positions()
         return jsonify({"message": "Vehicle added"}), 201
     except sqlite3.Error as e:
         return jsonify({"error": str(e)}), 500
@@ -1123,6 +4323,7 @@ def update_vehicle(id):
     try:
         query_commit("UPDATE vehicles SET vehicle_number=?, driver_name=?, capacity=?, route_id=? WHERE vehicle_id=?",
                      (data['vehicle_number'], data['driver_name'], data['capacity'], data.get('route_id'), id))
+        invalidate_fleet_positions()
         return jsonify({"message": "Vehicle updated"})
     except sqlite3.Error as e:
         return jsonify({"error": str(e)}), 500
@@ -1132,15 +4333,563 @@ def update_vehicle(id):
 def delete_vehicle(id):
     try:
         query_commit("DELETE FROM gps_locations WHERE vehicle_id=?", (id,))
+        query_commit("DELETE FROM vehicle_latest_position WHERE vehicle_id=?", (id,))
+        query_commit("DELETE FROM gps_rollups WHERE vehicle_id=?", (id,))
+        query_commit("DELETE FROM vehicle_occupancy WHERE vehicle_id=?", (id,))
         query_commit("DELETE FROM vehicles WHERE vehicle_id=?", (id,))
+        invalidate_fleet_positions()
         return jsonify({"message": "Vehicle deleted successfully"})
     except sqlite3.Error as e:
         return jsonify({"error": str(e)}), 500
 
+# -------------------------------
+# Exports
+# -------------------------------
+EXPORT_CHUNK_BYTES = 64 * 1024
+
+def export_filters(column_map):
+    """Build WHERE clauses from ?from=&to= and the id filters named in `column_map`."""
+    clauses, params = [], []
+    start = parse_timestamp(request.args.get("from"))
+    end = parse_timestamp(request.args.get("to"))
+    if start:
+        clauses.append(f"{column_map['timestamp']} >= ?")
+        params.append(start)
+    if end:
+        clauses.append(f"{column_map['timestamp']} <= ?")
+        params.append(end)
+    for arg, column in column_map.items():
+        if arg == "timestamp" or request.args.get(arg) in (None, ""):
+            continue
+        try:
+            params.append(int(request.args[arg]))
+        except ValueError:
+            raise ValueError(f"{arg} must be an integer")
+        clauses.append(f"{column} = ?")
+    return ("WHERE " + " AND ".join(clauses)) if clauses else "", tuple(params)
+
+def export_response(sql, params, name):
+    """Stream `sql` rows as NDJSON (default) or CSV, optionally gzip-encoded.
+
+    Rows come straight off the SQLite cursor and are flushed in ~64 KiB chunks, so
+    memory stays flat and the first bytes leave before the query finishes.
+    """
+    fmt = request.args.get("format", "ndjson")
+    if fmt not in ("ndjson", "csv"):
+        return jsonify({"error": "format must be 'ndjson' or 'csv'"}), 400
+    use_gzip = request.args.get("gzip", "").lower() in ("1", "true", "yes")
+    cur = get_read_db().execute(sql, params)
+    columns = [d[0] for d in cur.description]
+
+    def encode_rows():
+        buf = io.StringIO()
+        writer = csv.writer(buf) if fmt == "csv" else None
+        if writer:
+            writer.writerow(columns)
+        for row in cur:
+            if writer:
+                writer.writerow(row)
+            else:
+                buf.write(json.dumps(dict(zip(columns, row)), separators=(",", ":")))
+                buf.write("\n")
+            if buf.tell() >= EXPORT_CHUNK_BYTES:
+                yield buf.getvalue().encode("utf-8")
+                buf.seek(0)
+                buf.truncate()
+        if buf.tell():
+            yield buf.getvalue().encode("utf-8")
+
+    def generate():
+        try:
+            if not use_gzip:
+                yield from encode_rows()
+                return
+            compressor = zlib.compressobj(6, zlib.DEFLATED, 31)  # wbits=31 -> gzip container
+            for chunk in encode_rows():
+                out = compressor.compress(chunk)
+                if out:
+                    yield out
+            yield compressor.flush()
+        finally:
+            cur.close()
+
+    mimetype = "text/csv" if fmt == "csv" else "application/x-ndjson"
+    headers = {"Content-Disposition": f"attachment; filename={name}.{fmt}"}
+    if use_gzip:
+        headers["Content-Encoding"] = "gzip"
+    return Response(stream_with_context(generate()), mimetype=mimetype, headers=headers)
+
+@app.route('/export/access_logs', methods=['GET'])
+@token_required(require_admin=True)
+def export_access_logs():
+    try:
+        where, params = export_filters({"timestamp": "access_logs.timestamp",
+                                        "user_id": "access_logs.user_id",
+                                        "card_id": "access_logs.card_id"})
+        return export_response(f"""
+            SELECT access_logs.log_id, access_logs.user_id, users.name, access_logs.card_id, cards.card_uid,
+                   access_logs.action_type, access_logs.area, access_logs.granted, access_logs.timestamp,
+                   user_categories.category_name
+            FROM access_logs
+            LEFT JOIN users ON access_logs.user_id = users.user_id
+            LEFT JOIN cards ON access_logs.card_id = cards.card_id
+            LEFT JOIN user_categories ON users.category_id = user_categories.category_id
+            {where}
+            ORDER BY access_logs.timestamp, access_logs.log_id
+        """, params, "access_logs")
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    except sqlite3.Error as e:
+        return jsonify({"error": str(e)}), 500
+
+@app.route('/export/gps', methods=['GET'])
+@token_required(require_admin=True)
+def export_gps():
+    """Raw GPS points only; minutes already compacted by retention are in gps_rollups."""
+    try:
+        where, params = export_filters({"timestamp": "gps_locations.timestamp",
+                                        "vehicle_id": "gps_locations.vehicle_id"})
+        return export_response(f"""
+            SELECT gps_locations.location_id, gps_locations.vehicle_id, vehicles.vehicle_number,
+                   gps_locations.latitude, gps_locations.longitude, gps_locations.timestamp
+            FROM gps_locations
+            LEFT JOIN vehicles ON gps_locations.vehicle_id = vehicles.vehicle_id
+            {where}
+            ORDER BY gps_locations.timestamp, gps_locations.location_id
+        """, params, "gps")
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    except sqlite3.Error as e:
+        return jsonify({"error": str(e)}), 500
+
+# -------------------------------
+# Auth diagnostics
+# -------------------------------
+@app.route('/auth/token_cache', methods=['GET'])
+@token_required(require_admin=True)
+def get_token_cache_stats():
+    return jsonify(token_cache.snapshot())
+
+@app.route('/auth/token_cache', methods=['DELETE'])
+@token_required(require_admin=True)
+def clear_token_cache():
+    """Empty the verified-claims cache; other workers follow within TOKEN_CACHE_GENERATION_TTL."""
+    try:
+        bump_generation("token_cache")
+    except sqlite3.Error as e:
+        return jsonify({"error": str(e)}), 500
+    token_cache.clear()
+    return jsonify({"message": "Token cache cleared"})
+
+@app.route('/auth/hash_pool', methods=['GET'])
+@token_required(require_admin=True)
+def get_hash_pool_stats():
+    return jsonify(password_hasher.snapshot())
+
+# -------------------------------
+# Database diagnostics
+# -------------------------------
+@app.route('/db/stats', methods=['GET'])
+@token_required(require_admin=True)
+def get_db_stats():
+    try:
+        conn = get_read_db()
+        journal_mode = conn.execute("PRAGMA journal_mode").fetchone()[0]
+        return jsonify({
+            "pool": db_pool.snapshot(),
+            "journal_mode": journal_mode,
+            "schema_version": get_schema_version(conn),
+            "pragmas": {
+                "synchronous": SQLITE_SYNCHRONOUS,
+                "cache_size": SQLITE_CACHE_SIZE,
+                "mmap_size": SQLITE_MMAP_SIZE,
+                "busy_timeout_ms": SQLITE_BUSY_TIMEOUT_MS
+            }
+        })
+    except sqlite3.Error as e:
+        return jsonify({"error": str(e)}), 500
+
+# -------------------------------
+# Bulk import
+# -------------------------------
+# `flask import-gps` and `flask import-roster` load large files directly instead of
+# one API request per row. Input is streamed and committed IMPORT_BATCH_ROWS records
+# at a time on a connection with synchronous=OFF. GPS indexes stay in place by default;
+# with --drop-indexes (offline loads only, since /gps, nearby and track queries fall
+# back to full scans meanwhile) they are dropped and rebuilt once at the end. Roster
+# passwords are hashed across a process pool. Every committed batch also records in
+# import_progress how many input records it consumed, so re-running the same command
+# on an unchanged file resumes after the last committed batch.
+IMPORT_BATCH_ROWS = int(os.getenv("IMPORT_BATCH_ROWS", "50000"))
+GPS_IMPORT_DEFERRED_INDEXES = {
+    "idx_gps_locations_vehicle_ts": "CREATE INDEX IF NOT EXISTS idx_gps_locations_vehicle_ts ON gps_locations(vehicle_id, timestamp)",
+    "idx_gps_locations_ts": "CREATE INDEX IF NOT EXISTS idx_gps_locations_ts ON gps_locations(timestamp)",
+}
+
+def import_source_key(path):
+    """Identify an input file by path, size and a hash of its head, so an edited file starts over."""
+    size = os.path.getsize(path)
+    with open(path, "rb") as f:
+        head = hashlib.sha1(f.read(65536)).hexdigest()[:16]
+    return f"{os.path.abspath(path)}:{size}:{head}"
+
+def open_import_connection():
+    conn = open_db_connection()
+    # durability is traded for speed only on this connection; a crash loses at most
+    # the uncommitted batch, which the resume point does not include
+    conn.execute("PRAGMA synchronous = OFF")
+    conn.execute("PRAGMA temp_store = MEMORY")
+    conn.execute("PRAGMA cache_size = -200000")
+    return conn
+
+def read_csv_records(f):
+    for row in csv.DictReader(io.TextIOWrapper(f, encoding="utf-8-sig", newline="")):
+        yield row
+
+def read_gpx(f):
+    """Track, route and waypoint points of a GPX file, parsed incrementally."""
+    for _, elem in ET.iterparse(f, events=("end",)):
+        tag = elem.tag.rsplit("}", 1)[-1]
+        if tag in ("trkpt", "rtept", "wpt"):
+            time_elem = next((child for child in elem if child.tag.rsplit("}", 1)[-1] == "time"), None)
+            yield {"latitude": elem.get("lat"), "longitude": elem.get("lon"),
+                   "timestamp": time_elem.text if time_elem is not None else None}
+            elem.clear()
+
+class ImportRun:
+    """Resume point, counters and progress output for one input file."""
+
+    def __init__(self, conn, kind, path, out):
+        self.conn = conn
+        self.kind = kind
+        self.key = import_source_key(path)
+        self.size = max(os.path.getsize(path), 1)
+        self.out = out
+        self.started = time.perf_counter()
+        row = conn.execute("SELECT records_done, finished FROM import_progress WHERE source=?", (self.key,)).fetchone()
+        self.resume_from = row["records_done"] if row else 0
+        self.already_finished = bool(row and row["finished"])
+        self.consumed = 0
+        self.inserted = 0
+        self.rejected = 0
+        self.errors = []
+
+    def reject(self, message):
+        self.rejected += 1
+        if len(self.errors) < 20:
+            self.errors.append(f"record {self.consumed}: {message}")
+
+    def commit_batch(self, write, rows, finished=False):
+        """Write one batch and advance the resume point in the same transaction."""
+        written = None
+        with self.conn:
+            if rows:
+                written = write(self.conn, rows)
+            self.conn.execute("""
+                INSERT INTO import_progress(source, kind, records_done, finished, updated_at)
+                VALUES (?, ?, ?, ?, CURRENT_TIMESTAMP)
+                ON CONFLICT(source) DO UPDATE SET records_done=excluded.records_done,
+                    finished=excluded.finished, updated_at=excluded.updated_at
+            """, (self.key, self.kind, self.consumed, int(finished)))
+        # writers may report fewer rows than given, e.g. when duplicates are skipped
+        self.inserted += len(rows) if written is None else written
+
+    def report(self, position):
+        elapsed = max(time.perf_counter() - self.started, 1e-6)
+        print(f"{self.kind}: {self.consumed} records ({100.0 * position / self.size:.1f}%), "
+              f"{self.inserted} inserted, {self.rejected} rejected, {self.inserted / elapsed:.0f} rows/s",
+              file=self.out, flush=True)
+
+    def summary(self):
+        return {"source": self.key, "resumed_from": self.resume_from, "records": self.consumed,
+                "inserted": self.inserted, "rejected": self.rejected, "errors": self.errors,
+                "seconds": round(time.perf_counter() - self.started, 1)}
+
+def import_gps_file(path, fmt=None, vehicle_id=None, defer_indexes=False, out=sys.stderr):
+    """Stream a CSV (vehicle_id|vehicle_number, latitude, longitude, timestamp) or GPX file into gps_locations."""
+    fmt = fmt or ("gpx" if path.lower().endswith(".gpx") else "csv")
+    if fmt == "gpx" and vehicle_id is None:
+        raise ValueError("GPX input needs a vehicle id")
+    conn = open_import_connection()
+    run = ImportRun(conn, "gps", path, out)
+    if run.already_finished:
+        conn.close()
+        return dict(run.summary(), message="already imported")
+    vehicles_by_number = {r["vehicle_number"]: r["vehicle_id"]
+                          for r in conn.execute("SELECT vehicle_id, vehicle_number FROM vehicles")}
+    if defer_indexes:
+        for name in GPS_IMPORT_DEFERRED_INDEXES:
+            conn.execute(f"DROP INDEX IF EXISTS {name}")
+    try:
+        with open(path, "rb") as f:
+            records = read_gpx(f) if fmt == "gpx" else read_csv_records(f)
+            rows = []
+            for record in records:
+                run.consumed += 1
+                if run.consumed <= run.resume_from:
+                    continue
+                try:
+                    vid = vehicle_id
+                    if vid is None:
+                        if record.get("vehicle_id"):
+                            vid = int(record["vehicle_id"])
+                        else:
+                            vid = vehicles_by_number.get(record.get("vehicle_number"))
+                    if vid is None:
+                        raise ValueError("unknown vehicle")
+                    lat, lon = parse_coordinates(record)
+                    rows.append((vid, lat, lon, parse_timestamp(record.get("timestamp"))))
+                except (ValueError, TypeError) as e:
+                    run.reject(str(e))
+                    continue
+                if len(rows) >= IMPORT_BATCH_ROWS:
+                    run.commit_batch(write_gps_rows, rows)
+                    rows = []
+                    run.report(f.tell())
+            run.commit_batch(write_gps_rows, rows, finished=True)
+            run.report(run.size)
+    finally:
+        if defer_indexes:
+            print("gps: rebuilding indexes", file=out, flush=True)
+            for sql in GPS_IMPORT_DEFERRED_INDEXES.values():
+                conn.execute(sql)
+            conn.execute("ANALYZE gps_locations")
+            conn.commit()
+        conn.close()
+    return run.summary()
+
+ROSTER_USER_SQL = """
+    INSERT INTO users (name, email, phone, category_id, emergency_contact, fee_status, password_hash)
+    VALUES (?, ?, ?, ?, ?, ?, ?)
+    ON CONFLICT(email) DO NOTHING
+"""
+
+ROSTER_CARD_SQL = """
+    INSERT INTO cards (card_uid, user_id, status)
+    SELECT ?, user_id, 'active' FROM users
+    WHERE email = ? AND NOT EXISTS (SELECT 1 FROM cards WHERE card_uid = ?)
+"""
+
+def write_roster_rows(conn, rows):
+    """Insert users and their cards; returns how many users were new."""
+    inserted = conn.executemany(ROSTER_USER_SQL, [r[:7] for r in rows]).rowcount
+    conn.executemany(ROSTER_CARD_SQL, [(r[7], r[1], r[7]) for r in rows if r[7]])
+    return inserted
+
+def import_roster_file(path, workers=None, out=sys.stderr):
+    """Load users (and optional card_uid) from CSV, hashing passwords across a process pool.
+
+    Columns: name, email, password, phone, category (id or name), emergency_contact,
+    fee_status, card_uid. Users whose email already exists are left unchanged.
+    """
+    conn = open_import_connection()
+    run = ImportRun(conn, "roster", path, out)
+    if run.already_finished:
+        conn.close()
+        return dict(run.summary(), message="already imported")
+    categories = {}
+    for r in conn.execute("SELECT category_id, category_name FROM user_categories"):
+        categories[str(r["category_id"])] = r["category_id"]
+        categories[r["category_name"].strip().lower()] = r["category_id"]
+
+    batch_size = min(IMPORT_BATCH_ROWS, 5000)
+    pool = concurrent.futures.ProcessPoolExecutor(max_workers=workers or os.cpu_count() or 1)
+
+    def flush(pending, finished=False):
+        hashes = pool.map(generate_password_hash, [p[2] for p in pending],
+                          [PASSWORD_HASH_METHOD] * len(pending), chunksize=32)
+        rows = [(p[0], p[1], p[3], p[4], p[5], p[6], h, p[7]) for p, h in zip(pending, hashes)]
+        run.commit_batch(write_roster_rows, rows, finished=finished)
+
+    try:
+        with open(path, "rb") as f:
+            pending = []
+            for record in read_csv_records(f):
+                run.consumed += 1
+                if run.consumed <= run.resume_from:
+                    continue
+                name = (record.get("name") or "").strip()
+                email = (record.get("email") or "").strip().lower()
+                password = record.get("password") or ""
+                if not name or not email or not password:
+                    run.reject("name, email and password are required")
+                    continue
+                category = (record.get("category") or record.get("category_id") or "").strip().lower()
+                category_id = categories.get(category) if category else None
+                if category and category_id is None:
+                    run.reject(f"unknown category {category!r}")
+                    continue
+                pending.append((name, email, password, (record.get("phone") or "").strip(), category_id,
+                                record.get("emergency_contact") or None, record.get("fee_status") or None,
+                                (record.get("card_uid") or "").strip() or None))
+                if len(pending) >= batch_size:
+                    flush(pending)
+                    pending = []
+                    run.report(f.tell())
+            flush(pending, finished=True)
+            run.report(run.size)
+    finally:
+        pool.shutdown()
+        conn.close()
+    return run.summary()
+
+@app.cli.command("import-gps")
+@click.argument("path", type=click.Path(exists=True, dir_okay=False))
+@click.option("--format", "fmt", type=click.Choice(["csv", "gpx"]), help="Defaults to the file extension.")
+@click.option("--vehicle-id", type=int, help="Assign every point to this vehicle (required for GPX).")
+@click.option("--drop-indexes", is_flag=True,
+              help="Drop GPS indexes for the load and rebuild them after; only while the server is stopped.")
+def import_gps_command(path, fmt, vehicle_id, drop_indexes):
+    """Bulk-load historical GPS points from CSV or GPX; re-run to resume."""
+    startup()
+    try:
+        summary = import_gps_file(path, fmt, vehicle_id, defer_indexes=drop_indexes)
+    except ValueError as e:
+        raise click.UsageError(str(e))
+    print(json.dumps(summary))
+
+@app.cli.command("import-roster")
+@click.argument("path", type=click.Path(exists=True, dir_okay=False))
+@click.option("--workers", type=int, help="Hashing processes (default: CPU count).")
+def import_roster_command(path, workers):
+    """Bulk-load users and cards from CSV; re-run to resume."""
+    startup()
+    print(json.dumps(import_roster_file(path, workers)))
+
+# -------------------------------
+# Query plan checks
+# -------------------------------
+# Statements on the hot request paths, with representative parameters. Each must be
+# planned without a plain table scan, and without a temp B-tree unless listed in its
+# allowed flags. Run `flask check-query-plans` in CI, or set QUERY_PLAN_STRICT=1 in
+# the test environment so startup fails when an index stops being used.
+class QueryPlanError(Exception):
+    pass
+
+def hot_queries():
+    """name -> (sql, sample params, flags that are acceptable for it)."""
+    return {
+        "access_logs_cursor_page": (ACCESS_LOGS_LIST_SQL + """
+            WHERE (access_logs.timestamp, access_logs.log_id) < (?, ?)
+            ORDER BY access_logs.timestamp DESC, access_logs.log_id DESC LIMIT ?
+        """, ("9999-12-31 00:00:00", 0, 50), ()),
+        "gps_cursor_page": (GPS_LIST_SQL + """
+            WHERE (gps_locations.timestamp, gps_locations.location_id) < (?, ?)
+            ORDER BY gps_locations.timestamp DESC, gps_locations.location_id DESC LIMIT ?
+        """, ("9999-12-31 00:00:00", 0, 50), ()),
+        "gps_stream_tail": (STREAM_ROWS_SQL + " ORDER BY gps_locations.location_id LIMIT ?", (0, 1000), ()),
+        "vehicle_track": (TRACK_SQL, (1, "2000-01-01 00:00:00", "9999-12-31 00:00:00"), ()),
+        "nearby_vehicles": (NEARBY_VEHICLES_SQL, (1.0, -1.0, 1.0, -1.0), ()),
+        "nearby_stops": (NEARBY_STOPS_SQL, (1.0, -1.0, 1.0, -1.0), ()),
+        # the ORDER BY only sorts the handful of rows sharing one uid
+        "card_lookup": (CARD_LOOKUP_SQL.format(where="WHERE card_uid=?"), ("uid",), ("temp_btree",)),
+        "occupancy_replay": (OCCUPANCY_REPLAY_SQL, (0, OCCUPANCY_REPLAY_CHUNK), ()),
+        "access_analytics_hourly": ("""
+            SELECT hour, SUM(taps) AS taps, SUM(denied) AS denied FROM access_hourly_counts
+            WHERE hour >= ? AND hour < ? GROUP BY hour ORDER BY hour
+        """, ("2000-01-01 00:00:00", "9999-12-31 00:00:00"), ()),
+    }
+
+def check_hot_query_plans(conn=None):
+    """Return a list of {name, flags, plan} for hot queries whose plan regressed."""
+    own = conn is None
+    if own:
+        conn = open_db_connection()
+    failures = []
+    try:
+        for name, (sql, params, allowed) in hot_queries().items():
+            plan = explain_plan(conn, sql, params)
+            bad = [f for f in plan_flags(plan) if f not in allowed]
+            if bad or any(p.startswith("error:") for p in plan):
+                failures.append({"name": name, "flags": bad, "plan": plan})
+    finally:
+        if own:
+            conn.close()
+    return failures
+
+@app.cli.command("check-query-plans")
+def check_query_plans_command():
+    """Exit non-zero if a hot query is no longer served by an index."""
+    startup()
+    failures = check_hot_query_plans()
+    for failure in failures:
+        print(json.dumps(failure))
+    if failures:
+        raise SystemExit(1)
+    print(f"{len(hot_queries())} hot queries use their indexes")
+
+@app.route('/db/slow_queries', methods=['GET'])
+@token_required(require_admin=True)
+def get_slow_queries():
+    """This worker's most recent slow queries, newest first, and normalised SQL for every query_id."""
+    _, _, statements = metrics.merged()
+    return jsonify({"threshold_ms": SLOW_QUERY_MS, "queries": list(reversed(_slow_queries)),
+                    "statements": statements})
+
+# -------------------------------
+# Metrics endpoint
+# -------------------------------
+METRIC_HELP = {
+    "http_request_duration_seconds": ("histogram", "Request latency by route, method and status."),
+    "db_queries_per_request": ("histogram", "SQL statements run through the query helpers per request."),
+    "db_query_duration_seconds": ("histogram", "Execution time per statement and query helper."),
+    "db_lock_wait_seconds": ("histogram", "Time spent waiting for the per-worker writer or the SQLite write lock."),
+    "db_query_rows_total": ("counter", "Rows returned or affected per statement and query helper."),
+    "db_slow_queries_total": ("counter", "Statements slower than SLOW_QUERY_MS."),
+}
+
+def format_labels(labels):
+    if not labels:
+        return ""
+    parts = []
+    for key, value in labels:
+        value = str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+        parts.append(f'{key}="{value}"')
+    return "{" + ",".join(parts) + "}"
+
+def render_prometheus(histograms, counters):
+    by_name = collections.defaultdict(list)
+    for (name, labels), entry in histograms.items():
+        by_name[name].append((labels, entry))
+    for (name, labels), value in counters.items():
+        by_name[name].append((labels, value))
+    lines = []
+    for name in sorted(by_name):
+        kind, help_text = METRIC_HELP.get(name, ("untyped", name))
+        lines.append(f"# HELP {name} {help_text}")
+        lines.append(f"# TYPE {name} {kind}")
+        for labels, value in sorted(by_name[name], key=lambda item: item[0]):
+            if kind == "histogram":
+                cumulative = 0
+                for bound, count in zip(value["buckets"], value["counts"]):
+                    cumulative += count
+                    lines.append(f"{name}_bucket{format_labels(labels + (('le', repr(float(bound))),))} {cumulative}")
+                lines.append(f"{name}_bucket{format_labels(labels + (('le', '+Inf'),))} {value['count']}")
+                lines.append(f"{name}_sum{format_labels(labels)} {value['sum']!r}")
+                lines.append(f"{name}_count{format_labels(labels)} {value['count']}")
+            else:
+                lines.append(f"{name}{format_labels(labels)} {value}")
+    return "\n".join(lines) + "\n"
+
+@app.route('/metrics', methods=['GET'])
+def get_metrics():
+    """Prometheus text exposition, merged across all workers of this server.
+
+    Statements are labelled by query_id only; GET /db/slow_queries maps ids to normalised SQL.
+    """
+    if not METRICS_TOKEN:
+        return jsonify({"error": "Metrics are disabled; set METRICS_TOKEN"}), 404
+    if not hmac.compare_digest(request.headers.get("Authorization", ""), f"Bearer {METRICS_TOKEN}"):
+        return jsonify({"error": "Unauthorized"}), 401
+    histograms, counters, _ = metrics.merged()
+    body = render_prometheus(histograms, counters)
+    return Response(body, mimetype="text/plain; version=0.0.4")
+
 # -------------------------------
 # Start server
 # -------------------------------
 if __name__ == '__main__':
     debug_flag = os.getenv("FLASK_DEBUG", "1") == "1"
     port = int(os.getenv("PORT", 5000))
+    create_app(os.getenv("DB_INIT_MODE", "auto"))
     app.run(host="0.0.0.0", port=port, debug=debug_flag)
\ No newline at end of file
@@ -0,0 +1,57 @@
+"""Micro-benchmark: worker startup cost, i.e. module import and create_app().
+
+Run from backend/:  python benchmarks/bench_startup.py [runs]
+Each sample is a fresh interpreter, as a gunicorn worker without --preload would be.
+Reports import alone, create_app() on a fresh database (DB_INIT_MODE=auto, full init)
+and create_app() on a current database (the default per-worker version check). Uses a
+throwaway SQLite file.
+"""
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+
+BACKEND = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+PROBE = r"""
+import time
+t0 = time.perf_counter()
+import app
+t1 = time.perf_counter()
+app.create_app()
+t2 = time.perf_counter()
+print(f"{(t1 - t0) * 1000:.3f} {(t2 - t1) * 1000:.3f}")
+"""
+
+
+def sample(db_file, mode):
+    env = dict(os.environ, SQLITE_FILE=db_file, DB_INIT_MODE=mode,
+               JWT_SECRET=os.environ.get("JWT_SECRET", "benchmark-secret-benchmark-secret-000"))
+    out = subprocess.run([sys.executable, "-c", PROBE], cwd=BACKEND, env=env,
+                         check=True, capture_output=True, text=True).stdout.split()
+    return float(out[-2]), float(out[-1])
+
+
+def main():
+    runs = int(sys.argv[1]) if len(sys.argv) > 1 else 5
+    tmp = tempfile.mkdtemp()
+    imports, fresh, current = [], [], []
+    for i in range(runs):
+        imp, init = sample(os.path.join(tmp, f"fresh-{i}.db"), "auto")
+        imports.append(imp)
+        fresh.append(init)
+    db_file = os.path.join(tmp, "current.db")
+    sample(db_file, "auto")
+    for _ in range(runs):
+        imp, check = sample(db_file, "check")
+        imports.append(imp)
+        current.append(check)
+    print(f"runs: {runs}")
+    print(f"import app:                   {statistics.median(imports):8.1f} ms (median)")
+    print(f"create_app(), fresh database: {statistics.median(fresh):8.1f} ms (median)")
+    print(f"create_app(), current schema: {statistics.median(current):8.1f} ms (median)")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,51 @@
+"""Micro-benchmark: per-request auth overhead with and without the verified-token cache.
+
+Run from backend/:  python benchmarks/bench_token_cache.py [iterations]
+Uses a throwaway SQLite file, so it never touches smart_gps.db.
+"""
+import os
+import sys
+import tempfile
+import time
+
+os.environ["SQLITE_FILE"] = os.path.join(tempfile.mkdtemp(), "bench.db")
+os.environ.setdefault("JWT_SECRET", "benchmark-secret-benchmark-secret-000")
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import app as trackapp  # noqa: E402
+
+trackapp.create_app("auto")
+
+
+def per_call_us(fn, iterations):
+    start = time.perf_counter()
+    for _ in range(iterations):
+        fn()
+    return (time.perf_counter() - start) / iterations * 1e6
+
+
+def main():
+    iterations = int(sys.argv[1]) if len(sys.argv) > 1 else 20000
+    token = trackapp.create_token({"admin_id": 1, "name": "bench", "role": "admin"})
+    client = trackapp.app.test_client()
+    headers = {"Authorization": "Bearer " + token}
+
+    results = {}
+    for label, size in (("uncached", 0), ("cached", trackapp.TOKEN_CACHE_SIZE or 10000)):
+        trackapp.token_cache.max_size = size
+        trackapp.token_cache.clear()
+        trackapp.decode_token(token)  # warm up
+        results[label] = (
+            per_call_us(lambda: trackapp.decode_token(token), iterations),
+            per_call_us(lambda: client.get("/auth/token_cache", headers=headers), iterations // 10),
+        )
+
+    print(f"{'mode':<10} {'decode_token (us)':>18} {'full request (us)':>18}")
+    for label, (decode_us, request_us) in results.items():
+        print(f"{label:<10} {decode_us:>18.2f} {request_us:>18.2f}")
+    saved = results["uncached"][1] - results["cached"][1]
+    print(f"auth overhead saved per request: {saved:.2f} us")
+
+
+if __name__ == "__main__":
+    main()
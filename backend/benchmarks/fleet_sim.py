@@ -0,0 +1,366 @@
+"""Fleet simulator and load test: synthetic fleet + history, then mixed traffic.
+
+Run from backend/:
+    python benchmarks/fleet_sim.py --vehicles 50 --users 2000 --history-rows 1000000 --duration 30
+    python benchmarks/fleet_sim.py --target http          # same, through a local threaded HTTP server
+    python benchmarks/fleet_sim.py --target http --url http://127.0.0.1:8000 --db /path/to/server.db
+
+Traffic is vehicles POSTing /gps at --gps-hz each, riders polling /user/vehicle and
+admins paging /gps and /access_logs with cursors. Reports throughput, p50/p99
+latency per traffic class and the database size. Without --db a throwaway SQLite
+file is used, so smart_gps.db is never touched. With --url the server must be
+running against the same --db file.
+"""
+import argparse
+import http.client
+import json
+import math
+import os
+import random
+import sys
+import tempfile
+import threading
+import time
+import urllib.parse
+
+parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+parser.add_argument("--vehicles", type=int, default=20)
+parser.add_argument("--users", type=int, default=500)
+parser.add_argument("--history-rows", type=int, default=200000, help="historical GPS rows to generate")
+parser.add_argument("--log-rows", type=int, default=50000, help="historical access_logs rows to generate")
+parser.add_argument("--duration", type=float, default=20.0, help="seconds of mixed traffic")
+parser.add_argument("--gps-hz", type=float, default=1.0, help="POST /gps rate per vehicle")
+parser.add_argument("--gps-threads", type=int, default=4)
+parser.add_argument("--riders", type=int, default=8, help="threads polling /user/vehicle")
+parser.add_argument("--rider-interval", type=float, default=0.5, help="seconds between polls per rider thread")
+parser.add_argument("--admins", type=int, default=2, help="threads paging /gps and /access_logs")
+parser.add_argument("--admin-interval", type=float, default=0.2)
+parser.add_argument("--target", choices=("inprocess", "http"), default="inprocess")
+parser.add_argument("--url", help="existing server for --target http (default: start one in-process)")
+parser.add_argument("--db", help="SQLite file to build the fleet in (default: temporary)")
+parser.add_argument("--skip-setup", action="store_true", help="reuse the fleet already in --db")
+parser.add_argument("--seed", type=int, default=7)
+parser.add_argument("--json", action="store_true", help="print the report as JSON")
+args = parser.parse_args()
+
+os.environ["SQLITE_FILE"] = args.db or os.path.join(tempfile.mkdtemp(), "fleet_sim.db")
+os.environ.setdefault("JWT_SECRET", "benchmark-secret-benchmark-secret-000")
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import app as trackapp  # noqa: E402
+
+trackapp.create_app("auto")
+
+CENTER = (24.9056, 67.0822)
+POINT_SPACING_S = 10
+HISTORY_CHUNK = 50000
+
+
+# -------------------------------
+# Synthetic fleet
+# -------------------------------
+def route_paths(conn):
+    """Give every route's stops coordinates (if missing) and return route_id -> [(lat, lon), ...]."""
+    paths = {}
+    routes = [r[0] for r in conn.execute("SELECT route_id FROM routes ORDER BY route_id")]
+    for n, route_id in enumerate(routes):
+        stops = conn.execute("""
+            SELECT stop_id, latitude, longitude FROM route_stops WHERE route_id=? ORDER BY stop_number
+        """, (route_id,)).fetchall()
+        bearing = 2 * math.pi * n / max(len(routes), 1)
+        path = []
+        for i, (stop_id, lat, lon) in enumerate(stops):
+            if lat is None or lon is None:
+                # stops ~600 m apart on a spoke out of the campus centre
+                lat = CENTER[0] + math.cos(bearing) * 0.0055 * (i + 1)
+                lon = CENTER[1] + math.sin(bearing) * 0.0055 * (i + 1)
+                conn.execute("UPDATE route_stops SET latitude=?, longitude=? WHERE stop_id=?", (lat, lon, stop_id))
+            path.append((lat, lon))
+        if len(path) >= 2:
+            paths[route_id] = path
+    conn.commit()
+    return paths
+
+
+def position_at(path, t):
+    """Position after t seconds driving the path back and forth at ~8 m/s."""
+    legs = list(zip(path, path[1:])) + list(zip(path[::-1], path[::-1][1:]))
+    lengths = [max(trackapp.haversine_m(a[0], a[1], b[0], b[1]), 1.0) for a, b in legs]
+    distance = (t * 8.0) % sum(lengths)
+    for (a, b), length in zip(legs, lengths):
+        if distance <= length:
+            f = distance / length
+            return a[0] + (b[0] - a[0]) * f, a[1] + (b[1] - a[1]) * f
+        distance -= length
+    return path[0]
+
+
+def build_fleet(rng):
+    conn = trackapp.open_db_connection()
+    paths = route_paths(conn)
+    route_ids = sorted(paths)
+    if not route_ids:
+        raise SystemExit("no routes with at least two stops to drive")
+
+    existing = conn.execute("SELECT COUNT(*) FROM vehicles").fetchone()[0]
+    conn.executemany("INSERT INTO vehicles (vehicle_number, driver_name, capacity, route_id) VALUES (?, ?, ?, ?)", [
+        (f"SIM-{i:04d}", f"Sim Driver {i}", rng.choice((30, 40, 50)), route_ids[i % len(route_ids)])
+        for i in range(existing, args.vehicles)
+    ])
+    # one hash for every simulated rider; hashing is not what this benchmark measures
+    password_hash = trackapp.generate_password_hash("sim-password", trackapp.PASSWORD_HASH_METHOD)
+    first_user = conn.execute("SELECT COALESCE(MAX(user_id), 0) FROM users").fetchone()[0] + 1
+    conn.executemany("""
+        INSERT INTO users (name, email, phone, category_id, password_hash) VALUES (?, ?, ?, ?, ?)
+    """, [(f"Sim Rider {i}", f"sim{first_user + i}@example.com", "0000", 1 + i % 4, password_hash)
+          for i in range(args.users)])
+    conn.executemany("INSERT INTO cards (card_uid, user_id, status) VALUES (?, ?, 'active')", [
+        (f"SIMCARD{first_user + i:08d}", first_user + i) for i in range(args.users)
+    ])
+    conn.commit()
+
+    vehicles = [(r[0], r[1]) for r in conn.execute("SELECT vehicle_id, route_id FROM vehicles WHERE route_id IS NOT NULL")]
+    vehicles = [(v, r) for v, r in vehicles if r in paths]
+    now = time.time()
+
+    # history: one point every POINT_SPACING_S per vehicle, ending now
+    per_vehicle = max(1, args.history_rows // max(len(vehicles), 1))
+    rows = []
+    written = 0
+    for step in range(per_vehicle, 0, -1):
+        ts = trackapp.parse_timestamp(now - step * POINT_SPACING_S)
+        for vehicle_id, route_id in vehicles:
+            lat, lon = position_at(paths[route_id], (now - step * POINT_SPACING_S) + vehicle_id * 97)
+            rows.append((vehicle_id, lat, lon, ts))
+        if len(rows) >= HISTORY_CHUNK or step == 1:
+            with conn:
+                trackapp.write_gps_rows(conn, rows)
+            written += len(rows)
+            rows = []
+            progress(f"gps history {written}/{per_vehicle * len(vehicles)}")
+    progress("\n")
+
+    users = [r[0] for r in conn.execute("SELECT user_id FROM users")]
+    cards = dict(conn.execute("SELECT user_id, card_id FROM cards").fetchall())
+    logs = []
+    span = per_vehicle * POINT_SPACING_S
+    for i in range(args.log_rows):
+        user_id = rng.choice(users)
+        logs.append((user_id, cards.get(user_id), rng.choice(("entry", "exit")), "campus",
+                     1, trackapp.parse_timestamp(now - rng.random() * span)))
+        if len(logs) >= HISTORY_CHUNK or i == args.log_rows - 1:
+            with conn:
+                conn.executemany("""
+                    INSERT INTO access_logs(user_id, card_id, action_type, area, granted, timestamp)
+                    VALUES (?, ?, ?, ?, ?, ?)
+                """, logs)
+            logs = []
+            progress(f"access logs {i + 1}/{args.log_rows}")
+    conn.close()
+    return paths, vehicles, users
+
+
+def progress(message):
+    if not args.json:
+        print(f"\r  {message}", end="", file=sys.stderr, flush=True)
+
+
+# -------------------------------
+# Clients
+# -------------------------------
+class InProcessClient:
+    def __init__(self):
+        self.client = trackapp.app.test_client()
+
+    def request(self, method, path, body=None, headers=None):
+        response = self.client.open(path, method=method, json=body, headers=headers)
+        data = response.get_data()
+        response.close()
+        return response.status_code, data
+
+
+class HttpClient:
+    def __init__(self, base_url):
+        parsed = urllib.parse.urlsplit(base_url)
+        self.conn = http.client.HTTPConnection(parsed.hostname, parsed.port or 80, timeout=30)
+
+    def request(self, method, path, body=None, headers=None):
+        headers = dict(headers or {})
+        payload = None
+        if body is not None:
+            payload = json.dumps(body)
+            headers["Content-Type"] = "application/json"
+        try:
+            self.conn.request(method, path, payload, headers)
+            response = self.conn.getresponse()
+            return response.status, response.read()
+        except (OSError, http.client.HTTPException):
+            self.conn.close()
+            return 599, b""
+
+
+# -------------------------------
+# Traffic
+# -------------------------------
+class Recorder:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.samples = {}
+
+    def add(self, name, samples):
+        with self.lock:
+            self.samples.setdefault(name, []).extend(samples)
+
+
+def timed(client, samples, method, path, body=None, headers=None):
+    started = time.perf_counter()
+    status, data = client.request(method, path, body, headers)
+    samples.append((time.perf_counter() - started, status))
+    return status, data
+
+
+def gps_sender(make_client, recorder, stop_at, vehicles, paths, headers):
+    client, samples = make_client(), []
+    interval = 1.0 / args.gps_hz if args.gps_hz > 0 else None
+    due = {vehicle_id: time.monotonic() + random.random() * (interval or 1) for vehicle_id, _ in vehicles}
+    while interval and time.monotonic() < stop_at:
+        vehicle_id, route_id = min(vehicles, key=lambda v: due[v[0]])
+        wait = due[vehicle_id] - time.monotonic()
+        if wait > 0:
+            time.sleep(min(wait, max(stop_at - time.monotonic(), 0)))
+        lat, lon = position_at(paths[route_id], time.time() + vehicle_id * 97)
+        timed(client, samples, "POST", "/gps", {"vehicle_id": vehicle_id, "latitude": lat, "longitude": lon}, headers)
+        due[vehicle_id] += interval
+    recorder.add("gps_ingest", samples)
+
+
+def rider(make_client, recorder, stop_at, headers):
+    client, samples = make_client(), []
+    while time.monotonic() < stop_at:
+        timed(client, samples, "GET", "/user/vehicle", headers=headers)
+        time.sleep(args.rider_interval)
+    recorder.add("rider_poll", samples)
+
+
+def admin(make_client, recorder, stop_at, headers):
+    client, samples = make_client(), {"admin_gps_page": [], "admin_logs_page": []}
+    cursors = {"/gps": "", "/access_logs": ""}
+    while time.monotonic() < stop_at:
+        for path, name in (("/gps", "admin_gps_page"), ("/access_logs", "admin_logs_page")):
+            # walk back through history page by page, starting over at the newest page
+            query = "?" + urllib.parse.urlencode({"cursor": cursors[path], "per_page": 50})
+            status, data = timed(client, samples[name], "GET", path + query, headers=headers)
+            try:
+                cursors[path] = (json.loads(data) if status == 200 else {}).get("next_cursor") or ""
+            except ValueError:
+                cursors[path] = ""
+        time.sleep(args.admin_interval)
+    for name, values in samples.items():
+        recorder.add(name, values)
+
+
+def percentile(sorted_values, p):
+    if not sorted_values:
+        return 0.0
+    return sorted_values[min(len(sorted_values) - 1, max(0, math.ceil(p / 100.0 * len(sorted_values)) - 1))]
+
+
+def db_size_bytes(path):
+    return sum(os.path.getsize(path + suffix) for suffix in ("", "-wal", "-shm") if os.path.exists(path + suffix))
+
+
+def main():
+    rng = random.Random(args.seed)
+    random.seed(args.seed)
+    db_path = os.environ["SQLITE_FILE"]
+    setup_started = time.perf_counter()
+    if args.skip_setup:
+        conn = trackapp.open_db_connection()
+        paths = route_paths(conn)
+        vehicles = [(v, r) for v, r in conn.execute("SELECT vehicle_id, route_id FROM vehicles") if r in paths]
+        users = [r[0] for r in conn.execute("SELECT user_id FROM users")]
+        conn.close()
+    else:
+        paths, vehicles, users = build_fleet(rng)
+    setup_s = time.perf_counter() - setup_started
+    if not args.json:
+        print(file=sys.stderr)
+
+    server = None
+    if args.target == "http":
+        base_url = args.url
+        if base_url is None:
+            from werkzeug.serving import make_server
+            server = make_server("127.0.0.1", 0, trackapp.app, threaded=True)
+            threading.Thread(target=server.serve_forever, daemon=True).start()
+            base_url = f"http://127.0.0.1:{server.server_port}"
+        make_client = lambda: HttpClient(base_url)  # noqa: E731
+    else:
+        make_client = InProcessClient
+
+    admin_headers = {"Authorization": "Bearer " + trackapp.create_token({"admin_id": 1, "name": "sim", "role": "admin"})}
+    device_headers = admin_headers
+    rider_headers = [{"Authorization": "Bearer " + trackapp.create_token({"user_id": u, "name": "sim", "role": "user"})}
+                     for u in users[:max(args.riders, 1)]]
+
+    recorder = Recorder()
+    stop_at = time.monotonic() + args.duration
+    threads = []
+    for i in range(args.gps_threads):
+        share = vehicles[i::args.gps_threads]
+        if share:
+            threads.append(threading.Thread(target=gps_sender, args=(make_client, recorder, stop_at, share, paths,
+                                                                      device_headers)))
+    for i in range(args.riders):
+        threads.append(threading.Thread(target=rider, args=(make_client, recorder, stop_at,
+                                                            rider_headers[i % len(rider_headers)])))
+    for _ in range(args.admins):
+        threads.append(threading.Thread(target=admin, args=(make_client, recorder, stop_at, admin_headers)))
+    started = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - started
+    if server is not None:
+        server.shutdown()
+    if trackapp.gps_ingest_queue is not None:
+        trackapp.gps_ingest_queue.flush()
+
+    conn = trackapp.open_db_connection(readonly=True)
+    report = {
+        "target": args.target,
+        "vehicles": len(vehicles),
+        "users": len(users),
+        "setup_s": round(setup_s, 1),
+        "duration_s": round(elapsed, 1),
+        "gps_rows": conn.execute("SELECT COUNT(*) FROM gps_locations").fetchone()[0],
+        "access_log_rows": conn.execute("SELECT COUNT(*) FROM access_logs").fetchone()[0],
+        "db_bytes": db_size_bytes(db_path),
+        "traffic": {},
+    }
+    conn.close()
+    for name, samples in sorted(recorder.samples.items()):
+        latencies = sorted(s[0] for s in samples)
+        report["traffic"][name] = {
+            "requests": len(samples),
+            "errors": sum(1 for s in samples if s[1] >= 400),
+            "rps": round(len(samples) / elapsed, 1),
+            "p50_ms": round(percentile(latencies, 50) * 1000, 2),
+            "p99_ms": round(percentile(latencies, 99) * 1000, 2),
+        }
+
+    if args.json:
+        print(json.dumps(report, indent=2))
+        return
+    print(f"target={report['target']} vehicles={report['vehicles']} users={report['users']} "
+          f"setup={report['setup_s']}s run={report['duration_s']}s")
+    print(f"{'traffic':<18} {'requests':>9} {'errors':>7} {'req/s':>8} {'p50 ms':>8} {'p99 ms':>8}")
+    for name, row in report["traffic"].items():
+        print(f"{name:<18} {row['requests']:>9} {row['errors']:>7} {row['rps']:>8} {row['p50_ms']:>8} {row['p99_ms']:>8}")
+    print(f"gps rows {report['gps_rows']}, access log rows {report['access_log_rows']}, "
+          f"db size {report['db_bytes'] / 1024 / 1024:.1f} MiB")
+
+
+if __name__ == "__main__":
+    main()
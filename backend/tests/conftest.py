@@ -0,0 +1,61 @@
+"""Shared fixtures: one throwaway SQLite file per test session, initialised through create_app()."""
+import itertools
+import os
+import sys
+import tempfile
+
+import pytest
+
+_tmp = tempfile.mkdtemp()
+os.environ["SQLITE_FILE"] = os.path.join(_tmp, "test.db")
+os.environ["METRICS_DIR"] = os.path.join(_tmp, "metrics")
+os.environ.setdefault("JWT_SECRET", "test-secret-test-secret-test-secret-00")
+os.environ.setdefault("ACCESS_SNAPSHOT_SALT", "test-salt")
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import app as trackapp  # noqa: E402
+
+_ids = itertools.count(1)
+
+
+@pytest.fixture(scope="session")
+def flask_app():
+    return trackapp.create_app("auto")
+
+
+@pytest.fixture
+def client(flask_app):
+    return flask_app.test_client()
+
+
+@pytest.fixture
+def admin_headers(client):
+    r = client.post("/admin/login", json={"email": "admin@smartgps.com", "password": "admin123"})
+    return {"Authorization": "Bearer " + r.get_json()["token"]}
+
+
+def fetch_one(sql, params=()):
+    conn = trackapp.open_db_connection(readonly=True)
+    try:
+        return conn.execute(sql, params).fetchone()
+    finally:
+        conn.close()
+
+
+@pytest.fixture
+def make_rider(client, admin_headers):
+    """Register a user in a fresh category allowed into `area`, give them a card; returns (user_id, card_uid)."""
+    def make(area):
+        n = next(_ids)
+        client.post("/categories", json={"category_name": f"cat-{n}"}, headers=admin_headers)
+        category_id = fetch_one("SELECT category_id FROM user_categories WHERE category_name=?", (f"cat-{n}",))[0]
+        client.post("/permissions", json={"category_id": category_id, "allowed_area": area}, headers=admin_headers)
+        r = client.post("/user/register", json={"name": f"rider {n}", "email": f"rider{n}@example.com",
+                                                "phone": "0", "category_id": category_id, "password": "pw"})
+        assert r.status_code == 201
+        user_id = fetch_one("SELECT user_id FROM users WHERE email=?", (f"rider{n}@example.com",))[0]
+        card_uid = f"CARD-{n}"
+        r = client.post("/cards", json={"card_uid": card_uid, "user_id": user_id}, headers=admin_headers)
+        assert r.status_code == 201
+        return user_id, card_uid
+    return make
@@ -0,0 +1,69 @@
+import sqlite3
+
+import app as trackapp
+from conftest import fetch_one
+
+
+def test_tap_granted_for_user_created_after_warm_up(client, admin_headers, make_rider):
+    # warm the permission index first, so the new user arrives as a delta
+    assert client.get("/access/index", headers=admin_headers).status_code == 200
+    _, card_uid = make_rider("gate-a")
+
+    r = client.post("/access/tap", json={"card_uid": card_uid, "area": "gate-a"}, headers=admin_headers)
+    assert r.status_code == 200
+    assert r.get_json()["granted"] is True
+    assert r.get_json()["reason"] == "allowed"
+
+    r = client.post("/access/tap", json={"card_uid": card_uid, "area": "gate-b"}, headers=admin_headers)
+    assert r.get_json()["reason"] == "area_not_allowed"
+
+
+def test_snapshot_includes_user_created_after_warm_up(client, admin_headers, make_rider):
+    from app import card_hash
+
+    before = client.get("/access/snapshot", headers=admin_headers).get_json()
+    _, card_uid = make_rider("gate-c")
+
+    full = client.get("/access/snapshot", headers=admin_headers).get_json()
+    bit = full["areas"]["gate-c"]
+    assert full["cards"][card_hash(card_uid)] == 1 << bit
+
+    delta = client.get(f"/access/snapshot?since={before['version']}", headers=admin_headers).get_json()
+    assert delta["full"] is False
+    assert delta["cards"][card_hash(card_uid)] == 1 << bit
+
+
+def test_snapshot_requires_admin(client, make_rider):
+    user_id, _ = make_rider("gate-d")
+    email = fetch_one("SELECT email FROM users WHERE user_id=?", (user_id,))[0]
+    r = client.post("/user/login", json={"email": email, "password": "pw"})
+    rider_headers = {"Authorization": "Bearer " + r.get_json()["token"]}
+    assert client.get("/access/snapshot", headers=rider_headers).status_code == 403
+
+
+def test_snapshot_refused_without_salt(client, admin_headers, monkeypatch):
+    monkeypatch.setattr(trackapp, "ACCESS_SNAPSHOT_SALT", "")
+    assert client.get("/access/snapshot", headers=admin_headers).status_code == 503
+
+
+def test_pruned_change_log_forces_full_reload(client, admin_headers, make_rider, monkeypatch):
+    assert client.get("/access/index", headers=admin_headers).status_code == 200
+    before = client.get("/access/snapshot", headers=admin_headers).get_json()
+    rebuilds = trackapp.permission_index.full_rebuilds
+    _, card_uid = make_rider("gate-e")
+    make_rider("gate-e")
+
+    conn = sqlite3.connect(trackapp.DB_FILE)
+    with conn:
+        conn.execute("UPDATE access_changes SET changed_at = '2000-01-01 00:00:00'")
+    conn.close()
+    monkeypatch.setattr(trackapp, "GPS_RETENTION_DAYS", 0)
+    assert trackapp.run_gps_retention()["access_changes_pruned"] > 0
+    assert fetch_one("SELECT COUNT(*) FROM access_changes")[0] == 1
+
+    r = client.post("/access/tap", json={"card_uid": card_uid, "area": "gate-e"}, headers=admin_headers)
+    assert r.get_json()["granted"] is True
+    assert trackapp.permission_index.full_rebuilds == rebuilds + 1
+
+    delta = client.get(f"/access/snapshot?since={before['version']}", headers=admin_headers).get_json()
+    assert delta["full"] is True
@@ -0,0 +1,29 @@
+import itertools
+
+import pytest
+
+_areas = (f"window-{n}" for n in itertools.count())
+
+
+@pytest.fixture
+def taps_on_two_days(client, admin_headers, make_rider):
+    """Two taps in a fresh area, at 10:00 on 2031-03-01 and 2031-03-02; returns the area."""
+    area = next(_areas)
+    _, card_uid = make_rider(area)
+    entries = [{"card_uid": card_uid, "area": area, "timestamp": ts}
+               for ts in ("2031-03-01T10:00:00Z", "2031-03-02T10:00:00Z")]
+    r = client.post("/access_logs/batch", json={"entries": entries}, headers=admin_headers)
+    assert r.status_code == 201
+    return area
+
+
+@pytest.mark.parametrize("window,days", [
+    ("from=2031-03-01T00:00:00Z&to=2031-03-02T00:00:00Z", ["2031-03-01"]),
+    ("from=2031-03-01T00:00:00Z&to=2031-03-03T00:00:00Z", ["2031-03-01", "2031-03-02"]),
+    ("from=2031-03-01T00:00:00Z&to=2031-03-02T12:00:00Z", ["2031-03-01", "2031-03-02"]),
+])
+def test_window_is_half_open_in_both_endpoints(client, admin_headers, taps_on_two_days, window, days):
+    hourly = client.get(f"/analytics/access?group=area&area={taps_on_two_days}&{window}", headers=admin_headers).get_json()
+    daily = client.get(f"/analytics/access/unique_users?{window}", headers=admin_headers).get_json()
+    assert sum(row["taps"] for row in hourly) == len(days)
+    assert [row["day"] for row in daily] == days
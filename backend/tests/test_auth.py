@@ -0,0 +1,37 @@
+import sqlite3
+
+import app as trackapp
+
+
+def test_token_cache_clear_reaches_other_workers(client, admin_headers, monkeypatch):
+    monkeypatch.setattr(trackapp, "TOKEN_CACHE_GENERATION_TTL", 0.0)
+    client.get("/auth/token_cache", headers=admin_headers)
+    before = client.get("/auth/token_cache", headers=admin_headers).get_json()
+
+    # what DELETE /auth/token_cache in another worker leaves behind: a bumped generation
+    conn = sqlite3.connect(trackapp.DB_FILE)
+    with conn:
+        conn.execute("""
+            INSERT INTO cache_generations(name, generation) VALUES('token_cache', 1)
+            ON CONFLICT(name) DO UPDATE SET generation = generation + 1
+        """)
+    conn.close()
+
+    after = client.get("/auth/token_cache", headers=admin_headers).get_json()
+    assert after["misses"] == before["misses"] + 1
+    assert after["size"] == 1  # only the token this request re-verified
+
+
+def test_token_cache_clear_endpoint(client, admin_headers):
+    assert client.delete("/auth/token_cache", headers=admin_headers).status_code == 200
+    assert client.get("/auth/token_cache", headers=admin_headers).get_json()["size"] == 1
+
+
+def test_token_cache_generation_checked_at_most_once_per_ttl(client, admin_headers, monkeypatch):
+    monkeypatch.setattr(trackapp, "TOKEN_CACHE_GENERATION_TTL", 3600.0)
+    client.get("/auth/token_cache", headers=admin_headers)
+    calls = []
+    monkeypatch.setattr(trackapp, "current_generation", lambda name: calls.append(name) or 0)
+    for _ in range(5):
+        assert client.get("/auth/token_cache", headers=admin_headers).status_code == 200
+    assert calls == []
@@ -0,0 +1,65 @@
+import sqlite3
+
+import pytest
+
+import app as trackapp
+from conftest import fetch_one
+
+BUMP_SQL = """
+    INSERT INTO cache_generations(name, generation) VALUES(?, 1)
+    ON CONFLICT(name) DO UPDATE SET generation = generation + 1
+"""
+
+
+def generation(name):
+    row = fetch_one("SELECT generation FROM cache_generations WHERE name=?", (name,))
+    return row[0] if row else 0
+
+
+def test_writer_is_released_after_each_commit(flask_app):
+    with flask_app.test_request_context():
+        trackapp.query_commit(BUMP_SQL, ("test-writer",))
+        assert not trackapp.db_pool.snapshot()["writer_busy"]
+        trackapp.query_fetchall("SELECT 1")
+        assert not trackapp.db_pool.snapshot()["writer_busy"]
+
+
+def test_nested_writes_commit_or_roll_back_together(flask_app):
+    with flask_app.test_request_context():
+        with trackapp.write_transaction():
+            trackapp.query_commit(BUMP_SQL, ("test-nested",))
+            trackapp.query_commit(BUMP_SQL, ("test-nested",))
+        assert generation("test-nested") == 2
+
+        with pytest.raises(sqlite3.OperationalError):
+            with trackapp.write_transaction():
+                trackapp.query_commit(BUMP_SQL, ("test-nested",))
+                trackapp.query_commit("INSERT INTO no_such_table VALUES(1)")
+        assert generation("test-nested") == 2
+        assert not trackapp.db_pool.snapshot()["writer_busy"]
+
+
+def test_route_delete_rolls_back_when_generation_bump_fails(client, admin_headers, monkeypatch):
+    r = client.post("/routes", json={"route_name": "bump-fail", "start_point": "a", "end_point": "b"},
+                    headers=admin_headers)
+    assert r.status_code == 201
+    route_id = fetch_one("SELECT route_id FROM routes WHERE route_name='bump-fail'")[0]
+    real = trackapp.query_commit
+
+    def fail_on_bump(sql, params=()):
+        if "cache_generations" in sql:
+            raise sqlite3.OperationalError("disk I/O error")
+        return real(sql, params)
+
+    monkeypatch.setattr(trackapp, "query_commit", fail_on_bump)
+    assert client.delete(f"/routes/{route_id}", headers=admin_headers).status_code == 500
+    monkeypatch.undo()
+    assert fetch_one("SELECT 1 FROM routes WHERE route_id=?", (route_id,)) is not None
+
+
+def test_occupancy_reset_bumps_generation_with_checkpoint(client, admin_headers):
+    before = generation("occupancy")
+    r = client.post("/vehicles/1/occupancy/reset", json={"occupancy": 3}, headers=admin_headers)
+    assert r.status_code == 200
+    row = fetch_one("SELECT occupancy, generation FROM vehicle_occupancy WHERE vehicle_id=1")
+    assert tuple(row) == (3, before + 1)
@@ -0,0 +1,16 @@
+import pytest
+
+
+def test_batch_rejects_overflowing_timestamp_per_item(client, admin_headers):
+    points = [{"vehicle_id": 1, "latitude": 24.9, "longitude": 67.08, "timestamp": 1e20},
+              {"vehicle_id": 1, "latitude": 24.9, "longitude": 67.08}]
+    r = client.post("/gps/batch", json={"points": points}, headers=admin_headers)
+    body = r.get_json()
+    assert (body["accepted"], body["rejected"]) == (1, 1)
+    assert body["results"][0] == {"index": 0, "status": "rejected", "error": "Invalid timestamp"}
+
+
+@pytest.mark.parametrize("path", ["/vehicles/1/track", "/export/gps"])
+def test_overflowing_from_is_a_bad_request(client, admin_headers, path):
+    r = client.get(f"{path}?from=100000000000000000000", headers=admin_headers)
+    assert r.status_code == 400
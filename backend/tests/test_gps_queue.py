@@ -0,0 +1,52 @@
+import csv
+import sqlite3
+
+import pytest
+
+import app as trackapp
+
+ROWS = [(990, 24.9, 67.08, "2030-01-01 00:00:00"), (990, 24.91, 67.08, "2030-01-01 00:00:10")]
+
+
+@pytest.fixture
+def writer(monkeypatch, tmp_path):
+    monkeypatch.setattr(trackapp, "GPS_QUEUE_RETRY_MAX_S", 0.01)
+    monkeypatch.setattr(trackapp, "GPS_DEAD_LETTER_FILE", str(tmp_path / "dead.csv"))
+    q = trackapp.GPSIngestQueue()
+    conn = trackapp.open_db_connection()
+    yield q, conn
+    conn.close()
+
+
+def failing(monkeypatch, error, times):
+    real = trackapp.write_gps_rows
+    calls = []
+
+    def write(conn, rows):
+        calls.append(len(rows))
+        if len(calls) <= times:
+            raise error
+        real(conn, rows)
+    monkeypatch.setattr(trackapp, "write_gps_rows", write)
+    return calls
+
+
+def test_locked_database_is_retried_until_commit(writer, monkeypatch):
+    q, conn = writer
+    calls = failing(monkeypatch, sqlite3.OperationalError("database is locked"), times=3)
+    q._write(conn, ROWS)
+    assert len(calls) == 4
+    assert q.stats["written"] == 2 and q.stats["dead_lettered"] == 0
+
+
+def test_other_errors_go_to_the_dead_letter_file(writer, monkeypatch):
+    q, conn = writer
+    failing(monkeypatch, sqlite3.IntegrityError("boom"), times=1)
+    q._write(conn, ROWS)
+    q._write(conn, ROWS[:1])  # succeeds; the header is written only once
+    with open(trackapp.GPS_DEAD_LETTER_FILE) as f:
+        lines = list(csv.reader(f))
+    assert lines == [["vehicle_id", "latitude", "longitude", "timestamp"],
+                     ["990", "24.9", "67.08", "2030-01-01 00:00:00"],
+                     ["990", "24.91", "67.08", "2030-01-01 00:00:10"]]
+    assert q.stats["dead_lettered"] == 2 and q.stats["written"] == 1
@@ -0,0 +1,20 @@
+import io
+
+import app as trackapp
+from conftest import fetch_one
+
+
+def test_imported_card_can_tap(client, admin_headers, tmp_path):
+    client.post("/categories", json={"category_name": "imported"}, headers=admin_headers)
+    category_id = fetch_one("SELECT category_id FROM user_categories WHERE category_name='imported'")[0]
+    client.post("/permissions", json={"category_id": category_id, "allowed_area": "depot"}, headers=admin_headers)
+    assert client.get("/access/index", headers=admin_headers).status_code == 200
+
+    roster = tmp_path / "roster.csv"
+    roster.write_text("name,email,password,phone,category,card_uid\n"
+                      "Imported Rider,imported@example.com,pw,0,imported,IMPORTED-1\n")
+    summary = trackapp.import_roster_file(str(roster), workers=1, out=io.StringIO())
+    assert summary["inserted"] == 1
+
+    r = client.post("/access/tap", json={"card_uid": "IMPORTED-1", "area": "depot"}, headers=admin_headers)
+    assert r.get_json()["granted"] is True
@@ -0,0 +1,40 @@
+import json
+import os
+
+import app as trackapp
+
+
+def test_metrics_require_token(client, monkeypatch):
+    monkeypatch.setattr(trackapp, "METRICS_TOKEN", "")
+    assert client.get("/metrics").status_code == 404
+
+    monkeypatch.setattr(trackapp, "METRICS_TOKEN", "scrape-token")
+    assert client.get("/metrics").status_code == 401
+    r = client.get("/metrics", headers={"Authorization": "Bearer scrape-token"})
+    assert r.status_code == 200
+    assert "SELECT" not in r.get_data(as_text=True)
+
+
+def test_exited_worker_files_are_folded_into_retired(client, monkeypatch):
+    monkeypatch.setattr(trackapp, "METRICS_TOKEN", "scrape-token")
+    headers = {"Authorization": "Bearer scrape-token"}
+    client.get("/routes")
+    directory = trackapp.metrics.directory()
+    assert os.path.basename(directory) == os.environ["METRICS_RUN_ID"]
+
+    def count(body):
+        line = next(l for l in body.splitlines()
+                    if l.startswith('http_request_duration_seconds_count{method="GET",route="/routes"'))
+        return int(line.rsplit(" ", 1)[1])
+
+    before = count(client.get("/metrics", headers=headers).get_data(as_text=True))
+    own = trackapp.read_snapshot(os.path.join(directory, f"worker-{os.getpid()}.json"))
+    dead = os.path.join(directory, "worker-999999999.json")
+    with open(dead, "w") as f:
+        json.dump(own, f)
+
+    after = count(client.get("/metrics", headers=headers).get_data(as_text=True))
+    assert not os.path.exists(dead)
+    assert os.path.exists(os.path.join(directory, "retired.json"))
+    assert after >= 2 * before
+    assert count(client.get("/metrics", headers=headers).get_data(as_text=True)) >= after
@@ -0,0 +1,64 @@
+import sqlite3
+import threading
+
+import pytest
+
+import app as trackapp
+
+
+def test_invalid_text_coordinates_are_quarantined(tmp_path, monkeypatch):
+    conn = sqlite3.connect(str(tmp_path / "v2.db"))
+    conn.executescript(trackapp.SCHEMA_SQL)
+    monkeypatch.setattr(trackapp, "MIGRATIONS", trackapp.MIGRATIONS[:2])
+    trackapp.apply_migrations(conn)
+    monkeypatch.undo()
+    conn.executemany("INSERT INTO gps_locations(location_id, vehicle_id, latitude, longitude) VALUES(?, ?, ?, ?)", [
+        (1, 1, "24.9", " 67.08 "),
+        (2, 1, "n/a", "67.08"),
+        (3, 2, "24.9", "67.08"),
+        (4, 2, "95", "67.08"),
+        (5, 3, "", "1e400"),
+    ])
+    conn.executemany("INSERT OR REPLACE INTO vehicle_latest_position VALUES(?, ?, ?, '2024-01-01 00:00:00')",
+                     [(1, "n/a", "67.08"), (2, "95", "67.08"), (3, "", "1e400")])
+    conn.commit()
+
+    trackapp.apply_migrations(conn)
+
+    assert conn.execute("SELECT location_id, latitude, longitude FROM gps_locations ORDER BY 1").fetchall() == [
+        (1, 24.9, 67.08), (3, 24.9, 67.08)]
+    assert [r[0] for r in conn.execute("SELECT location_id FROM gps_locations_quarantine ORDER BY 1")] == [2, 4, 5]
+    assert conn.execute("SELECT vehicle_id, latitude, longitude FROM vehicle_latest_position ORDER BY 1").fetchall() == [
+        (1, 24.9, 67.08), (2, 24.9, 67.08)]
+    conn.close()
+
+
+def test_workers_refuse_a_missing_database_by_default(tmp_path, monkeypatch):
+    monkeypatch.setattr(trackapp, "DB_FILE", str(tmp_path / "missing.db"))
+    assert trackapp.DB_INIT_MODE == "check"
+    with pytest.raises(trackapp.SchemaOutOfDateError):
+        trackapp.ensure_database()
+
+
+def test_concurrent_init_seeds_once(tmp_path, monkeypatch):
+    monkeypatch.setattr(trackapp, "DB_FILE", str(tmp_path / "race.db"))
+    trackapp.init_db()
+    conn = sqlite3.connect(trackapp.DB_FILE)
+    with conn:
+        # back to "needs seeding", with the schema in place
+        for table in ("admins", "vehicles", "route_stops", "routes"):
+            conn.execute(f"DELETE FROM {table}")
+    conn.close()
+    threads = [threading.Thread(target=trackapp.init_db) for _ in range(4)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    conn = sqlite3.connect(trackapp.DB_FILE)
+    try:
+        assert conn.execute("SELECT COUNT(*) FROM admins").fetchone()[0] == 1
+        assert conn.execute("SELECT COUNT(*) FROM vehicles").fetchone()[0] == 2
+        assert conn.execute("SELECT COUNT(*) FROM routes").fetchone()[0] == 2
+        assert conn.execute("SELECT COUNT(*) FROM user_categories").fetchone()[0] == 4
+    finally:
+        conn.close()
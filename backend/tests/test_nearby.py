@@ -0,0 +1,15 @@
+import pytest
+
+
+@pytest.mark.parametrize("radius", ["nan", "inf", "-inf", "0", "-5", "abc"])
+def test_nearby_rejects_bad_max_radius(client, admin_headers, radius):
+    r = client.get(f"/nearby?lat=24.9&lon=67.08&max_radius_m={radius}", headers=admin_headers)
+    assert r.status_code == 400
+
+
+def test_nearby_finds_vehicle(client, admin_headers):
+    assert client.post("/gps", json={"vehicle_id": 1, "latitude": 24.9001, "longitude": 67.0801},
+                       headers=admin_headers).status_code == 201
+    r = client.get("/nearby?lat=24.9&lon=67.08&type=vehicles&max_radius_m=1000", headers=admin_headers)
+    assert r.status_code == 200
+    assert 1 in [v["vehicle_id"] for v in r.get_json()["vehicles"]]
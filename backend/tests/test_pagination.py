@@ -0,0 +1,27 @@
+import pytest
+
+from app import encode_cursor
+
+
+@pytest.mark.parametrize("path,values", [
+    ("/gps", ["2024-01-01 00:00:00", [1]]),
+    ("/gps", [{"a": 1}, 2]),
+    ("/gps", [1]),
+    ("/access_logs", [None, 1]),
+    ("/access_logs", ["2024-01-01 00:00:00", True]),
+    ("/cards", [[1]]),
+    ("/cards", [1, 2]),
+])
+def test_malformed_cursor_is_rejected(client, admin_headers, path, values):
+    r = client.get(f"{path}?cursor={encode_cursor(values)}", headers=admin_headers)
+    assert r.status_code == 400
+    assert r.get_json() == {"error": "Invalid cursor"}
+
+
+def test_cursor_pages_follow_each_other(client, admin_headers, make_rider):
+    for _ in range(3):
+        make_rider("gate-p")
+    first = client.get("/cards?cursor=&per_page=2", headers=admin_headers).get_json()
+    assert len(first["items"]) == 2 and first["next_cursor"]
+    second = client.get(f"/cards?cursor={first['next_cursor']}&per_page=2", headers=admin_headers).get_json()
+    assert second["items"][0]["card_id"] < first["items"][-1]["card_id"]
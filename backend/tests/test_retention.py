@@ -0,0 +1,51 @@
+import sqlite3
+
+import pytest
+
+import app as trackapp
+
+VEHICLE = 880
+POINTS = [(24.90, 67.08, "1990-01-01 00:00:00"), (24.91, 67.08, "1990-01-01 00:00:10"),
+          (24.91, 67.09, "1990-01-01 00:05:00"), (24.92, 67.09, "1990-01-01 00:09:00")]
+
+
+@pytest.fixture
+def old_points(flask_app, monkeypatch):
+    monkeypatch.setattr(trackapp, "GPS_RETENTION_DAYS", 365 * 30)  # cutoff lands in the late 1990s
+    monkeypatch.setattr(trackapp, "GPS_RETENTION_PAUSE_MS", 0)
+    conn = sqlite3.connect(trackapp.DB_FILE)
+    with conn:
+        conn.execute("DELETE FROM gps_rollups WHERE vehicle_id=?", (VEHICLE,))
+        conn.executemany("INSERT INTO gps_locations(vehicle_id, latitude, longitude, timestamp) VALUES(?, ?, ?, ?)",
+                         [(VEHICLE, *p) for p in POINTS])
+    conn.close()
+
+
+def rollup_distance():
+    conn = sqlite3.connect(trackapp.DB_FILE)
+    try:
+        return conn.execute("SELECT SUM(distance_m) FROM gps_rollups WHERE vehicle_id=?", (VEHICLE,)).fetchone()[0]
+    finally:
+        conn.close()
+
+
+def test_distance_continues_across_runs(old_points, monkeypatch):
+    monkeypatch.setattr(trackapp, "GPS_RETENTION_CHUNK", 1)
+    for _ in POINTS:
+        assert trackapp.run_gps_retention(max_chunks=1)["compacted"] == 1
+    expected = sum(trackapp.haversine_m(a[0], a[1], b[0], b[1]) for a, b in zip(POINTS, POINTS[1:]))
+    assert rollup_distance() == pytest.approx(expected)
+
+
+def test_run_skips_while_another_holds_the_lease(old_points):
+    conn = sqlite3.connect(trackapp.DB_FILE)
+    with conn:
+        assert trackapp.take_lease(conn, trackapp.RETENTION_LEASE, "other-worker", 60)
+    try:
+        summary = trackapp.run_gps_retention()
+        assert summary["skipped"] and summary["compacted"] == 0
+    finally:
+        with conn:
+            conn.execute("DELETE FROM job_leases WHERE name=?", (trackapp.RETENTION_LEASE,))
+        conn.close()
+    assert trackapp.run_gps_retention()["compacted"] >= len(POINTS)
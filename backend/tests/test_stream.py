@@ -0,0 +1,19 @@
+def open_stream(client, url, **kwargs):
+    r = client.get(url, buffered=False, **kwargs)
+    r.close()
+    return r.status_code
+
+
+def test_stream_ticket_is_single_use(client, admin_headers):
+    r = client.post("/stream/tickets", headers=admin_headers)
+    assert r.status_code == 201
+    ticket = r.get_json()["ticket"]
+
+    assert open_stream(client, f"/stream/positions?ticket={ticket}") == 200
+    assert open_stream(client, f"/stream/positions?ticket={ticket}") == 401
+
+
+def test_stream_rejects_jwt_in_query_string(client, admin_headers):
+    token = admin_headers["Authorization"].split(" ", 1)[1]
+    assert open_stream(client, f"/stream/positions?token={token}") == 401
+    assert open_stream(client, "/stream/positions", headers=admin_headers) == 200